@@ -0,0 +1,57 @@
+"""Compares the chained boolean masks NDVI binning against classify.
+
+Usage:
+    python benchmarks/bench_classification.py --size 10980
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+import synthetic  # noqa: F401 (adds pySatell to the path)
+
+from classification import classify
+
+
+def chained_masks(band: np.ndarray) -> np.ndarray:
+    """The previous CLI binning, working on a copy to keep the input intact."""
+    band = band.copy()
+
+    band[band <= 0] = 0
+    for number, step in enumerate(np.arange(0.0, 0.9, 0.1)):
+        band[(band > step) & (band <= step + 0.1) & (band < 1)] = number + 1
+    band[(band > 0.9) & (band < 1)] = 10
+
+    return band
+
+
+def measure(function) -> tuple:
+    """Returns the elapsed time and the peak of traced memory of a call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=10980)
+    args = parser.parse_args()
+
+    ndvi = np.random.default_rng(0).uniform(-1, 1, size=(args.size, args.size)).astype(np.float32)
+
+    print(f'{"path":>14} {"time (s)":>10} {"peak (MiB)":>11}')
+    for name, function in (
+            ('chained masks', lambda: chained_masks(ndvi)),
+            ('classify', lambda: classify(ndvi)),
+    ):
+        elapsed, peak = measure(function)
+        print(f'{name:>14} {elapsed:>10.3f} {peak / 2 ** 20:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Compares the per field clipping against the batched clipping engine.
+
+Usage:
+    python benchmarks/bench_clipping.py --fields 1 10 50 100 200 [--workers 8] [--reader window]
+"""
+import argparse
+import tempfile
+import time
+
+from pathlib import Path
+
+import rasterio
+
+from rasterio.mask import mask
+
+from synthetic import make_fields, make_product
+
+from clipping import ReaderMode, clip_fields
+from models import Fields
+
+
+def clip_per_field(data_path: Path, resolution: int, geometries: list) -> list:
+    """The previous implementation, opening every band file once per field."""
+    fields_bands = []
+
+    for geometry in geometries:
+        bands = {}
+        for image in data_path.glob(f'**/*B*_{resolution}m.jp2'):
+            with rasterio.open(image) as dataset:
+                bands[str(image).split('_')[-2]], _ = mask(dataset, [geometry], crop=True)
+        fields_bands.append(bands)
+
+    return fields_bands
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fields', type=int, nargs='+', default=[1, 10, 50, 100])
+    parser.add_argument('--size', type=int, default=1098)
+    parser.add_argument('--driver', default='JP2OpenJPEG')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--reader', choices=[mode.value for mode in ReaderMode], default=ReaderMode.MASK.value)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp) / 'data'
+        make_product(data_path, size=args.size, driver=args.driver)
+
+        print(f'{"fields":>8} {"per field (s)":>14} {"batched (s)":>12} {"speedup":>8}')
+        for count in args.fields:
+            fields = Fields(make_fields(Path(tmp) / f'fields_{count}', count, tile_size=args.size))
+            geometries = [field.geometry for field in fields.fields]
+
+            start = time.perf_counter()
+            clip_per_field(data_path, 10, geometries)
+            per_field = time.perf_counter() - start
+
+            start = time.perf_counter()
+            clip_fields(data_path, 10, geometries, workers=args.workers, reader=ReaderMode(args.reader))
+            batched = time.perf_counter() - start
+
+            print(f'{count:>8} {per_field:>14.3f} {batched:>12.3f} {per_field / batched:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
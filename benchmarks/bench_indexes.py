@@ -0,0 +1,64 @@
+"""Compares the Bands index methods against the fused index kernel.
+
+Usage:
+    python benchmarks/bench_indexes.py --size 2000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+
+import synthetic  # noqa: F401 (adds pySatell to the path)
+
+from indexes import compute_indexes
+from models import INDEXES, Band, BandNumber, Bands, BandStack
+
+
+def make_bands(size: int, seed: int = 0) -> Bands:
+    """Returns a Bands object with random uint16 10m bands."""
+    rng = np.random.default_rng(seed)
+    return Bands(**{
+        band: Band(BandNumber(band), 10, rng.integers(1, 10000, size=(1, size, size), dtype=np.uint16))
+        for band in ('B02', 'B03', 'B04', 'B08')
+    })
+
+
+def measure(function) -> tuple:
+    """Returns the elapsed time and the peak of traced memory of a call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def per_method(bands: Bands) -> list:
+    with np.errstate(all='ignore'):
+        return [definition.function(bands) for definition in INDEXES.values()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2000)
+    args = parser.parse_args()
+
+    bands = make_bands(args.size)
+    stacked_bands = Bands.from_stack(BandStack.from_bands(
+        {name: getattr(bands, name) for name in ('B02', 'B03', 'B04', 'B08')}
+    ))
+
+    print(f'{"path":>12} {"time (s)":>10} {"peak (MiB)":>11}')
+    for name, function in (
+            ('per method', lambda: per_method(bands)),
+            ('fused', lambda: compute_indexes(bands)),
+            ('fused stack', lambda: compute_indexes(stacked_bands)),
+    ):
+        elapsed, peak = measure(function)
+        print(f'{name:>12} {elapsed:>10.3f} {peak / 2 ** 20:>11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Measures the startup time of every CLI command, and of offline commands.
+
+Every command is run with --help in a new interpreter, so the time
+includes the interpreter startup and the imports done before parsing
+the arguments. The --help runs never reach the imports done inside the
+commands, so the offline commands (which calculate an index of a single
+field of a small synthetic product) are also timed, to include the
+imports of their code paths.
+
+Usage:
+    python benchmarks/bench_startup.py --repeat 5
+    python benchmarks/bench_startup.py --driver GTiff
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Dict, List
+
+from synthetic import make_fields, make_product
+
+CLI_PATH = Path(__file__).resolve().parents[1] / 'pySatell' / 'cli.py'
+COMMANDS = [
+    [],
+    ['shp-to-geojson'],
+    ['get-vegetation-indexes'],
+    ['plot-vegetation-indexes'],
+    ['export-indexes'],
+    ['export-tile-indexes'],
+    ['zonal-statistics'],
+]
+TILE_SIZE = 256
+
+
+def offline_commands(data_path: Path) -> Dict[str, List[str]]:
+    """Returns the offline commands run on the synthetic product and field of a directory."""
+    arguments = [str(data_path / 'data'), str(data_path / 'fields'), '--sentinel', '--index', 'ndvi']
+    return {
+        'get-vegetation-indexes (ndvi)': ['get-vegetation-indexes', *arguments],
+        'plot-vegetation-indexes (ndvi)': [
+            'plot-vegetation-indexes', *arguments, '--output-dir', str(data_path / 'quicklooks')
+        ],
+    }
+
+
+def run_time(command: List[str], repeat: int) -> float:
+    """Returns the median wall time of running a CLI command in a new interpreter."""
+    # The non interactive backend makes plt.show return at once.
+    env = {**os.environ, 'MPLBACKEND': 'Agg'}
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(CLI_PATH), *command],
+            cwd=CLI_PATH.parent, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def startup_time(command: List[str], repeat: int) -> float:
+    """Returns the median wall time of running a command with --help."""
+    return run_time([*command, '--help'], repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--driver', default='JP2OpenJPEG')
+    args = parser.parse_args()
+
+    print(f'{"command":>32} {"median (s)":>11}')
+    for command in COMMANDS:
+        name = ' '.join(command) or '(app)'
+        print(f'{name:>32} {startup_time(command, args.repeat):>11.3f}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp)
+        make_product(data_path / 'data', size=TILE_SIZE, bands=['B04', 'B08'], driver=args.driver)
+        make_fields(data_path / 'fields', 1, tile_size=TILE_SIZE)
+        for name, command in offline_commands(data_path).items():
+            print(f'{name:>32} {run_time(command, args.repeat):>11.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Runs the benchmark suite on synthetic data and stores the results.
+
+Every benchmark is timed over several repetitions (after a warm up run)
+and its peak of traced memory is measured in a separate run, along with
+the peak resident memory of the process and of its worker processes,
+which also count the GDAL buffers that tracemalloc misses. The results
+are written as JSON to the results directory, named after the date and
+the git commit, so runs can be compared over time.
+
+Usage:
+    python benchmarks/suite.py --fields 10 100 --size 1098 --driver GTiff
+    python benchmarks/suite.py --filter clipping.window --compare benchmarks/results/<baseline>.json
+"""
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from synthetic import make_fields, make_product
+
+from bench_indexes import make_bands, per_method
+from classification import classify
+from clipping import ReaderMode, clip_fields
+from export import IndexEncoding, export_field_indexes, export_mosaic, export_tile_indexes
+from indexes import compute_indexes
+from models import Bands, Fields
+from rendering import Quicklook, RenderStyle, render_quicklooks
+
+RESULTS_PATH = Path(__file__).resolve().parent / 'results'
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace, Path], Dict[str, Callable]]] = {}
+
+
+def benchmark(group: str):
+    """Registers a function returning the cases of a group of benchmarks.
+
+    The function receives the parsed arguments and a directory with the
+    synthetic data, does any setup that should not be timed, and returns
+    a dict with the case name as the key and the callable to time as the
+    value.
+    """
+    def register(function):
+        BENCHMARKS[group] = function
+        return function
+    return register
+
+
+def _clipped_fields(data_path: Path, count: int) -> List:
+    fields = Fields(data_path / f'fields_{count}').fields
+    for field, bands in zip(fields, clip_fields(data_path / 'data', 10, [field.geometry for field in fields])):
+        field.bands = Bands(**bands)
+    return fields
+
+
+@benchmark('fields')
+def fields_benchmarks(args: argparse.Namespace, data_path: Path) -> Dict[str, Callable]:
+    cases = {}
+    for count in args.fields:
+        path = data_path / f'fields_{count}'
+        cases[f'load[{count}]'] = lambda path=path: Fields(path)
+        cases[f'load_cached[{count}]'] = lambda path=path: Fields(path, cache_directory=data_path / 'fields_cache')
+        cases[f'intersecting[{count}]'] = lambda fields=Fields(path): [
+            fields.intersecting(field.geometry) for field in fields.fields
+        ]
+    return cases
+
+
+@benchmark('clipping')
+def clipping_benchmarks(args: argparse.Namespace, data_path: Path) -> Dict[str, Callable]:
+    cases = {}
+    for count in args.fields:
+        geometries = [field.geometry for field in Fields(data_path / f'fields_{count}').fields]
+        for reader in ReaderMode:
+            cases[f'{reader.value}[{count}]'] = lambda geometries=geometries, reader=reader: clip_fields(
+                data_path / 'data', 10, geometries, workers=args.workers, reader=reader
+            )
+    return cases
+
+
+@benchmark('indexes')
+def indexes_benchmarks(args: argparse.Namespace, data_path: Path) -> Dict[str, Callable]:
+    bands = make_bands(args.index_size)
+    return {
+        'per_method': lambda: per_method(bands),
+        'fused': lambda: compute_indexes(bands),
+    }
+
+
+@benchmark('classification')
+def classification_benchmarks(args: argparse.Namespace, data_path: Path) -> Dict[str, Callable]:
+    ndvi = np.random.default_rng(0).uniform(-1, 1, size=(args.index_size, args.index_size)).astype(np.float32)
+    return {'classify': lambda: classify(ndvi)}
+
+
+@benchmark('export')
+def export_benchmarks(args: argparse.Namespace, data_path: Path) -> Dict[str, Callable]:
+    cases = {}
+    for count in args.fields:
+        fields = _clipped_fields(data_path, count)
+        output = data_path / f'export_{count}'
+        for encoding in IndexEncoding:
+            cases[f'fields_{encoding.value}[{count}]'] = lambda fields=fields, encoding=encoding: (
+                export_field_indexes(fields, output / encoding.value, ['ndvi'], encoding)
+            )
+        cases[f'mosaic[{count}]'] = lambda fields=fields: export_mosaic(fields, output / 'ndvi.tif')
+    for chunk_size in args.chunk_sizes:
+        cases[f'tile[{chunk_size}]'] = lambda chunk_size=chunk_size: export_tile_indexes(
+            data_path / 'data', 10, data_path / f'tile_{chunk_size}', ['ndvi', 'evi'], chunk_size=chunk_size
+        )
+    return cases
+
+
+@benchmark('rendering')
+def rendering_benchmarks(args: argparse.Namespace, data_path: Path) -> Dict[str, Callable]:
+    cases = {}
+    for count in args.fields:
+        output = data_path / f'quicklooks_{count}'
+        quicklooks = [
+            Quicklook(output / f'{number}.png', field.get_all_indexes(['ndvi'])['ndvi'])
+            for number, field in enumerate(_clipped_fields(data_path, count))
+        ]
+        for decorations in (False, True):
+            name = 'figure' if decorations else 'rgba'
+            cases[f'{name}[{count}]'] = lambda quicklooks=quicklooks, decorations=decorations: render_quicklooks(
+                quicklooks, RenderStyle.HEAT_MAP, decorations=decorations, workers=args.workers
+            )
+    return cases
+
+
+def peak_rss_mib(who: int = resource.RUSAGE_SELF) -> float:
+    """Returns the peak resident memory of the process (or of its finished children) in MiB."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes and macOS bytes.
+    return maxrss / 2 ** 20 if sys.platform == 'darwin' else maxrss / 2 ** 10
+
+
+def measure(function: Callable, repeat: int) -> dict:
+    """Returns the min and median time of the repetitions, and the memory peaks.
+
+    The traced memory peak covers the Python allocations of the benchmark
+    only. The resident memory peaks also cover the native allocations (GDAL
+    blocks and caches) and the worker processes, but they are high water
+    marks of the whole run: a benchmark only raises them above the peaks of
+    the benchmarks that ran before it.
+    """
+    function()
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {
+        'min': min(times),
+        'median': statistics.median(times),
+        'peak_mib': peak / 2 ** 20,
+        'rss_peak_mib': peak_rss_mib(resource.RUSAGE_SELF),
+        'children_rss_peak_mib': peak_rss_mib(resource.RUSAGE_CHILDREN),
+    }
+
+
+def git_commit() -> str:
+    """Returns the short hash of the current commit, or 'unknown' outside a git tree."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """Prints the median time and peak memory ratios against a baseline run."""
+    print(f'\nCompared with {baseline["commit"]} ({baseline["timestamp"]}):')
+    print(f'{"benchmark":>36} {"time":>8} {"memory":>8}')
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        previous = baseline['results'][name]
+        time_ratio = result['median'] / previous['median'] if previous['median'] else float('nan')
+        memory_ratio = result['peak_mib'] / previous['peak_mib'] if previous['peak_mib'] else float('nan')
+        print(f'{name:>36} {time_ratio:>7.2f}x {memory_ratio:>7.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fields', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--field-size', type=int, default=40, help='Side of the fields in pixels.')
+    parser.add_argument('--size', type=int, default=1098, help='Side of the synthetic tile in pixels.')
+    parser.add_argument('--index-size', type=int, default=2000, help='Side of the index rasters in pixels.')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[512, 2048],
+                        help='Chunk sizes of the full tile index export.')
+    parser.add_argument('--driver', default='JP2OpenJPEG')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', default='', help='Run only the benchmarks starting with this group[.case].')
+    parser.add_argument('--output', type=Path, default=RESULTS_PATH)
+    parser.add_argument('--compare', type=Path, help='A previous results file to compare with.')
+    args = parser.parse_args()
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform()},
+        'parameters': {key: str(value) for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp)
+        make_product(data_path / 'data', size=args.size, driver=args.driver)
+        for count in args.fields:
+            make_fields(data_path / f'fields_{count}', count, tile_size=args.size, field_size=args.field_size)
+
+        print(
+            f'{"benchmark":>36} {"min (s)":>9} {"median (s)":>11} {"peak (MiB)":>11} {"rss (MiB)":>10} '
+            f'{"children rss (MiB)":>19}'
+        )
+        for group, cases in BENCHMARKS.items():
+            # The setup of the groups that are filtered out is skipped.
+            if not (group.startswith(args.filter) or args.filter.startswith(group)):
+                continue
+            for case, function in cases(args, data_path).items():
+                name = f'{group}.{case}'
+                if not name.startswith(args.filter):
+                    continue
+                result = measure(function, args.repeat)
+                results['results'][name] = result
+                print(
+                    f'{name:>36} {result["min"]:>9.3f} {result["median"]:>11.3f} {result["peak_mib"]:>11.1f} '
+                    f'{result["rss_peak_mib"]:>10.1f} {result["children_rss_peak_mib"]:>19.1f}'
+                )
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    path = args.output / f'{datetime.now():%Y%m%dT%H%M%S}_{results["commit"]}.json'
+    path.write_text(json.dumps(results, indent=2))
+    print(f'\nResults written to {path}')
+
+    if args.compare is not None:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == '__main__':
+    main()
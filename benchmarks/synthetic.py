@@ -0,0 +1,120 @@
+"""Synthetic sentinel 2 products and field shapefiles used by the benchmarks."""
+import sys
+
+from pathlib import Path
+from typing import List
+
+import fiona
+import numpy as np
+import rasterio
+
+from rasterio.transform import from_origin
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'pySatell'))
+
+CRS = 'EPSG:32720'
+ORIGIN = (300000.0, 6100020.0)
+TILE = 'T20HNH'
+SENSING_TIME = '20220101T140051'
+PRODUCT_NAME = f'S2A_MSIL2A_{SENSING_TIME}_N0301_R067_{TILE}_20220101T163245.SAFE'
+BANDS = {
+    10: ['B02', 'B03', 'B04', 'B08'],
+    20: ['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12'],
+    60: ['B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B09', 'B11', 'B12'],
+}
+
+
+def band_path(root: Path, band: str, resolution: int, product_name: str = PRODUCT_NAME) -> Path:
+    """Returns the path of a band file inside a L2A SAFE layout."""
+    granule = f'L2A_{TILE}_A000000_{SENSING_TIME}'
+    return (
+        root / product_name / 'GRANULE' / granule / 'IMG_DATA' / f'R{resolution}m'
+        / f'{TILE}_{SENSING_TIME}_{band}_{resolution}m.jp2'
+    )
+
+
+def make_product(
+        root: Path,
+        size: int = 1098,
+        resolution: int = 10,
+        bands: List[str] = None,
+        driver: str = 'JP2OpenJPEG',
+        product_name: str = PRODUCT_NAME,
+        seed: int = 0
+) -> Path:
+    """Writes a synthetic L2A product with uint16 reflectance bands.
+
+    Args:
+        root (Path): Directory where the SAFE product is created.
+        size (int): Width and height of the bands in pixels.
+        resolution (int): The bands resolution in meters.
+        bands (List[str]): The band names to write. Defaults to all
+            the bands available for the resolution.
+        driver (str): GDAL driver used to write the bands. 'GTiff' can
+            be used when the OpenJPEG driver is not available.
+        product_name (str): Name of the SAFE directory.
+        seed (int): Seed of the random reflectances.
+
+    Returns:
+        The path of the SAFE directory.
+    """
+    rng = np.random.default_rng(seed)
+    bands = BANDS[resolution] if bands is None else bands
+
+    for band in bands:
+        path = band_path(root, band, resolution, product_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        raster = rng.integers(1, 10000, size=(size, size), dtype=np.uint16)
+
+        with rasterio.open(
+                path, 'w', driver=driver, width=size, height=size, count=1,
+                dtype='uint16', crs=CRS, transform=from_origin(*ORIGIN, resolution, resolution)
+        ) as dataset:
+            dataset.write(raster, 1)
+
+    return root / product_name
+
+
+def make_fields(
+        root: Path,
+        count: int,
+        tile_size: int = 1098,
+        field_size: int = 40,
+        resolution: int = 10,
+        seed: int = 0
+) -> Path:
+    """Writes a shapefile with square fields placed inside the synthetic tile.
+
+    Args:
+        root (Path): Directory where the shapefile is created.
+        count (int): Number of fields.
+        tile_size (int): Width and height of the tile in pixels.
+        field_size (int): Side of every field in pixels.
+        resolution (int): The tile resolution in meters.
+        seed (int): Seed of the fields positions.
+
+    Returns:
+        The directory containing the shapefile.
+    """
+    rng = np.random.default_rng(seed)
+    root.mkdir(parents=True, exist_ok=True)
+    schema = {'geometry': 'Polygon', 'properties': {'farm_name': 'str'}}
+    side = field_size * resolution
+
+    with fiona.open(root / 'fields.shp', 'w', driver='ESRI Shapefile', crs=CRS, schema=schema) as shapefile:
+        for number in range(count):
+            column, row = rng.integers(0, tile_size - field_size, size=2)
+            left = ORIGIN[0] + column * resolution
+            top = ORIGIN[1] - row * resolution
+            shapefile.write({
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[
+                        (left, top), (left + side, top), (left + side, top - side),
+                        (left, top - side), (left, top)
+                    ]]
+                },
+                'properties': {'farm_name': f'farm_{number}'},
+            })
+
+    return root
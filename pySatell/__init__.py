@@ -1,6 +1,8 @@
-from sentinelsat import SentinelAPI
+from data import get_sentinel_api
 
-from data import API_USER, API_PASSWORD, SENTINEL_API_URL
 
-
-sentinel_api = SentinelAPI(API_USER, API_PASSWORD, SENTINEL_API_URL)
+def __getattr__(name):
+    # The client is created on first access instead of at import time.
+    if name == 'sentinel_api':
+        return get_sentinel_api()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,139 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Dict, Union
+
+from rasterio.enums import Resampling
+from rasterio.transform import Affine
+from rasterio.vrt import WarpedVRT
+
+import os
+import rasterio
+
+from clipping import _band_resolution, product_id
+
+
+def aligned_band_path(
+        directory: Path,
+        image: Union[Path, str],
+        resolution: int,
+        resampling: Resampling
+) -> Path:
+    """Returns the path of the resampled copy of a band file.
+
+    The name keeps the `<product>_<band>_<resolution>m` layout of the band
+    files, under a directory per resampling kernel.
+    """
+    band = str(image).split('_')[-2]
+    return Path(directory) / resampling.name / f'{product_id(image)}_{band}_{resolution}m.tif'
+
+
+def default_aligned_directory(data_path: Path) -> Path:
+    """Returns the `aligned` directory next to the products of a data path."""
+    return (data_path if data_path.is_dir() else data_path.parent) / 'aligned'
+
+
+def align_band(
+        image: Union[Path, str],
+        resolution: int,
+        resampling: Resampling = Resampling.bilinear,
+        directory: Path = Path('.')
+) -> Path:
+    """Resample a band file to the grid of another resolution of its tile.
+
+    All the resolutions of a sentinel2 tile share the same origin and
+    extent, so the target grid is the band extent divided in pixels of the
+    desired resolution. The whole tile is resampled once, through a
+    WarpedVRT, into a tiled GeoTIFF that is reused by every field, index and
+    later run. Files already resampled are returned without reading the band.
+
+    Args:
+        image (Union[Path, str]): Path of the band file.
+        resolution (int): The target resolution in meters.
+        resampling (Resampling): The resampling kernel.
+        directory (Path): Directory where the resampled files are stored.
+
+    Returns:
+        The path of the resampled band file.
+    """
+    path = aligned_band_path(directory, image, resolution, resampling)
+    if path.exists():
+        return path
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = path.with_name(f'{path.stem}.{os.getpid()}.partial')
+
+    with rasterio.open(image) as dataset:
+        left, bottom, right, top = dataset.bounds
+        width = int(round((right - left) / resolution))
+        height = int(round((top - bottom) / resolution))
+
+        with WarpedVRT(
+                dataset,
+                crs=dataset.crs,
+                transform=Affine(resolution, 0, left, 0, -resolution, top),
+                width=width,
+                height=height,
+                resampling=resampling
+        ) as vrt:
+            profile = vrt.profile
+            profile.update(
+                driver='GTiff', tiled=True, blockxsize=512, blockysize=512, compress='deflate'
+            )
+            with rasterio.open(partial_path, 'w', **profile) as aligned:
+                for _, window in aligned.block_windows(1):
+                    aligned.write(vrt.read(window=window), window=window)
+
+    os.replace(partial_path, path)
+    return path
+
+
+def _can_decimate(image: Union[Path, str], resolution: int) -> bool:
+    """Returns True if a band file can be read at a resolution from its JP2 levels."""
+    factor = resolution / _band_resolution(image)
+    return factor > 1 and factor.is_integer() and int(factor) & (int(factor) - 1) == 0
+
+
+def align_band_paths(
+        band_paths: Dict[str, Union[Path, str]],
+        resolution: int,
+        resampling: Resampling = Resampling.bilinear,
+        directory: Path = Path('.'),
+        workers: int = 1,
+        decimate: bool = False
+) -> Dict[str, Union[Path, str]]:
+    """Align the band files of a tile to the grid of a resolution.
+
+    Args:
+        band_paths (Dict[str, Union[Path, str]]): The band files, with the
+            band name as the key, as returned by get_band_paths.
+        resolution (int): The target resolution in meters.
+        resampling (Resampling): The resampling kernel.
+        directory (Path): Directory where the resampled files are stored.
+        workers (int): Number of processes used to resample the bands.
+        decimate (bool): Keep the finer files that can be read at the
+            resolution from their JP2 resolution levels (as the WINDOW
+            reader does) instead of resampling them.
+
+    Returns:
+        A dict with the same bands, where the files not at the resolution
+            are replaced by their resampled copy.
+    """
+    misaligned = [
+        band for band, image in band_paths.items()
+        if _band_resolution(image) != resolution and not (decimate and _can_decimate(image, resolution))
+    ]
+    arguments = (
+        [band_paths[band] for band in misaligned],
+        repeat(resolution),
+        repeat(resampling),
+        repeat(directory)
+    )
+
+    if workers > 1 and len(misaligned) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            aligned_paths = list(executor.map(align_band, *arguments))
+    else:
+        aligned_paths = map(align_band, *arguments)
+
+    return {**band_paths, **dict(zip(misaligned, aligned_paths))}
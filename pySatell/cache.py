@@ -0,0 +1,114 @@
+from pathlib import Path
+from typing import Optional
+
+from numpy import ndarray
+
+import hashlib
+import os
+import numpy as np
+
+
+class ClippedRasterCache:
+    """Content addressed on disk cache of clipped field rasters.
+
+    The rasters are stored as .npy files named after a hash of the product,
+    band, resolution, field geometry and reader mode (the readers clip
+    different extents and masks), and are loaded memory mapped. The
+    mask of masked rasters is stored in a .mask.npy file next to them. When
+    the cache grows over its size limit, the least recently used files are
+    evicted (every hit refreshes the modification time of the file).
+
+    Args:
+        directory (Path): Directory where the rasters are stored.
+        max_bytes (int): Size limit of the cache in bytes.
+
+    Attributes:
+        directory (Path): Directory where the rasters are stored.
+        max_bytes (int): Size limit of the cache in bytes.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = 2 ** 30):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._size = None
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(product_id: str, band: str, resolution: int, geometry_hash: str, reader: str) -> str:
+        """Returns the cache key of a clipped raster, with the value of the ReaderMode that clipped it."""
+        return hashlib.sha256(f'{product_id}|{band}|{resolution}|{geometry_hash}|{reader}'.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f'{key}.npy'
+
+    @staticmethod
+    def _mask_path(path: Path) -> Path:
+        return path.with_name(f'{path.stem}.mask.npy')
+
+    def get(self, key: str) -> Optional[ndarray]:
+        """Returns the memory mapped raster of a key, or None if it is not cached."""
+        path = self._path(key)
+        mask_path = self._mask_path(path)
+
+        try:
+            raster = np.load(path, mmap_mode='r')
+            if mask_path.exists():
+                raster = np.ma.masked_array(raster, mask=np.load(mask_path, mmap_mode='r'))
+        except (FileNotFoundError, ValueError):
+            return None
+
+        os.utime(path)
+        return raster
+
+    def put(self, key: str, raster: ndarray) -> None:
+        """Stores a raster and evicts old rasters if the size limit is exceeded."""
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+
+        # The mask is written first, so a raster is never loaded without it.
+        if np.ma.isMaskedArray(raster):
+            self._save(self._mask_path(path), np.ma.getmaskarray(raster))
+        self._save(path, np.ma.getdata(raster))
+
+        if self._size is None:
+            self.evict()
+        else:
+            self._size += self._entry_size(path)
+            if self._size > self.max_bytes:
+                self.evict()
+
+    @staticmethod
+    def _save(path: Path, array: ndarray) -> None:
+        # Written to a temporary file first, so concurrent readers never
+        # load a partially written array.
+        partial_path = path.with_name(f'{path.stem}.{os.getpid()}.partial')
+        with open(partial_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(partial_path, path)
+
+    def _entry_size(self, path: Path) -> int:
+        mask_path = self._mask_path(path)
+        return path.stat().st_size + (mask_path.stat().st_size if mask_path.exists() else 0)
+
+    def evict(self) -> None:
+        """Removes the least recently used rasters until the cache fits its size limit."""
+        entries = []
+        for path in self.directory.glob('*/*.npy'):
+            if path.name.endswith('.mask.npy'):
+                continue
+            try:
+                entries.append((path.stat().st_mtime, self._entry_size(path), path))
+            except FileNotFoundError:
+                continue
+
+        size = sum(entry[1] for entry in entries)
+
+        for _, file_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            self._mask_path(path).unlink(missing_ok=True)
+            path.unlink(missing_ok=True)
+            size -= file_size
+
+        self._size = size
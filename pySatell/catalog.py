@@ -0,0 +1,257 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from shapely import wkt
+
+import hashlib
+import sqlite3
+
+# The products are published some time after their sensing date (L2A ones
+# hours to days later), so the last days of a synced window are queried again.
+SYNC_OVERLAP = timedelta(days=3)
+
+
+class ProductCatalog:
+    """Local SQLite catalog of the products metadata.
+
+    The catalog stores the footprint, sensing date, cloud coverage, platform,
+    tile and local path of every product seen in a hub query, with a spatial
+    (R*Tree) and a date index. It also remembers which date window was
+    already queried for every zone, so only the new dates are sent to the
+    hub and "what is new for this zone" can be answered locally.
+
+    Args:
+        path (Path): Path of the SQLite database. It is created if it does
+            not exist.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS products (
+                    rowid INTEGER PRIMARY KEY,
+                    id TEXT UNIQUE NOT NULL,
+                    title TEXT NOT NULL,
+                    platform TEXT,
+                    tile TEXT,
+                    sensing_date TEXT NOT NULL,
+                    cloud_coverage REAL,
+                    footprint TEXT NOT NULL,
+                    min_x REAL, min_y REAL, max_x REAL, max_y REAL,
+                    local_path TEXT
+                )
+                """
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS products_sensing_date ON products (sensing_date)'
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS synced_zones (
+                    zone TEXT PRIMARY KEY,
+                    date_from TEXT NOT NULL,
+                    date_to TEXT NOT NULL
+                )
+                """
+            )
+            try:
+                self.connection.execute(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS products_bounds USING rtree(rowid, min_x, max_x, min_y, max_y)'
+                )
+                self.rtree = True
+            except sqlite3.OperationalError:
+                # SQLite built without the R*Tree module.
+                self.connection.execute(
+                    'CREATE INDEX IF NOT EXISTS products_bounds ON products (min_x, max_x, min_y, max_y)'
+                )
+                self.rtree = False
+
+    def close(self) -> None:
+        self.connection.close()
+
+    @staticmethod
+    def zone_key(footprint: str, platform_name: str, cloud_coverage_percentage: Tuple) -> str:
+        """Returns the key identifying a query zone and its filters."""
+        return hashlib.sha256(f'{footprint}|{platform_name}|{cloud_coverage_percentage}'.encode()).hexdigest()
+
+    def add_products(self, products: Dict[str, dict]) -> List[str]:
+        """Add the products returned by a SentinelAPI query.
+
+        Args:
+            products (Dict[str, dict]): The products returned by SentinelAPI.query.
+
+        Returns:
+            The ids of the products that were not in the catalog.
+        """
+        new_products = []
+
+        with self.connection:
+            for product_id, properties in products.items():
+                if self.get_product(product_id) is not None:
+                    continue
+
+                footprint = wkt.loads(properties['footprint'])
+                min_x, min_y, max_x, max_y = footprint.bounds
+                title = properties['title']
+                cursor = self.connection.execute(
+                    """
+                    INSERT INTO products (
+                        id, title, platform, tile, sensing_date, cloud_coverage,
+                        footprint, min_x, min_y, max_x, max_y
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        product_id,
+                        title,
+                        title.split('_')[0],
+                        properties.get('tileid') or title.split('_')[5][1:],
+                        properties['beginposition'].isoformat(),
+                        properties.get('cloudcoverpercentage'),
+                        properties['footprint'],
+                        min_x, min_y, max_x, max_y
+                    )
+                )
+                if self.rtree:
+                    self.connection.execute(
+                        'INSERT INTO products_bounds VALUES (?, ?, ?, ?, ?)',
+                        (cursor.lastrowid, min_x, max_x, min_y, max_y)
+                    )
+                new_products.append(product_id)
+
+        return new_products
+
+    def get_product(self, product_id: str) -> Optional[sqlite3.Row]:
+        """Returns the catalog row of a product, or None if it is unknown."""
+        return self.connection.execute('SELECT * FROM products WHERE id = ?', (product_id,)).fetchone()
+
+    def set_local_path(self, product_id: str, local_path: Path) -> None:
+        """Record where a product was downloaded."""
+        with self.connection:
+            self.connection.execute(
+                'UPDATE products SET local_path = ? WHERE id = ?', (str(local_path), product_id)
+            )
+
+    def search(
+            self,
+            footprint: str,
+            date_from: datetime,
+            date_to: datetime,
+            cloud_coverage_percentage: Tuple = (0, 100),
+            downloaded: bool = None
+    ) -> List[sqlite3.Row]:
+        """Search the catalog for the products of an area and a date window.
+
+        Args:
+            footprint (str): WKT of the desired area.
+            date_from (datetime): Starting date of the time window.
+            date_to (datetime): End date of the time window.
+            cloud_coverage_percentage (Tuple): The accepted range of cloud
+                coverage.
+            downloaded (bool): If given, return only the products that were
+                (or were not) downloaded.
+
+        Returns:
+            The matching catalog rows, sorted by sensing date.
+        """
+        area = wkt.loads(footprint)
+        min_x, min_y, max_x, max_y = area.bounds
+
+        if self.rtree:
+            bounds_filter = (
+                'rowid IN (SELECT rowid FROM products_bounds '
+                'WHERE max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?)'
+            )
+        else:
+            bounds_filter = 'max_x >= ? AND min_x <= ? AND max_y >= ? AND min_y <= ?'
+
+        query = f"""
+            SELECT * FROM products
+            WHERE {bounds_filter}
+            AND sensing_date >= ? AND sensing_date <= ?
+            AND (cloud_coverage IS NULL OR cloud_coverage BETWEEN ? AND ?)
+        """
+        if downloaded is not None:
+            query += f" AND local_path IS {'NOT ' if downloaded else ''}NULL"
+
+        rows = self.connection.execute(
+            query + ' ORDER BY sensing_date',
+            (
+                min_x, max_x, min_y, max_y,
+                date_from.isoformat(), date_to.isoformat(),
+                *cloud_coverage_percentage
+            )
+        ).fetchall()
+
+        return [row for row in rows if wkt.loads(row['footprint']).intersects(area)]
+
+    def sync(
+            self,
+            api,
+            footprint: str,
+            date_from: datetime,
+            date_to: datetime,
+            platform_name: str = 'Sentinel-2',
+            cloud_coverage_percentage: Tuple = (0, 100),
+            overlap: timedelta = SYNC_OVERLAP
+    ) -> List[str]:
+        """Query the hub only for the dates of a zone missing in the catalog.
+
+        If the zone was already synced from date_from (or earlier), only the
+        window after the last synced date, minus the overlap, is queried.
+        The windows are sensing dates, so the overlap catches the products
+        sensed before the last synced date but published after that sync.
+        The zone is identified by its footprint, platform and cloud coverage
+        range.
+
+        Args:
+            api (SentinelAPI): The client used to query the hub.
+            footprint (str): WKT of the desired area.
+            date_from (datetime): Starting date of the time window.
+            date_to (datetime): End date of the time window.
+            platform_name (str): The name of the satellite.
+            cloud_coverage_percentage (Tuple): The accepted range of cloud
+                coverage.
+            overlap (timedelta): The time before the last synced date that
+                is queried again.
+
+        Returns:
+            The ids of the products added to the catalog.
+        """
+        zone = self.zone_key(footprint, platform_name, cloud_coverage_percentage)
+        synced = self.connection.execute(
+            'SELECT date_from, date_to FROM synced_zones WHERE zone = ?', (zone,)
+        ).fetchone()
+
+        query_from = date_from
+        if synced is not None and datetime.fromisoformat(synced['date_from']) <= date_from:
+            # Starting at the last synced date (even if it is before date_from)
+            # keeps the synced window of the zone free of gaps.
+            query_from = datetime.fromisoformat(synced['date_to']) - overlap
+            if query_from >= date_to:
+                return []
+
+        products = api.query(
+            footprint,
+            date=(query_from, date_to),
+            platformname=platform_name,
+            cloudcoverpercentage=cloud_coverage_percentage
+        )
+        new_products = self.add_products(products)
+
+        synced_from = date_from if synced is None else min(date_from, datetime.fromisoformat(synced['date_from']))
+        synced_to = date_to if synced is None else max(date_to, datetime.fromisoformat(synced['date_to']))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO synced_zones VALUES (?, ?, ?)',
+                (zone, synced_from.isoformat(), synced_to.isoformat())
+            )
+
+        return new_products
@@ -0,0 +1,64 @@
+from typing import Sequence
+
+from numpy import ndarray
+
+import numpy as np
+
+
+NDVI_BREAKPOINTS = (0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+NODATA_CLASS = 255
+
+
+def classify(
+        raster: ndarray,
+        breakpoints: Sequence[float] = NDVI_BREAKPOINTS,
+        out: ndarray = None,
+        chunk_size: int = 2 ** 20
+) -> ndarray:
+    """Bin an index raster in classes delimited by increasing breakpoints.
+
+    A value gets the class i when breakpoints[i - 1] < value <= breakpoints[i],
+    so values under the first breakpoint get the class 0 and values over the
+    last one get the class len(breakpoints). NaN values, and the masked
+    ones of a masked array, get NODATA_CLASS.
+
+    The raster is never modified. It is traversed once, in chunks, so the
+    only temporaries are chunk sized.
+
+    Args:
+        raster (ndarray): The index raster to classify.
+        breakpoints (Sequence[float]): The increasing upper limits of the
+            classes. Defaults to the NDVI classes, from 0 to 0.9 in 0.1 steps.
+        out (ndarray): Optional C contiguous uint8 array with the raster
+            shape where the classes are written.
+        chunk_size (int): Number of pixels classified at once.
+
+    Raises:
+        ValueError if there are too many breakpoints for a uint8 class or
+            `out` is not a C contiguous uint8 array with the raster shape.
+
+    Returns:
+        A uint8 array with the class of every pixel.
+    """
+    raster = np.ma.filled(raster, np.nan)
+    breakpoints = np.asarray(breakpoints)
+
+    if len(breakpoints) >= NODATA_CLASS:
+        raise ValueError(f'At most {NODATA_CLASS - 1} breakpoints are supported')
+
+    if out is None:
+        out = np.empty(raster.shape, dtype=np.uint8)
+    elif out.shape != raster.shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError(f'Expected a C contiguous uint8 out with shape {raster.shape}')
+
+    flat_raster = raster.reshape(-1)
+    flat_out = out.reshape(-1)
+
+    for start in range(0, flat_raster.size, chunk_size):
+        chunk = flat_raster[start:start + chunk_size]
+        classes = flat_out[start:start + chunk_size]
+
+        classes[...] = np.digitize(chunk, breakpoints, right=True)
+        classes[np.isnan(chunk)] = NODATA_CLASS
+
+    return out
@@ -1,13 +1,10 @@
 import typer
 
-import matplotlib.pyplot as plt
-import numpy as np
-
 from pathlib import Path
+from typing import List
 
-from plotter import IndexPlotter
-from sdk import LandsatMSIManagerCreator, SentinelMSIManagerCreator, SentinelProcessingParams, Fields
-from utils import generate_geojsons
+# The scientific stack and the satellite clients are imported inside the
+# commands, so `--help` and the commands that do not need them start fast.
 
 app = typer.Typer(help="CLI used to manage satellite images data.")
 
@@ -21,6 +18,8 @@ def shp_to_geojson(
         )
 ):
     """Convert shape to geojson."""
+    from utils import generate_geojsons
+
     generate_geojsons(Path(path))
 
 
@@ -44,17 +43,62 @@ def get_vegetation_indexes(
             False,
             help='Process landsat images.',
             metavar='landsat'
+        ),
+        workers: int = typer.Option(
+            1,
+            help='Number of processes used to decode and clip the bands.',
+            min=1
+        ),
+        fields_cache_dir: str = typer.Option(
+            None,
+            help='Directory used to cache the parsed shapefiles of the fields between runs.'
+        ),
+        index: List[str] = typer.Option(
+            None,
+            help='Vegetation index to calculate. Can be repeated. Defaults to all the indexes.'
+        ),
+        cache_dir: str = typer.Option(
+            None,
+            help='Directory used to cache the clipped field rasters between runs.'
+        ),
+        cache_size: int = typer.Option(
+            1024,
+            help='Size limit of the clipped rasters cache in MiB.'
+        ),
+        resampling: str = typer.Option(
+            None,
+            help='Resampling kernel (nearest, bilinear, cubic, average...) used to align '
+                 'the bands without a 10m file, for example B05 or B11.'
+        ),
+        min_clear_fraction: float = typer.Option(
+            None,
+            help='Mask the cloudy pixels with the L2A scene classification layer, and skip the '
+                 'fields with a lower fraction of clear pixels.',
+            min=0,
+            max=1
         )
 
 ):
     """Get all vegetation indexes for the desired images."""
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    from rasterio.enums import Resampling
+
+    from cache import ClippedRasterCache
+    from classification import NODATA_CLASS, classify
+    from cloudmask import CloudMask
+    from sdk import LandsatMSIManagerCreator, SentinelMSIManagerCreator, SentinelProcessingParams, Fields
 
     if sentinel:
-        fields = Fields(Path(fields_path))
+        fields = Fields(Path(fields_path), workers, Path(fields_cache_dir) if fields_cache_dir else None)
         filters = SentinelProcessingParams(
             data_path=Path(image_path),
             fields=fields,
-            resolution=10
+            resolution=10,
+            cache=ClippedRasterCache(Path(cache_dir), cache_size * 2 ** 20) if cache_dir else None,
+            resampling=Resampling[resampling] if resampling else None,
+            cloud_mask=CloudMask(min_clear_fraction=min_clear_fraction) if min_clear_fraction is not None else None
         )
         manager = SentinelMSIManagerCreator()
     elif landsat:
@@ -64,29 +108,17 @@ def get_vegetation_indexes(
         manager = SentinelMSIManagerCreator()
         filters = None
 
-    indexes = manager.get_indexes(filters)
+    indexes = manager.get_indexes(filters, workers=workers, indexes=index or None)
 
     for band in indexes:
         band = band[0]
-        band2 = band.copy()
-
-        band[band <= 0] = 0
-        band[(band > 0) & (band <= 0.1)] = 1
-        band[(band > 0.1) & (band <= 0.2) & (band < 1)] = 2
-        band[(band > 0.2) & (band <= 0.3) & (band < 1)] = 3
-        band[(band > 0.3) & (band <= 0.4) & (band < 1)] = 4
-        band[(band > 0.4) & (band <= 0.5) & (band < 1)] = 5
-        band[(band > 0.5) & (band <= 0.6) & (band < 1)] = 6
-        band[(band > 0.6) & (band <= 0.7) & (band < 1)] = 7
-        band[(band > 0.7) & (band <= 0.8) & (band < 1)] = 8
-        band[(band > 0.8) & (band <= 0.9) & (band < 1)] = 9
-        band[(band > 0.9) & (band < 1)] = 10
+        classes = classify(band)
 
-        plt.imshow(band, cmap='RdYlGn')
+        plt.imshow(np.ma.masked_equal(classes, NODATA_CLASS), cmap='RdYlGn')
         plt.colorbar()
         plt.show()
 
-        plt.imshow(band2, cmap='RdYlGn')
+        plt.imshow(band, cmap='RdYlGn')
         plt.colorbar()
         plt.show()
 
@@ -113,17 +145,75 @@ def plot_vegetation_indexes(
             False,
             help='Process landsat images.',
             metavar='landsat'
+        ),
+        workers: int = typer.Option(
+            1,
+            help='Number of processes used to decode and clip the bands.',
+            min=1
+        ),
+        fields_cache_dir: str = typer.Option(
+            None,
+            help='Directory used to cache the parsed shapefiles of the fields between runs.'
+        ),
+        index: List[str] = typer.Option(
+            None,
+            help='Vegetation index to calculate. Can be repeated. Defaults to all the indexes.'
+        ),
+        cache_dir: str = typer.Option(
+            None,
+            help='Directory used to cache the clipped field rasters between runs.'
+        ),
+        cache_size: int = typer.Option(
+            1024,
+            help='Size limit of the clipped rasters cache in MiB.'
+        ),
+        resampling: str = typer.Option(
+            None,
+            help='Resampling kernel (nearest, bilinear, cubic, average...) used to align '
+                 'the bands without a 10m file, for example B05 or B11.'
+        ),
+        min_clear_fraction: float = typer.Option(
+            None,
+            help='Mask the cloudy pixels with the L2A scene classification layer, and skip the '
+                 'fields with a lower fraction of clear pixels.',
+            min=0,
+            max=1
+        ),
+        output_dir: str = typer.Option(
+            None,
+            help='Write the plots as quicklook images to this directory, in a directory per product, '
+                 'instead of showing them. It does not need a display, so it can run on servers.'
+        ),
+        image_format: str = typer.Option(
+            'png',
+            help='Format of the quicklook images: png or webp.'
+        ),
+        decorations: bool = typer.Option(
+            False,
+            help='Draw the axes, title and colorbar in the quicklook images. Without them, '
+                 'the images have one pixel per raster pixel and are much faster to write.'
         )
 
 ):
     """Plot vegetation indexes."""
+    import numpy as np
+
+    from rasterio.enums import Resampling
+
+    from cache import ClippedRasterCache
+    from cloudmask import CloudMask
+    from plotter import IndexPlotter
+    from sdk import LandsatMSIManagerCreator, SentinelMSIManagerCreator, SentinelProcessingParams, Fields
 
     if sentinel:
-        fields = Fields(Path(fields_path))
+        fields = Fields(Path(fields_path), workers, Path(fields_cache_dir) if fields_cache_dir else None)
         filters = SentinelProcessingParams(
             data_path=Path(image_path),
             fields=fields,
-            resolution=10
+            resolution=10,
+            cache=ClippedRasterCache(Path(cache_dir), cache_size * 2 ** 20) if cache_dir else None,
+            resampling=Resampling[resampling] if resampling else None,
+            cloud_mask=CloudMask(min_clear_fraction=min_clear_fraction) if min_clear_fraction is not None else None
         )
         manager = SentinelMSIManagerCreator()
     elif landsat:
@@ -133,27 +223,219 @@ def plot_vegetation_indexes(
         manager = SentinelMSIManagerCreator()
         filters = None
 
-    fields = manager.get_fields(filters)
+    product_fields = manager.get_product_fields(filters, workers=workers, indexes=index or None)
+    fields = [
+        (product, field) for product, candidates in product_fields.items() for field in candidates
+        if field.bands is not None
+    ]
+
+    if output_dir is not None:
+        from rendering import Quicklook, RenderStyle, render_quicklooks
 
-    for field in fields:
-        for index_name, index_raster in field.get_all_indexes().items():
+        index_rasters = [
+            (product, field, index_name, index_raster)
+            for product, field in fields
+            for index_name, index_raster in field.get_all_indexes(index or None).items()
+        ]
+        for style in RenderStyle:
+            # The quicklooks of every product go to their own directory, like the exported indexes.
+            quicklooks = [
+                Quicklook(
+                    Path(output_dir) / product / field.geometry_hash / f'{index_name}_{style.value}.{image_format}',
+                    index_raster,
+                    f'{field.farm_name} {index_name}'.strip()
+                )
+                for product, field, index_name, index_raster in index_rasters
+            ]
+            for path in render_quicklooks(quicklooks, style, decorations=decorations, workers=workers):
+                typer.echo(path)
+        return
+
+    import matplotlib.pyplot as plt
+
+    for product, field in fields:
+        for index_name, index_raster in field.get_all_indexes(index or None).items():
             index_plotter = IndexPlotter(index_raster)
 
             ndvi_ax = index_plotter('ndvi_plot', ax=None, kws={'cmap': 'RdYlGn'})
             ndvi_ax.plot()
             ndvi_ax.set_title(index_name)
-            plt.suptitle(field.farm_name)
+            plt.suptitle(f'{field.farm_name} {product}'.strip())
             plt.show()
 
             p1 = 1
             p2 = 99
-            vmin, vmax = np.percentile(index_raster[0], (p1, p2))
+            vmin, vmax = np.nanpercentile(np.ma.filled(index_raster[0], np.nan), (p1, p2))
             heat_map_ax = index_plotter('heat_map', ax=None, kws={'cmap': 'RdYlGn', 'vmin': vmin, 'vmax': vmax})
             heat_map_ax.plot()
             heat_map_ax.set_title(f'Heatmap for {index_name}')
-            plt.suptitle(field.farm_name)
+            plt.suptitle(f'{field.farm_name} {product}'.strip())
             plt.show()
 
 
+@app.command()
+def export_indexes(
+        image_path: str = typer.Argument(
+            '.',
+            help='Path of the directory containing the satellite images.',
+            metavar='image_path'
+        ),
+        fields_path: str = typer.Argument(
+            '.',
+            help='Path of the directory containing the shapefiles of the desired fields.'
+        ),
+        output_dir: str = typer.Option(
+            '.',
+            help='Directory where the Cloud Optimized GeoTIFFs are written.'
+        ),
+        workers: int = typer.Option(
+            1,
+            help='Number of processes used to decode and clip the bands.',
+            min=1
+        ),
+        fields_cache_dir: str = typer.Option(
+            None,
+            help='Directory used to cache the parsed shapefiles of the fields between runs.'
+        ),
+        index: List[str] = typer.Option(
+            None,
+            help='Vegetation index to export. Can be repeated. Defaults to all the indexes.'
+        ),
+        mosaic: bool = typer.Option(
+            False,
+            help='Write a single mosaic per index instead of a file per field and index.'
+        ),
+        int16: bool = typer.Option(
+            False,
+            help='Store the indexes as scaled int16 values, halving the size of the files.'
+        )
+):
+    """Export the vegetation indexes of every field as Cloud Optimized GeoTIFFs."""
+    from export import IndexEncoding
+    from sdk import SentinelMSIManagerCreator, SentinelProcessingParams, Fields
+
+    filters = SentinelProcessingParams(
+        data_path=Path(image_path),
+        fields=Fields(Path(fields_path), workers, Path(fields_cache_dir) if fields_cache_dir else None),
+        resolution=10
+    )
+    paths = SentinelMSIManagerCreator().export_indexes(
+        filters,
+        Path(output_dir),
+        workers=workers,
+        indexes=index or None,
+        encoding=IndexEncoding.INT16 if int16 else IndexEncoding.FLOAT32,
+        mosaic=mosaic
+    )
+
+    for path in paths:
+        typer.echo(path)
+
+
+@app.command()
+def export_tile_indexes(
+        image_path: str = typer.Argument(
+            '.',
+            help='Path of the directory containing the satellite images.',
+            metavar='image_path'
+        ),
+        output_dir: str = typer.Option(
+            '.',
+            help='Directory where the Cloud Optimized GeoTIFFs are written.'
+        ),
+        resolution: int = typer.Option(
+            10,
+            help='The bands resolution in meters.'
+        ),
+        index: List[str] = typer.Option(
+            None,
+            help='Vegetation index to export. Can be repeated. Defaults to all the indexes.'
+        ),
+        chunk_size: int = typer.Option(
+            1024,
+            help='Side in pixels of the windows processed at once. Bounds the memory used.',
+            min=1
+        ),
+        int16: bool = typer.Option(
+            False,
+            help='Store the indexes as scaled int16 values, halving the size of the files.'
+        )
+):
+    """Export the vegetation indexes of full product tiles, processing them chunk by chunk."""
+    from export import IndexEncoding, export_tile_indexes as export
+
+    paths = export(
+        Path(image_path),
+        resolution,
+        Path(output_dir),
+        indexes=index or None,
+        encoding=IndexEncoding.INT16 if int16 else IndexEncoding.FLOAT32,
+        chunk_size=chunk_size
+    )
+
+    for product_paths in paths.values():
+        for path in product_paths:
+            typer.echo(path)
+
+
+@app.command()
+def zonal_statistics(
+        image_path: str = typer.Argument(
+            '.',
+            help='Path of the directory containing the satellite images.',
+            metavar='image_path'
+        ),
+        fields_path: str = typer.Argument(
+            '.',
+            help='Path of the directory containing the shapefiles of the desired fields.'
+        ),
+        index: List[str] = typer.Option(
+            None,
+            help='Vegetation index to summarize. Can be repeated. Defaults to all the indexes.'
+        ),
+        percentile: List[float] = typer.Option(
+            [10, 25, 75, 90],
+            help='Percentile to calculate besides the median. Can be repeated.'
+        ),
+        workers: int = typer.Option(
+            1,
+            help='Number of processes used to read the shapefiles of the fields.',
+            min=1
+        ),
+        fields_cache_dir: str = typer.Option(
+            None,
+            help='Directory used to cache the parsed shapefiles of the fields between runs.'
+        ),
+        output: str = typer.Option(
+            None,
+            help='Path of a csv file where the statistics are written. Printed if not given.'
+        ),
+        resampling: str = typer.Option(
+            None,
+            help='Resampling kernel (nearest, bilinear, cubic, average...) used to align '
+                 'the bands without a 10m file, for example B05 or B11.'
+        )
+):
+    """Get the statistics of the vegetation indexes of every field."""
+    from rasterio.enums import Resampling
+
+    from sdk import SentinelMSIManagerCreator, SentinelProcessingParams, Fields
+
+    filters = SentinelProcessingParams(
+        data_path=Path(image_path),
+        fields=Fields(Path(fields_path), workers, Path(fields_cache_dir) if fields_cache_dir else None),
+        resolution=10,
+        resampling=Resampling[resampling] if resampling else None
+    )
+    statistics = SentinelMSIManagerCreator().get_zonal_statistics(
+        filters, indexes=index or None, percentiles=percentile
+    )
+
+    if output is None:
+        typer.echo(statistics.to_string(index=False))
+    else:
+        statistics.to_csv(output, index=False)
+
+
 if __name__ == '__main__':
     app()
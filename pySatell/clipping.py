@@ -0,0 +1,466 @@
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from fnmatch import fnmatch
+from itertools import repeat
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple, Union
+
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.io import DatasetReader
+from rasterio.mask import mask
+from rasterio.vrt import WarpedVRT
+
+import numpy as np
+import rasterio
+import zipfile
+
+from cache import ClippedRasterCache
+from models import Band, BandNumber, geometry_hash
+
+
+class ReaderMode(Enum):
+    """Enum used to represent how the field rasters are read from a band file.
+
+    MASK uses rasterio.mask.mask on the full resolution band file. WINDOW
+    reads only the pixel window of the field bounds, from the JP2 resolution
+    level matching the requested resolution when there is one, and
+    rasterizes the field polygon locally.
+    """
+    MASK = 'mask'
+    WINDOW = 'window'
+
+
+def _band_resolution(image: Union[Path, str]) -> int:
+    """Returns the resolution in meters encoded in a band file name."""
+    return int(Path(image).stem.split('_')[-1][:-len('m')])
+
+
+def product_id(image: Union[Path, str]) -> str:
+    """Returns the name of the SAFE product containing a band file.
+
+    Band files outside a SAFE directory are identified by their own name
+    without the band and resolution suffix.
+    """
+    image = Path(image)
+
+    for parent in image.parents:
+        if parent.suffix == '.SAFE':
+            return parent.stem
+
+    return '_'.join(image.name.split('_')[:-2])
+
+
+def get_product_paths(data_path: Path, zipped: bool = False) -> Dict[str, Path]:
+    """Get the sentinel2 products located in a directory.
+
+    Args:
+        data_path (Path): Path object where the sentinel2 products
+            are located.
+        zipped (bool): Also include the zipped products. When a product is
+            both zipped and extracted, the extracted directory is returned.
+
+    Returns:
+        A dict with the product name as the key and the SAFE directory
+            (or zip file) as the value, sorted by product name.
+    """
+    product_paths = {}
+
+    if zipped:
+        for zip_path in data_path.glob('**/*.zip'):
+            product_paths[zip_path.stem.replace('.SAFE', '')] = zip_path
+
+    for safe_path in data_path.glob('**/*.SAFE'):
+        product_paths[safe_path.stem] = safe_path
+
+    return dict(sorted(product_paths.items()))
+
+
+def get_zipped_band_paths(data_path: Path, pattern: str = '*B*_*m.jp2') -> List[str]:
+    """Get the band files inside the zipped products of a directory.
+
+    The bands are returned as GDAL /vsizip/ paths, so they can be read
+    directly from the zip files without extracting them.
+
+    Args:
+        data_path (Path): Path object where the zipped sentinel2
+            products are located, or the path of a single zipped product.
+        pattern (str): The glob pattern of the file names.
+
+    Returns:
+        A list with the /vsizip/ path of every band file.
+    """
+    band_paths = []
+    zip_paths = [data_path] if data_path.suffix == '.zip' else data_path.glob('**/*.zip')
+
+    for zip_path in zip_paths:
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            for name in zip_ref.namelist():
+                if 'IMG_DATA' in name and fnmatch(name.split('/')[-1], pattern):
+                    band_paths.append(f'/vsizip/{zip_path.resolve()}/{name}')
+
+    return band_paths
+
+
+def get_band_paths(
+        data_path: Path,
+        resolution: int,
+        bands: Iterable[str] = None,
+        allow_finer: bool = False,
+        zipped: bool = False,
+        any_resolution: bool = False
+) -> Dict[str, Union[Path, str]]:
+    """Get the band files for a particular resolution.
+
+    Args:
+        data_path (Path): Path object where the sentinel2
+            bands information is located.
+        resolution (int): The bands resolution in meters.
+            It can be 10, 20 or 60.
+        bands (Iterable[str]): The names of the desired bands.
+            Defaults to all the bands found.
+        allow_finer (bool): When a band has no file at the desired
+            resolution, use a finer one that can be decimated to it
+            by a power of two (for example, B08 at 10m for 20m).
+        zipped (bool): Also look for the bands inside the zipped products,
+            returning them as /vsizip/ paths.
+        any_resolution (bool): When a band has no file at the desired
+            resolution (nor a finer one allowed), use the file with the
+            closest resolution, so it can be resampled.
+
+    Returns:
+        A dict with the band name as the key and the band file path
+            as the value.
+    """
+    band_paths = {}
+    bands = None if bands is None else set(bands)
+    # Extracted files come last, so they are preferred over zipped ones.
+    images = get_zipped_band_paths(data_path) if zipped else []
+    if data_path.is_dir():
+        images += data_path.glob('**/*B*_*m.jp2')
+    # The glob also matches the TCI, AOT, WVP and SCL files of tiles with a B in their name.
+    images = [image for image in images if str(image).split('_')[-2] in BandNumber.__members__]
+
+    for image in images:
+        band = str(image).split('_')[-2]
+        if _band_resolution(image) == resolution and (bands is None or band in bands):
+            band_paths[band] = image
+
+    if allow_finer:
+        for image in sorted(images, key=_band_resolution, reverse=True):
+            band = str(image).split('_')[-2]
+            factor = resolution / _band_resolution(image)
+            if (
+                    band not in band_paths
+                    and (bands is None or band in bands)
+                    and factor > 1 and factor.is_integer() and int(factor) & (int(factor) - 1) == 0
+            ):
+                band_paths[band] = image
+
+    if any_resolution:
+        for image in sorted(images, key=lambda image: abs(_band_resolution(image) - resolution)):
+            band = str(image).split('_')[-2]
+            if band not in band_paths and (bands is None or band in bands):
+                band_paths[band] = image
+
+    return band_paths
+
+
+class ResampledBand(WarpedVRT):
+    """A band file read on the grid of a coarser resolution, closing the file with it."""
+
+    def close(self):
+        super().close()
+        self.src_dataset.close()
+
+
+def open_band(
+        image: Union[Path, str],
+        resolution: int = None,
+        resampling: Resampling = Resampling.average
+) -> Union[DatasetReader, WarpedVRT]:
+    """Open a band file at the JP2 resolution level of a resolution.
+
+    JPEG2000 files store reduced resolution levels that GDAL exposes as
+    overviews, so a coarser resolution can be read without decoding the
+    full resolution pixels. When the file has no level for the resolution
+    (a GeoTIFF without overviews, or a factor that is not a power of two),
+    it is resampled on the fly to the grid of the resolution, over the
+    windows read only.
+
+    Args:
+        image (Union[Path, str]): Path of the band file.
+        resolution (int): The desired resolution in meters. Defaults to
+            the native resolution of the file.
+        resampling (Resampling): The kernel used when there is no
+            resolution level for the resolution.
+
+    Returns:
+        The opened dataset, with pixels of the desired resolution if it is
+            coarser than the native one.
+    """
+    dataset = rasterio.open(image)
+
+    if resolution is not None:
+        factor = resolution / dataset.res[0]
+        overviews = dataset.overviews(1)
+        if factor > 1 and factor.is_integer() and int(factor) in overviews:
+            dataset.close()
+            dataset = rasterio.open(image, overview_level=overviews.index(int(factor)))
+        elif factor > 1:
+            left, bottom, right, top = dataset.bounds
+            dataset = ResampledBand(
+                dataset,
+                crs=dataset.crs,
+                transform=Affine(resolution, 0, left, 0, -resolution, top),
+                width=max(int(round((right - left) / resolution)), 1),
+                height=max(int(round((top - bottom) / resolution)), 1),
+                resampling=resampling
+            )
+
+    return dataset
+
+
+def read_window(dataset: DatasetReader, geometry: dict) -> np.ma.MaskedArray:
+    """Read the pixels of a geometry from a dataset.
+
+    Only the window covering the geometry bounds is read, and the pixels
+    outside the geometry are masked and filled with the dataset nodata
+    (or 0), like rasterio.mask.mask does with crop=True.
+
+    Args:
+        dataset (DatasetReader): The opened band file.
+        geometry (dict): The geojson like geometry of the field.
+
+    Returns:
+        The clipped masked raster with shape (count, height, width).
+    """
+    window = geometry_window(dataset, [geometry])
+    raster = dataset.read(window=window, masked=True)
+    outside = geometry_mask(
+        [geometry], out_shape=raster.shape[-2:], transform=dataset.window_transform(window)
+    )
+    invalid = np.ma.getmaskarray(raster) | outside
+
+    return np.ma.masked_array(raster.filled(dataset.nodata or 0), mask=invalid)
+
+
+def mask_field(dataset: DatasetReader, geometry: dict) -> np.ma.MaskedArray:
+    """Clip a geometry from a dataset with rasterio.mask.mask.
+
+    Returns:
+        The clipped masked raster, filled with the dataset nodata (or 0)
+            in the pixels outside the geometry or without data.
+    """
+    raster, _ = mask(dataset, [geometry], crop=True, filled=False)
+    return np.ma.masked_array(raster.filled(dataset.nodata or 0), mask=np.ma.getmaskarray(raster))
+
+
+def clip_band(
+        image: Union[Path, str],
+        geometries: List[dict],
+        reader: ReaderMode = ReaderMode.MASK,
+        resolution: int = None
+) -> List[np.ma.MaskedArray]:
+    """Clip a band file using a list of geometries.
+
+    The band file is opened (and its header decoded) only once, and every
+    geometry window is read from that same dataset.
+
+    Args:
+        image (Union[Path, str]): Path of the band file.
+        geometries (List[dict]): The geojson like geometries used to
+            clip the band.
+        reader (ReaderMode): How the field rasters are read.
+        resolution (int): The desired resolution in meters, used by the
+            WINDOW reader to pick the JP2 resolution level.
+
+    Returns:
+        A list with the clipped masked rasters, in the same order as the
+            geometries. The mask tells the pixels outside the geometry or
+            without data.
+    """
+    if reader is ReaderMode.WINDOW:
+        with open_band(image, resolution) as dataset:
+            return [read_window(dataset, geometry) for geometry in geometries]
+
+    with rasterio.open(image) as dataset:
+        return [mask_field(dataset, geometry) for geometry in geometries]
+
+
+def get_field_transforms(
+        image: Union[Path, str],
+        geometries: List[dict],
+        reader: ReaderMode = ReaderMode.MASK,
+        resolution: int = None
+) -> Tuple[List[Affine], CRS]:
+    """Get the georeferencing of the rasters clipped from a band file.
+
+    Only the band header is read, so the georeferencing is also available
+    for rasters loaded from a cache.
+
+    Args:
+        image (Union[Path, str]): Path of the band file.
+        geometries (List[dict]): The geojson like geometries used to
+            clip the band.
+        reader (ReaderMode): How the field rasters are read.
+        resolution (int): The desired resolution in meters, used by the
+            WINDOW reader to pick the JP2 resolution level.
+
+    Returns:
+        The transform of every clipped raster, in the same order as the
+            geometries, and the crs of the band.
+    """
+    dataset = open_band(image, resolution) if reader is ReaderMode.WINDOW else rasterio.open(image)
+
+    with dataset:
+        transforms = [dataset.window_transform(geometry_window(dataset, [geometry])) for geometry in geometries]
+        return transforms, dataset.crs
+
+
+def _chunks(items: list, chunks: int) -> List[list]:
+    """Split a list in (at most) the desired number of contiguous chunks."""
+    size = -(-len(items) // max(chunks, 1)) or 1
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def clip_fields(
+        data_path: Path,
+        resolution: int,
+        geometries: List[dict],
+        workers: int = 1,
+        bands: Iterable[str] = None,
+        reader: ReaderMode = ReaderMode.MASK,
+        cache: ClippedRasterCache = None,
+        zipped: bool = False,
+        resampling: Resampling = None,
+        aligned_directory: Path = None
+) -> List[Dict[str, Band]]:
+    """Clip all the bands of a resolution for every field in one pass.
+
+    When more than one worker is requested, the band decoding and the
+    clipping are spread across a process pool. Each work unit is a band
+    file together with a contiguous chunk of the geometries, so the
+    results are always returned in the same order as the geometries.
+
+    When a cache is given, the clipped rasters are looked up by product,
+    band, resolution and geometry before decoding anything, and only the
+    missing ones are clipped (and stored).
+
+    When a resampling kernel is given, the bands without a file at the
+    resolution are taken from another resolution and aligned to the
+    resolution grid, once per tile, so all the bands of a field share the
+    same shape.
+
+    Args:
+        data_path (Path): Path object where the sentinel2
+            bands information is located.
+        resolution (int): The bands resolution in meters.
+            It can be 10, 20 or 60.
+        geometries (List[dict]): The geojson like geometries of the fields.
+        workers (int): Number of processes used to clip the bands.
+        bands (Iterable[str]): The names of the bands to clip.
+            Defaults to all the bands found.
+        reader (ReaderMode): How the field rasters are read. The WINDOW
+            reader can also use finer band files decimated to the
+            resolution.
+        cache (ClippedRasterCache): Optional on disk cache of the
+            clipped rasters.
+        zipped (bool): Also read the bands directly from the zipped
+            products, without extracting them.
+        resampling (Resampling): Optional kernel used to align the bands
+            of other resolutions.
+        aligned_directory (Path): Directory where the aligned bands are
+            stored. Defaults to an `aligned` directory next to the products.
+
+    Returns:
+        A list with one dict per geometry, with the band name as the key
+            and the clipped Band as the value.
+    """
+    fields_bands = [{} for _ in geometries]
+    band_paths = get_band_paths(
+        data_path,
+        resolution,
+        bands,
+        allow_finer=reader is ReaderMode.WINDOW,
+        zipped=zipped,
+        any_resolution=resampling is not None
+    )
+    source_bands = {band: band for band in band_paths}
+
+    if resampling is not None:
+        # Imported here because the alignment builds on the clipping helpers.
+        from alignment import align_band_paths, default_aligned_directory
+
+        aligned_paths = align_band_paths(
+            band_paths,
+            resolution,
+            resampling,
+            aligned_directory or default_aligned_directory(data_path),
+            workers=workers,
+            decimate=reader is ReaderMode.WINDOW
+        )
+        for band, image in aligned_paths.items():
+            if image != band_paths[band]:
+                # The kernel is part of the cache key of the resampled bands.
+                source_bands[band] = f'{band}_{resampling.name}'
+        band_paths = aligned_paths
+
+    clipped_bands = {band: [None] * len(geometries) for band in band_paths}
+    keys = {}
+
+    if cache is not None:
+        hashes = [geometry_hash(geometry) for geometry in geometries]
+        for band, image in band_paths.items():
+            for position, hash_ in enumerate(hashes):
+                keys[band, position] = cache.key(
+                    product_id(image), source_bands[band], resolution, hash_, reader.value
+                )
+                clipped_bands[band][position] = cache.get(keys[band, position])
+
+    units = [
+        (band, chunk)
+        for band, rasters in clipped_bands.items()
+        for chunk in _chunks(
+            [position for position, raster in enumerate(rasters) if raster is None],
+            -(-workers // len(band_paths))
+        )
+    ]
+    arguments = (
+        [band_paths[band] for band, _ in units],
+        [[geometries[position] for position in chunk] for _, chunk in units],
+        repeat(reader),
+        repeat(resolution)
+    )
+
+    if workers > 1 and len(units) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(clip_band, *arguments))
+    else:
+        results = map(clip_band, *arguments)
+
+    for (band, chunk), rasters in zip(units, results):
+        for position, raster in zip(chunk, rasters):
+            clipped_bands[band][position] = raster
+            if cache is not None:
+                cache.put(keys[band, position], raster)
+
+    # All the bands are aligned to the same grid, so any of them georeferences the fields.
+    transforms, crs = get_field_transforms(
+        next(iter(band_paths.values())), geometries, reader, resolution
+    ) if band_paths else ([], None)
+
+    for band, clipped_rasters in clipped_bands.items():
+        for field_bands, clipped_band, transform in zip(fields_bands, clipped_rasters, transforms):
+            field_bands[band] = Band(
+                BandNumber(band),
+                resolution,
+                np.ma.getdata(clipped_band),
+                ~np.ma.getmaskarray(clipped_band),
+                transform,
+                crs
+            )
+
+    return fields_bands
@@ -0,0 +1,135 @@
+from dataclasses import dataclass
+from enum import IntEnum
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+
+from numpy import ndarray
+from rasterio.enums import Resampling
+
+import numpy as np
+
+from alignment import align_band, default_aligned_directory
+from clipping import ReaderMode, _band_resolution, clip_band, get_zipped_band_paths
+
+
+class SceneClass(IntEnum):
+    """Enum used to represent the classes of the L2A Scene Classification layer (SCL)."""
+    NO_DATA = 0
+    SATURATED_OR_DEFECTIVE = 1
+    DARK_AREA_PIXELS = 2
+    CLOUD_SHADOWS = 3
+    VEGETATION = 4
+    NOT_VEGETATED = 5
+    WATER = 6
+    UNCLASSIFIED = 7
+    CLOUD_MEDIUM_PROBABILITY = 8
+    CLOUD_HIGH_PROBABILITY = 9
+    THIN_CIRRUS = 10
+    SNOW = 11
+
+
+DEFAULT_INVALID_CLASSES = (
+    SceneClass.NO_DATA,
+    SceneClass.SATURATED_OR_DEFECTIVE,
+    SceneClass.CLOUD_SHADOWS,
+    SceneClass.CLOUD_MEDIUM_PROBABILITY,
+    SceneClass.CLOUD_HIGH_PROBABILITY,
+    SceneClass.THIN_CIRRUS,
+)
+
+
+@dataclass
+class CloudMask:
+    """Describes how the Scene Classification layer masks the field pixels.
+
+    Attributes:
+        invalid_classes (Tuple[int, ...]): The scene classes treated as not
+            valid. Defaults to no data, saturated, cloud shadows, clouds and
+            thin cirrus.
+        min_clear_fraction (float): Fields with a lower fraction of clear
+            pixels (among the pixels of the field with data) are skipped.
+    """
+    invalid_classes: Tuple[int, ...] = DEFAULT_INVALID_CLASSES
+    min_clear_fraction: float = 0.0
+
+    def clear(self, scl: ndarray) -> ndarray:
+        """Returns the clear pixels of a clipped (and optionally masked) SCL raster."""
+        return ~np.isin(np.ma.getdata(scl), self.invalid_classes) & ~np.ma.getmaskarray(scl)
+
+    @staticmethod
+    def clear_fraction(scl: ndarray, clear: ndarray) -> float:
+        """Returns the fraction of clear pixels among the pixels with data."""
+        observed = np.count_nonzero(~np.ma.getmaskarray(scl) & (np.ma.getdata(scl) != SceneClass.NO_DATA))
+        return np.count_nonzero(clear) / observed if observed else 0.0
+
+
+def get_scl_path(data_path: Path, zipped: bool = False) -> Optional[Union[Path, str]]:
+    """Get the finest Scene Classification layer file of a product.
+
+    Args:
+        data_path (Path): Path object where the sentinel2 product is located.
+        zipped (bool): Also look inside the zipped products.
+
+    Returns:
+        The path of the SCL file, or None if the product has none (as the
+            L1C products).
+    """
+    images = get_zipped_band_paths(data_path, '*_SCL_*m.jp2') if zipped else []
+    if data_path.is_dir():
+        images += data_path.glob('**/*_SCL_*m.jp2')
+
+    return min(images, key=_band_resolution, default=None)
+
+
+def get_clear_masks(
+        data_path: Path,
+        resolution: int,
+        geometries: List[dict],
+        cloud_mask: CloudMask,
+        reader: ReaderMode = ReaderMode.MASK,
+        zipped: bool = False,
+        aligned_directory: Path = None
+) -> List[Optional[ndarray]]:
+    """Get the clear pixels of every field from the Scene Classification layer.
+
+    The SCL file is upsampled once per tile to the grid of the resolution,
+    with the nearest kernel since it is categorical, and clipped like the
+    bands, so the masks have the same shape as the clipped bands.
+
+    Args:
+        data_path (Path): Path object where the sentinel2
+            product is located.
+        resolution (int): The bands resolution in meters.
+        geometries (List[dict]): The geojson like geometries of the fields.
+        cloud_mask (CloudMask): The classes to mask and the minimum clear
+            fraction.
+        reader (ReaderMode): How the field rasters are read.
+        zipped (bool): Also look for the SCL file inside the zipped products.
+        aligned_directory (Path): Directory where the upsampled SCL file is
+            stored. Defaults to an `aligned` directory next to the products.
+
+    Raises:
+        FileNotFoundError if the product has no SCL file.
+
+    Returns:
+        A list with a (1, H, W) boolean array of the clear pixels of every
+            field, in the same order as the geometries, or None for the
+            fields under the minimum clear fraction.
+    """
+    image = get_scl_path(data_path, zipped)
+    if image is None:
+        raise FileNotFoundError(f'No scene classification layer found in {data_path}')
+
+    if _band_resolution(image) != resolution:
+        image = align_band(
+            image, resolution, Resampling.nearest, aligned_directory or default_aligned_directory(data_path)
+        )
+
+    clear_masks = []
+    for scl in clip_band(image, geometries, reader, resolution):
+        clear = cloud_mask.clear(scl)
+        if cloud_mask.clear_fraction(scl, clear) < cloud_mask.min_clear_fraction:
+            clear = None
+        clear_masks.append(clear)
+
+    return clear_masks
@@ -1,8 +1,28 @@
-from sentinelsat import SentinelAPI
+from functools import lru_cache
 
+from data.config import DEFAULT_SENTINEL_API_URL, read_config
 
-API_USER = "****"
-API_PASSWORD = "****"
-SENTINEL_API_URL = 'https://apihub.copernicus.eu/apihub'
 
-sentinel_api = SentinelAPI(API_USER, API_PASSWORD, SENTINEL_API_URL)
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_sentinel_api():
+    """Returns the SentinelAPI client, creating it on the first call.
+
+    The credentials and the url are read from the config.ini file, so
+    importing this package does not import sentinelsat nor set up any
+    network client.
+    """
+    from sentinelsat import SentinelAPI
+
+    config = read_config()
+    return SentinelAPI(
+        config.get('API_USER'),
+        config.get('API_PASSWORD'),
+        config.get('API_URL', DEFAULT_SENTINEL_API_URL)
+    )
+
+
+def __getattr__(name):
+    # Keeps `from data import sentinel_api` working, creating the client lazily.
+    if name == 'sentinel_api':
+        return get_sentinel_api()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -1,2 +1,30 @@
+from configparser import ConfigParser
+from pathlib import Path
+from typing import Dict
 
+import os
 
+
+CONFIG_PATH = Path(os.environ.get('PYSATELL_CONFIG', Path(__file__).resolve().parents[2] / 'config.ini'))
+DEFAULT_SENTINEL_API_URL = 'https://apihub.copernicus.eu/apihub'
+
+
+def read_config(path: Path = CONFIG_PATH, section: str = 'SENTINEL') -> Dict[str, str]:
+    """Read a section of the config.ini file.
+
+    Args:
+        path (Path): Path of the config file. Defaults to the config.ini of
+            the repository, or the PYSATELL_CONFIG environment variable.
+        section (str): The section to read.
+
+    Returns:
+        A dict with the options of the section, without surrounding quotes.
+            It is empty if the file or the section do not exist.
+    """
+    parser = ConfigParser()
+    parser.read(path)
+
+    if not parser.has_section(section):
+        return {}
+
+    return {key.upper(): value.strip('\'"') for key, value in parser.items(section)}
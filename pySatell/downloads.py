@@ -0,0 +1,276 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+import hashlib
+import time
+
+import requests
+
+
+# The client errors that are not solved by retrying (timeouts and throttling are).
+RETRYABLE_CLIENT_ERRORS = (408, 429)
+
+
+class ChecksumError(Exception):
+    pass
+
+
+@dataclass
+class ProductDownload:
+    """Encapsulates the information needed to download a product.
+
+    Attributes:
+        id (str): The product id.
+        title (str): The product title, used as the file name.
+        url (str): The url of the product zip file.
+        md5 (str): The expected md5 checksum of the zip file, if known.
+        size (int): The expected size in bytes of the zip file, if known.
+    """
+    id: str
+    title: str
+    url: str
+    md5: str = None
+    size: int = None
+
+    @classmethod
+    def from_odata(cls, odata: dict) -> 'ProductDownload':
+        """Creates a ProductDownload from the output of SentinelAPI.get_product_odata."""
+        return cls(
+            id=odata['id'],
+            title=odata['title'],
+            url=odata['url'],
+            md5=odata.get('md5'),
+            size=odata.get('size')
+        )
+
+
+@dataclass
+class DownloadResult:
+    """The outcome of a product download.
+
+    Attributes:
+        product (ProductDownload): The downloaded product.
+        path (Path): Path of the downloaded zip file.
+        downloaded_bytes (int): Number of bytes transferred in this run.
+        elapsed (float): Seconds spent transferring, without the waits
+            between attempts.
+        skipped (bool): True if the product was already on disk.
+        error (Exception): The error of the last attempt if the product
+            could not be downloaded, in which case the path does not exist.
+    """
+    product: ProductDownload
+    path: Path
+    downloaded_bytes: int = 0
+    elapsed: float = 0.0
+    skipped: bool = False
+    error: Exception = None
+
+    @property
+    def failed(self) -> bool:
+        """Returns True if the product could not be downloaded."""
+        return self.error is not None
+
+    @property
+    def throughput(self) -> float:
+        """Returns the download throughput in bytes per second."""
+        return self.downloaded_bytes / self.elapsed if self.elapsed else 0.0
+
+
+def is_retryable(error: Exception) -> bool:
+    """Returns True unless the error is a client error response, like 401, 403 or 404."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True
+    return not 400 <= response.status_code < 500 or response.status_code in RETRYABLE_CLIENT_ERRORS
+
+
+def md5sum(path: Path, chunk_size: int = 2 ** 20) -> str:
+    """Returns the md5 hex digest of a file."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadScheduler:
+    """Downloads products concurrently, resuming partial files.
+
+    Products are downloaded to `<directory>/<title>.zip` through a
+    `<title>.zip.incomplete` file, which is resumed with an HTTP range request
+    when a previous run was interrupted. Failed downloads are retried with an
+    exponential backoff, except for the client errors (like 401, 403 or 404)
+    that fail at once, and products already present on disk (and matching
+    their checksum) are skipped. Since the scheduler only needs an http
+    session and the product urls, it can run against any http server.
+
+    Args:
+        session (requests.Session): Session used for the requests, for
+            example SentinelAPI.session, which holds the credentials.
+        directory (Path): Directory where the products are downloaded.
+        max_concurrent (int): Maximum number of simultaneous downloads.
+        max_attempts (int): Maximum number of attempts for every product.
+        backoff (float): Seconds waited after the first failed attempt,
+            doubled after every new failure.
+        chunk_size (int): Bytes read from the response at once.
+        progress (Callable[[ProductDownload, int, int], None]): Optional
+            callback called with the product, the bytes on disk and the
+            expected total bytes (or None) while downloading.
+    """
+
+    def __init__(
+            self,
+            session: requests.Session,
+            directory: Path,
+            max_concurrent: int = 4,
+            max_attempts: int = 5,
+            backoff: float = 2.0,
+            chunk_size: int = 2 ** 20,
+            progress: Callable[[ProductDownload, int, int], None] = None
+    ):
+        self.session = session
+        self.directory = Path(directory)
+        self.max_concurrent = max_concurrent
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+    def is_downloaded(self, product: ProductDownload) -> bool:
+        """Returns True if the product zip file is complete on disk.
+
+        The checksum of a verified file is stored next to it, so it is only
+        calculated once.
+        """
+        path = self.directory / f'{product.title}.zip'
+        if not path.exists():
+            return False
+        if product.size is not None and path.stat().st_size != product.size:
+            return False
+        if product.md5 is None:
+            return True
+
+        checksum_path = path.with_name(f'{path.name}.md5')
+        if checksum_path.exists() and checksum_path.read_text().strip().lower() == product.md5.lower():
+            return True
+
+        if md5sum(path) == product.md5.lower():
+            checksum_path.write_text(product.md5.lower())
+            return True
+
+        return False
+
+    def _transfer(self, product: ProductDownload, partial_path: Path) -> int:
+        """Download (or resume) a product into its partial file.
+
+        Returns:
+            The number of bytes transferred.
+        """
+        offset = partial_path.stat().st_size if partial_path.exists() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        transferred = 0
+
+        with self.session.get(product.url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 416:
+                return 0
+            response.raise_for_status()
+
+            # The server ignored the range request, so start over.
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            offset = offset if mode == 'ab' else 0
+            total = product.size
+            if total is None and 'Content-Length' in response.headers:
+                total = offset + int(response.headers['Content-Length'])
+
+            with open(partial_path, mode) as file:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    file.write(chunk)
+                    transferred += len(chunk)
+                    if self.progress is not None:
+                        self.progress(product, offset + transferred, total)
+
+        return transferred
+
+    def download(self, product: ProductDownload) -> DownloadResult:
+        """Download a single product.
+
+        Raises:
+            requests.RequestException or ChecksumError if the product could
+                not be downloaded after all the attempts, or at once for the
+                client errors.
+
+        Returns:
+            A DownloadResult with the path and the transfer statistics.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f'{product.title}.zip'
+
+        if self.is_downloaded(product):
+            return DownloadResult(product, path, skipped=True)
+
+        partial_path = path.with_name(f'{path.name}.incomplete')
+        downloaded_bytes = 0
+        elapsed = 0.0
+
+        for attempt in range(self.max_attempts):
+            try:
+                start = time.perf_counter()
+                try:
+                    downloaded_bytes += self._transfer(product, partial_path)
+                finally:
+                    elapsed += time.perf_counter() - start
+
+                if product.md5 is not None and md5sum(partial_path) != product.md5.lower():
+                    partial_path.unlink()
+                    raise ChecksumError(f'Checksum mismatch for {product.title}')
+
+                partial_path.replace(path)
+                if product.md5 is not None:
+                    path.with_name(f'{path.name}.md5').write_text(product.md5.lower())
+
+                return DownloadResult(product, path, downloaded_bytes, elapsed)
+            except (requests.RequestException, ChecksumError) as error:
+                if attempt == self.max_attempts - 1 or not is_retryable(error):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def download_all(self, products: Iterable[ProductDownload]) -> List[DownloadResult]:
+        """Download several products with a bounded concurrency.
+
+        A failed product does not stop the others: its result carries the
+        error instead.
+
+        Returns:
+            The DownloadResult of every product, in the same order as the
+                products.
+        """
+        products = list(products)
+        results: List[DownloadResult] = [None] * len(products)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            futures = {executor.submit(self.download, product): position for position, product in enumerate(products)}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    results[position] = future.result()
+                except (requests.RequestException, ChecksumError, OSError) as error:
+                    product = products[position]
+                    results[position] = DownloadResult(product, self.directory / f'{product.title}.zip', error=error)
+
+        return results
+
+
+def get_products_downloads(api, products: Iterable[str]) -> List[ProductDownload]:
+    """Get the download information of the products returned by a SentinelAPI query.
+
+    Args:
+        api (SentinelAPI): The client used to query the products.
+        products (Iterable[str]): The ids of the products, for example the
+            dict returned by SentinelAPI.query.
+
+    Returns:
+        A list with a ProductDownload for every product.
+    """
+    return [ProductDownload.from_odata(api.get_product_odata(product_id)) for product_id in products]
@@ -0,0 +1,426 @@
+from contextlib import ExitStack
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from affine import Affine
+from numpy import ndarray
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.windows import Window
+
+import os
+import numpy as np
+import rasterio
+import rasterio.shutil
+
+from alignment import align_band_paths, default_aligned_directory
+from clipping import get_band_paths, get_product_paths
+from indexes import compute_indexes
+from models import Band, BandNumber, Bands, FieldData, get_index_definitions, get_required_bands
+
+
+INT16_SCALE = 1e-4
+INT16_NODATA = -32768
+# The ratio indexes without a -1 to 1 range (their denominator can approach
+# 0) are stored with a coarser scale, covering -32.767 to 32.767.
+INT16_SCALES = {'evi': 1e-3, 'gci': 1e-3, 'sipi': 1e-3}
+
+
+class IndexEncoding(Enum):
+    """Enum used to represent how the index values are stored in the exported rasters.
+
+    FLOAT32 stores the values as they are, with NaN as nodata. INT16 stores
+    them scaled by the scale of the index (see int16_scale) with
+    INT16_NODATA as nodata, halving the size of the files. The values out of
+    the range of the scale are clipped to it. The scale is written in the
+    file metadata, so GIS software reads the original values.
+    """
+    FLOAT32 = 'float32'
+    INT16 = 'int16'
+
+
+def int16_scale(index: str = None) -> float:
+    """Returns the INT16 scale of an index: 1e-4 (-3.2767 to 3.2767) unless it is in INT16_SCALES."""
+    return INT16_SCALES.get(index, INT16_SCALE)
+
+
+def encode_index(
+        raster: ndarray,
+        encoding: IndexEncoding = IndexEncoding.FLOAT32,
+        scale: float = INT16_SCALE
+) -> ndarray:
+    """Convert an index raster, with NaN (or masked pixels) as nodata, to an encoding.
+
+    The INT16 values are the index values divided by the scale, clipped to
+    the int16 range.
+    """
+    raster = np.ma.filled(raster, np.nan) if np.ma.isMaskedArray(raster) else raster
+
+    if encoding is IndexEncoding.FLOAT32:
+        return raster.astype(np.float32, copy=False)
+
+    scaled = np.round(raster / scale)
+    np.clip(scaled, -32767, 32767, out=scaled)
+    return np.where(np.isnan(scaled), INT16_NODATA, scaled).astype(np.int16)
+
+
+def _profile(encoding: IndexEncoding, width: int, height: int, transform: Affine, crs: CRS) -> dict:
+    return {
+        'driver': 'GTiff',
+        'dtype': encoding.value,
+        'nodata': np.nan if encoding is IndexEncoding.FLOAT32 else INT16_NODATA,
+        'count': 1,
+        'width': width,
+        'height': height,
+        'transform': transform,
+        'crs': crs,
+        'tiled': True,
+        'blockxsize': 512,
+        'blockysize': 512,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER',
+    }
+
+
+def _partial_path(path: Path) -> Path:
+    return path.with_name(f'{path.stem}.{os.getpid()}.partial.tif')
+
+
+def _to_cog(partial_path: Path, path: Path) -> None:
+    """Convert a tiled GeoTIFF into a Cloud Optimized GeoTIFF with overviews.
+
+    GDAL builds the overviews and the COG layout reading the source block
+    by block, so the whole raster is never loaded in memory.
+    """
+    rasterio.shutil.copy(
+        partial_path,
+        path,
+        driver='COG',
+        compress='DEFLATE',
+        predictor='YES',
+        blocksize=512,
+        overview_resampling='average',
+        bigtiff='IF_SAFER'
+    )
+    rasterio.shutil.delete(partial_path)
+
+
+def _create(
+        path: Path,
+        encoding: IndexEncoding,
+        width: int,
+        height: int,
+        transform: Affine,
+        crs: CRS,
+        scale: float = INT16_SCALE,
+        mode: str = 'w'
+):
+    """Open a new tiled GeoTIFF for writing, with the index scale in its metadata.
+
+    The `w+` mode also allows reading back the written pixels. The blocks
+    not written yet are read as nodata.
+    """
+    dataset = rasterio.open(path, mode, **_profile(encoding, width, height, transform, crs))
+    if encoding is IndexEncoding.INT16:
+        dataset.scales = (scale,)
+        dataset.offsets = (0.0,)
+    return dataset
+
+
+def write_index_cog(
+        path: Path,
+        raster: ndarray,
+        transform: Affine,
+        crs: CRS,
+        encoding: IndexEncoding = IndexEncoding.FLOAT32,
+        name: str = None
+) -> Path:
+    """Write an index raster as a tiled, compressed Cloud Optimized GeoTIFF.
+
+    The raster is encoded and written one block at a time into a temporary
+    GeoTIFF, which is then converted to a COG with overviews.
+
+    Args:
+        path (Path): Path of the output file.
+        raster (ndarray): The (1, H, W) or (H, W) index raster, with NaN (or
+            masked pixels) as nodata.
+        transform (Affine): The georeferencing transform of the raster.
+        crs (CRS): The coordinate reference system of the raster.
+        encoding (IndexEncoding): How the values are stored.
+        name (str): Optional name of the index, stored as the band
+            description. It also picks the INT16 scale (see int16_scale).
+
+    Returns:
+        The path of the written file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = _partial_path(path)
+    raster = raster.reshape(raster.shape[-2:])
+
+    scale = int16_scale(name)
+
+    with _create(partial_path, encoding, raster.shape[1], raster.shape[0], transform, crs, scale) as dataset:
+        if name is not None:
+            dataset.set_band_description(1, name)
+        for _, window in dataset.block_windows(1):
+            block = raster[window.toslices()]
+            dataset.write(encode_index(block, encoding, scale), 1, window=window)
+
+    _to_cog(partial_path, path)
+    return path
+
+
+def get_georeference(bands: Bands) -> Tuple[Affine, CRS, Tuple[int, int]]:
+    """Returns the transform, crs and (height, width) shape of the bands of a field.
+
+    Raises:
+        ValueError if the bands are not georeferenced.
+    """
+    for band in vars(bands).values():
+        if band is not None and band.transform is not None:
+            return band.transform, band.crs, band.raster.shape[-2:]
+
+    raise ValueError('The bands of the field are not georeferenced')
+
+
+def export_field_indexes(
+        fields: Iterable[FieldData],
+        directory: Path,
+        indexes: Iterable[str] = None,
+        encoding: IndexEncoding = IndexEncoding.FLOAT32
+) -> Dict[str, List[Path]]:
+    """Write the indexes of every field as Cloud Optimized GeoTIFFs.
+
+    The files are written to `<directory>/<field geometry hash>/<index>.tif`.
+    Fields without bands (for example the ones skipped by the cloud mask)
+    are ignored.
+
+    Args:
+        fields (Iterable[FieldData]): The fields, with their bands.
+        directory (Path): Directory where the files are written.
+        indexes (Iterable[str]): The names of the indexes. Defaults to all
+            the registered indexes.
+        encoding (IndexEncoding): How the values are stored.
+
+    Returns:
+        A dict with the field geometry hash as the key and the paths of its
+            files as the value.
+    """
+    names = [definition.name for definition in get_index_definitions(indexes)]
+    paths = {}
+
+    for field in fields:
+        if field.bands is None:
+            continue
+
+        transform, crs, _ = get_georeference(field.bands)
+        paths[field.geometry_hash] = [
+            write_index_cog(
+                Path(directory) / field.geometry_hash / f'{name}.tif', raster, transform, crs, encoding, name
+            )
+            for name, raster in zip(names, compute_indexes(field.bands, names))
+        ]
+
+    return paths
+
+
+def export_mosaic(
+        fields: Iterable[FieldData],
+        path: Path,
+        index: str = 'ndvi',
+        encoding: IndexEncoding = IndexEncoding.FLOAT32
+) -> Path:
+    """Write an index of several fields into a single Cloud Optimized GeoTIFF.
+
+    The mosaic covers the bounds of all the fields, on the grid they share.
+    Every field index is calculated and written into its own window, one
+    field at a time, so only one field raster is in memory at once. Pixels
+    of overlapping fields are taken from the last valid field.
+
+    Args:
+        fields (Iterable[FieldData]): The fields, with their bands clipped
+            from the same tile and resolution.
+        path (Path): Path of the output file.
+        index (str): The name of the index.
+        encoding (IndexEncoding): How the values are stored.
+
+    Raises:
+        ValueError if there are no fields with bands or they are not on
+            the same crs.
+
+    Returns:
+        The path of the written file.
+    """
+    fields = [field for field in fields if field.bands is not None]
+    if not fields:
+        raise ValueError('There are no fields with bands to export')
+
+    georeferences = [get_georeference(field.bands) for field in fields]
+    if len({crs for _, crs, _ in georeferences}) > 1:
+        raise ValueError('The fields must share the same crs')
+
+    resolution_x, resolution_y = georeferences[0][0].a, -georeferences[0][0].e
+    left = min(transform.c for transform, _, _ in georeferences)
+    top = max(transform.f for transform, _, _ in georeferences)
+    right = max(transform.c + resolution_x * shape[1] for transform, _, shape in georeferences)
+    bottom = min(transform.f - resolution_y * shape[0] for transform, _, shape in georeferences)
+
+    transform = Affine(resolution_x, 0, left, 0, -resolution_y, top)
+    width = int(round((right - left) / resolution_x))
+    height = int(round((top - bottom) / resolution_y))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial_path = _partial_path(path)
+    scale = int16_scale(index)
+
+    # The windows of the previous fields are read back to merge the overlapping ones.
+    with _create(partial_path, encoding, width, height, transform, georeferences[0][1], scale, 'w+') as dataset:
+        dataset.set_band_description(1, index)
+        for field, (field_transform, _, (field_height, field_width)) in zip(fields, georeferences):
+            window = Window(
+                int(round((field_transform.c - left) / resolution_x)),
+                int(round((top - field_transform.f) / resolution_y)),
+                field_width,
+                field_height
+            )
+            raster = encode_index(compute_indexes(field.bands, [index])[0, 0], encoding, scale)
+
+            existing = dataset.read(1, window=window)
+            valid = ~np.isnan(raster) if encoding is IndexEncoding.FLOAT32 else raster != INT16_NODATA
+            existing[valid] = raster[valid]
+            dataset.write(existing, 1, window=window)
+
+    _to_cog(partial_path, path)
+    return path
+
+
+def chunk_windows(width: int, height: int, chunk_size: int) -> Iterator[Window]:
+    """Yield the square windows of chunk_size pixels covering a raster, row by row."""
+    for row in range(0, height, chunk_size):
+        for col in range(0, width, chunk_size):
+            yield Window(col, row, min(chunk_size, width - col), min(chunk_size, height - row))
+
+
+def export_tile_indexes(
+        data_path: Path,
+        resolution: int,
+        directory: Path,
+        indexes: Iterable[str] = None,
+        encoding: IndexEncoding = IndexEncoding.FLOAT32,
+        chunk_size: int = 1024,
+        zipped: bool = False,
+        resampling: Resampling = None,
+        aligned_directory: Path = None
+) -> Dict[str, List[Path]]:
+    """Write the indexes of full product tiles as Cloud Optimized GeoTIFFs, chunk by chunk.
+
+    The bands are read one chunk_size window at a time, the indexes of the
+    window are calculated with compute_indexes into a reused buffer and
+    streamed to the output files, so the tiles are never loaded in memory.
+    The peak memory is about chunk_size² × (8 × bands + 4 × indexes + 20)
+    bytes, around 80 MiB for all the indexes with the default chunk size,
+    whatever the tile size is. A chunk_size multiple of 512 matches the
+    blocks of the output files.
+
+    The files are written to `<directory>/<product>_<index>.tif`.
+
+    Args:
+        data_path (Path): Path object where the sentinel2 products are
+            located, or a single SAFE directory (or zip file).
+        resolution (int): The bands resolution in meters.
+        directory (Path): Directory where the files are written.
+        indexes (Iterable[str]): The names of the indexes. Defaults to all
+            the registered indexes.
+        encoding (IndexEncoding): How the values are stored.
+        chunk_size (int): Side in pixels of the windows processed at once.
+        zipped (bool): Also process the zipped products.
+        resampling (Resampling): Resample the bands without a file at the
+            resolution with this kernel (see align_band_paths). By default
+            only the bands with a file at the resolution are used.
+        aligned_directory (Path): Directory where the resampled bands are
+            stored. Defaults to an `aligned` directory next to the products.
+
+    Raises:
+        ValueError if a product lacks a band needed by the indexes, or its
+            bands are not on the same grid.
+
+    Returns:
+        A dict with the product name as the key and the paths of its
+            files, in the order of the indexes, as the value.
+    """
+    names = [definition.name for definition in get_index_definitions(indexes)]
+    needed_bands = get_required_bands(names)
+    product_paths = get_product_paths(data_path, zipped) or {data_path.stem.replace('.SAFE', ''): data_path}
+    paths = {}
+
+    for product, product_path in product_paths.items():
+        band_paths = get_band_paths(
+            Path(product_path), resolution, needed_bands, zipped=zipped, any_resolution=resampling is not None
+        )
+        if resampling is not None:
+            band_paths = align_band_paths(
+                band_paths, resolution, resampling, aligned_directory or default_aligned_directory(data_path)
+            )
+        missing = sorted(set(needed_bands) - set(band_paths))
+        if missing:
+            raise ValueError(f'The product {product} has no {", ".join(missing)} bands at {resolution}m')
+
+        paths[product] = _write_tile_indexes(
+            band_paths, resolution, Path(directory), product, names, encoding, chunk_size
+        )
+
+    return paths
+
+
+def _write_tile_indexes(
+        band_paths: Dict[str, Path],
+        resolution: int,
+        directory: Path,
+        product: str,
+        names: List[str],
+        encoding: IndexEncoding,
+        chunk_size: int
+) -> List[Path]:
+    """Stream the indexes of a tile, chunk by chunk, into temporary GeoTIFFs converted to COGs."""
+    directory.mkdir(parents=True, exist_ok=True)
+    index_paths = [directory / f'{product}_{name}.tif' for name in names]
+    partial_paths = [_partial_path(path) for path in index_paths]
+    scales = [int16_scale(name) for name in names]
+
+    with ExitStack() as stack:
+        datasets = {band: stack.enter_context(rasterio.open(image)) for band, image in band_paths.items()}
+        first = next(iter(datasets.values()))
+        if len({(dataset.width, dataset.height, dataset.transform) for dataset in datasets.values()}) > 1:
+            raise ValueError(f'The bands of the product {product} are not on the same grid')
+
+        outputs = [
+            stack.enter_context(
+                _create(partial_path, encoding, first.width, first.height, first.transform, first.crs, scale)
+            )
+            for partial_path, scale in zip(partial_paths, scales)
+        ]
+        for output, name in zip(outputs, names):
+            output.set_band_description(1, name)
+
+        buffer = np.empty((len(names), 1, min(chunk_size, first.height), min(chunk_size, first.width)), np.float32)
+        for window in chunk_windows(first.width, first.height, chunk_size):
+            bands = {}
+            for band, dataset in datasets.items():
+                raster = dataset.read([1], window=window, masked=True)
+                bands[band] = Band(
+                    BandNumber(band), resolution, np.ma.getdata(raster), ~np.ma.getmaskarray(raster)
+                )
+
+            # The edge windows are written into a corner of the reused buffer.
+            out = buffer[:, :, :window.height, :window.width]
+            compute_indexes(Bands(**bands), names, out=out)
+            for output, raster, scale in zip(outputs, out, scales):
+                output.write(encode_index(raster[0], encoding, scale), 1, window=window)
+
+    for partial_path, path in zip(partial_paths, index_paths):
+        _to_cog(partial_path, path)
+
+    return index_paths
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from shapely.geometry import shape
+
+import hashlib
+import json
+import os
+
+import fiona
+
+# The parsed shapefile: the WKB of the geometries, their properties and the crs WKT.
+ParsedShapefile = Tuple[List[bytes], List[OrderedDict], str]
+
+
+def read_shapefile(path: Path) -> ParsedShapefile:
+    """Read the geometries and properties of a shapefile, closing it afterwards."""
+    with fiona.open(path) as file:
+        geometries, properties = [], []
+        for feature in file:
+            geometries.append(shape(feature['geometry']).wkb)
+            properties.append(OrderedDict(feature['properties']))
+        return geometries, properties, file.crs_wkt
+
+
+def _cache_path(directory: Path, path: Path) -> Path:
+    """Returns the cache file of a shapefile, named after its path and modification time."""
+    stat = path.stat()
+    name = hashlib.sha256(str(path.resolve()).encode()).hexdigest()[:16]
+    return Path(directory) / f'{name}_{stat.st_mtime_ns}_{stat.st_size}.parquet'
+
+
+def load_cached(directory: Path, path: Path) -> Optional[ParsedShapefile]:
+    """Load a parsed shapefile from the cache.
+
+    Raises:
+        ImportError if pyarrow is not installed.
+
+    Returns:
+        The parsed shapefile, or None if it is not cached or the shapefile
+            changed since it was cached.
+    """
+    import pyarrow.parquet as pq
+
+    cache_path = _cache_path(directory, path)
+    if not cache_path.exists():
+        return None
+
+    table = pq.read_table(cache_path)
+    metadata = json.loads(table.schema.metadata[b'geo'])
+    properties = [
+        json.loads(value, object_pairs_hook=OrderedDict) for value in table.column('properties').to_pylist()
+    ]
+    return table.column('geometry').to_pylist(), properties, metadata['columns']['geometry']['crs']
+
+
+def store(directory: Path, path: Path, parsed: ParsedShapefile) -> None:
+    """Store a parsed shapefile in the cache as a GeoParquet file.
+
+    Files cached for previous versions of the shapefile are removed.
+
+    Raises:
+        ImportError if pyarrow is not installed.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    cache_path = _cache_path(directory, path)
+    geometries, properties, crs = parsed
+
+    # The geo metadata makes the file readable by geopandas.read_parquet.
+    metadata = {
+        'version': '0.4.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {'encoding': 'WKB', 'crs': crs}},
+    }
+    table = pa.table(
+        {
+            'geometry': pa.array(geometries, type=pa.binary()),
+            'properties': pa.array([json.dumps(value, default=str) for value in properties], type=pa.string()),
+        },
+        metadata={'geo': json.dumps(metadata)}
+    )
+
+    partial_path = cache_path.with_name(f'{cache_path.stem}.{os.getpid()}.partial')
+    pq.write_table(table, partial_path)
+    os.replace(partial_path, cache_path)
+
+    for stale_path in directory.glob(f'{cache_path.name.split("_")[0]}_*.parquet'):
+        if stale_path != cache_path:
+            stale_path.unlink(missing_ok=True)
+
+
+def load_shapefile(path: Path, cache_directory: Path = None) -> ParsedShapefile:
+    """Read a shapefile through the cache, if a cache directory is given."""
+    if cache_directory is not None:
+        parsed = load_cached(cache_directory, path)
+        if parsed is not None:
+            return parsed
+
+    parsed = read_shapefile(path)
+    if cache_directory is not None:
+        store(cache_directory, path, parsed)
+    return parsed
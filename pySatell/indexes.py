@@ -0,0 +1,148 @@
+from typing import Dict, Sequence, Tuple
+
+from numpy import ndarray
+
+import numpy as np
+
+from models import Bands, get_index_definitions
+
+
+Scratch = Tuple[ndarray, ndarray, ndarray]
+
+
+def _divide(out: ndarray, denominator: ndarray, valid: ndarray, where: ndarray) -> None:
+    """Divide in place only the valid pixels with a non zero denominator.
+
+    The other pixels are set to NaN. `where` is a boolean scratch buffer.
+    """
+    np.not_equal(denominator, 0, out=where)
+    np.logical_and(where, valid, out=where)
+    np.divide(out, denominator, out=out, where=where)
+    np.logical_not(where, out=where)
+    np.copyto(out, np.nan, where=where)
+
+
+def _ndvi(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.subtract(bands['B08'], bands['B04'], out=out)
+    np.add(bands['B08'], bands['B04'], out=scratch[0])
+    _divide(out, scratch[0], valid, scratch[2])
+
+
+def _evi(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.multiply(bands['B04'], 6, out=scratch[0])
+    np.add(scratch[0], bands['B08'], out=scratch[0])
+    np.multiply(bands['B02'], 7.5, out=scratch[1])
+    np.subtract(scratch[0], scratch[1], out=scratch[0])
+    np.add(scratch[0], 1, out=scratch[0])
+    np.subtract(bands['B08'], bands['B04'], out=out)
+    _divide(out, scratch[0], valid, scratch[2])
+    np.multiply(out, 2.5, out=out)
+
+
+def _savi(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.subtract(bands['B08'], bands['B04'], out=out)
+    np.add(bands['B08'], bands['B04'], out=scratch[0])
+    np.add(scratch[0], 0.5, out=scratch[0])
+    _divide(out, scratch[0], valid, scratch[2])
+    np.multiply(out, 1.5, out=out)
+
+
+def _osavi(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.subtract(bands['B08'], bands['B04'], out=out)
+    np.add(bands['B08'], bands['B04'], out=scratch[0])
+    np.add(scratch[0], 0.16, out=scratch[0])
+    _divide(out, scratch[0], valid, scratch[2])
+
+
+def _arvi(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.multiply(bands['B04'], 2, out=scratch[0])
+    np.add(bands['B08'], bands['B02'], out=scratch[1])
+    np.subtract(scratch[1], scratch[0], out=out)
+    np.add(scratch[1], scratch[0], out=scratch[1])
+    _divide(out, scratch[1], valid, scratch[2])
+
+
+def _gci(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.copyto(out, bands['B08'])
+    _divide(out, bands['B03'], valid, scratch[2])
+    np.subtract(out, 1, out=out)
+
+
+def _sipi(bands: Dict[str, ndarray], out: ndarray, scratch: Scratch, valid: ndarray) -> None:
+    np.subtract(bands['B08'], bands['B02'], out=out)
+    np.subtract(bands['B08'], bands['B04'], out=scratch[0])
+    _divide(out, scratch[0], valid, scratch[2])
+
+
+# The kernels write the index into `out` using only the scratch buffers,
+# so computing any number of indexes allocates no temporaries. The bands
+# each kernel reads are declared in the models.INDEXES registry.
+KERNELS = {
+    'arvi': _arvi,
+    'evi': _evi,
+    'gci': _gci,
+    'ndvi': _ndvi,
+    'osavi': _osavi,
+    'savi': _savi,
+    'sipi': _sipi,
+}
+
+
+def compute_indexes(
+        bands: Bands,
+        indexes: Sequence[str] = None,
+        out: ndarray = None,
+        dtype=np.float32
+) -> ndarray:
+    """Compute several vegetation indexes in a single pass.
+
+    Every band needed by the requested indexes is converted to the output
+    dtype only once, and the indexes are written into a single stacked
+    array reusing the same scratch buffers. Only the pixels valid in all
+    the bands of an index (and with a non zero denominator) are divided,
+    the others are set to NaN.
+
+    Args:
+        bands (Bands): The bands of a field.
+        indexes (Sequence[str]): The names of the indexes to compute.
+            Defaults to all the registered indexes.
+        out (ndarray): Optional array of shape (len(indexes), *band_shape)
+            and the requested dtype where the indexes are written.
+        dtype: The floating point dtype used for the calculations.
+
+    Raises:
+        ValueError if an index is not registered or `out` does not have the
+            expected shape or dtype.
+
+    Returns:
+        An array with the indexes stacked in the requested order, with
+            NaN as nodata.
+    """
+    definitions = get_index_definitions(indexes)
+
+    needed_bands = {band for definition in definitions for band in definition.bands}
+    rasters = {
+        band: getattr(bands, band).raster.astype(dtype, copy=False) for band in needed_bands
+    }
+
+    shape = (len(definitions),) + (next(iter(rasters.values())).shape if rasters else ())
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape or out.dtype != np.dtype(dtype):
+        raise ValueError(f'Expected out with shape {shape} and dtype {np.dtype(dtype)}')
+
+    scratch = (
+        np.empty(shape[1:], dtype=dtype),
+        np.empty(shape[1:], dtype=dtype),
+        np.empty(shape[1:], dtype=bool)
+    )
+    valids = {band: getattr(bands, band).valid for band in needed_bands}
+    combined_valids = {}
+
+    for position, definition in enumerate(definitions):
+        if definition.bands not in combined_valids:
+            band_valids = [valids[band] for band in definition.bands if valids[band] is not None]
+            combined_valids[definition.bands] = np.logical_and.reduce(band_valids) if band_valids else True
+        KERNELS[definition.name](rasters, out[position], scratch, combined_valids[definition.bands])
+
+    return out
@@ -1,15 +1,25 @@
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import List, OrderedDict
+from itertools import repeat
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, OrderedDict, Sequence, Tuple
+from affine import Affine
 from numpy import ndarray
 from pathlib import Path
-from rasterio.mask import mask
+from shapely import wkb
+from shapely.geometry import mapping, shape
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
 
 
+import hashlib
 import numpy as np
-import rasterio
-import fiona
+
+from fieldcache import load_shapefile
+
+if TYPE_CHECKING:
+    from rasterio.crs import CRS
 
 
 class Platform(Enum):
@@ -43,7 +53,7 @@ class BandNumber(Enum):
     B10 = 'B10'
     B11 = 'B11'
     B12 = 'B12'
-    B8A = 'B13'
+    B8A = 'B8A'
 
 
 @dataclass
@@ -56,10 +66,182 @@ class Band:
         resolution (int): The pixel resolution (for example, 10 represents a
             10m by 10m pixel resolution).
         raster (ndarray): A numpy array with the band information.
+        valid (ndarray): A boolean array with the raster shape, False for
+            the pixels outside the field or without data. None means that
+            every pixel is valid.
+        transform (Affine): The georeferencing transform of the raster.
+        crs (CRS): The coordinate reference system of the raster.
     """
     number: BandNumber
     resolution: int
     raster: ndarray
+    valid: ndarray = None
+    transform: Affine = None
+    crs: 'CRS' = None
+
+    def get_valid(self) -> ndarray:
+        """Returns the validity mask, with every pixel valid if there is none."""
+        if self.valid is None:
+            return np.ones(self.raster.shape, dtype=bool)
+        return self.valid
+
+
+def _valid(*bands: Band) -> ndarray:
+    """Returns the pixels that are valid in all the bands."""
+    return np.logical_and.reduce([band.get_valid() for band in bands])
+
+
+def _masked_divide(numerator: ndarray, denominator: ndarray, valid: ndarray) -> np.ma.MaskedArray:
+    """Divide only the valid pixels with a non zero denominator.
+
+    The other pixels are masked (and hold NaN), so no division by zero
+    happens and no global numpy error state has to be changed.
+    """
+    valid = valid & (denominator != 0)
+    result = np.divide(numerator, denominator, out=np.full(numerator.shape, np.nan), where=valid)
+    return np.ma.masked_array(result, mask=~valid)
+
+
+class BandView:
+    """A band of a BandStack.
+
+    It has the same attributes as a Band, but the raster and the validity
+    mask are views into the stack arrays, and the instance has no __dict__.
+    """
+    __slots__ = ('number', 'resolution', 'raster', 'valid', 'transform', 'crs')
+
+    def __init__(
+            self,
+            number: BandNumber,
+            resolution: int,
+            raster: ndarray,
+            valid: ndarray = None,
+            transform: Affine = None,
+            crs: 'CRS' = None
+    ):
+        self.number = number
+        self.resolution = resolution
+        self.raster = raster
+        self.valid = valid
+        self.transform = transform
+        self.crs = crs
+
+    def __repr__(self) -> str:
+        return f'BandView(number={self.number}, resolution={self.resolution}, shape={self.raster.shape})'
+
+    get_valid = Band.get_valid
+
+
+class BandStack:
+    """Contiguous storage of all the bands of a field.
+
+    The rasters of the bands are kept in a single (n_bands, H, W) array, and
+    the validity masks in a single boolean array with the same shape, instead
+    of one array per band. Both arrays can be memory mapped .npy files, so
+    the bands of many fields can be spilled to disk.
+
+    Args:
+        bands (Sequence[str]): The names of the stacked bands, in order.
+        resolution (int): The bands resolution in meters.
+        rasters (ndarray): The (n_bands, H, W) array with the rasters.
+        valid (ndarray): Optional (n_bands, H, W) boolean array, False for
+            the pixels outside the field or without data.
+        transform (Affine): The georeferencing transform shared by the bands.
+        crs (CRS): The coordinate reference system shared by the bands.
+    """
+    __slots__ = ('bands', 'resolution', 'rasters', 'valid', 'transform', 'crs')
+
+    def __init__(
+            self,
+            bands: Sequence[str],
+            resolution: int,
+            rasters: ndarray,
+            valid: ndarray = None,
+            transform: Affine = None,
+            crs: 'CRS' = None
+    ):
+        self.bands = tuple(bands)
+        self.resolution = resolution
+        self.rasters = rasters
+        self.valid = valid
+        self.transform = transform
+        self.crs = crs
+
+    @staticmethod
+    def _valid_path(path: Path) -> Path:
+        return path.with_name(f'{path.stem}.valid.npy')
+
+    @classmethod
+    def from_bands(cls, bands: Dict[str, Band], path: Path = None) -> 'BandStack':
+        """Stack the bands of a field.
+
+        Args:
+            bands (Dict[str, Band]): The bands of the field, with the band
+                name as the key. All the rasters must have the same (1, H, W)
+                shape.
+            path (Path): Optional .npy file where the stack is spilled. The
+                validity masks are stored next to it, in a .valid.npy file.
+
+        Raises:
+            ValueError if the bands do not have the same shape.
+
+        Returns:
+            The BandStack of the bands.
+        """
+        names = list(bands)
+        first = bands[names[0]]
+        shapes = {band.raster.shape for band in bands.values()}
+        if len(shapes) > 1 or first.raster.shape[0] != 1:
+            raise ValueError(f'Expected bands with the same (1, H, W) shape, got {sorted(shapes)}')
+
+        shape = (len(names),) + first.raster.shape[1:]
+        has_valid = any(band.valid is not None for band in bands.values())
+
+        if path is None:
+            rasters = np.empty(shape, dtype=first.raster.dtype)
+            valid = np.empty(shape, dtype=bool) if has_valid else None
+        else:
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Unlinked first, so stacks still mapping a previous file are not truncated.
+            path.unlink(missing_ok=True)
+            cls._valid_path(path).unlink(missing_ok=True)
+            rasters = np.lib.format.open_memmap(path, mode='w+', dtype=first.raster.dtype, shape=shape)
+            valid = None
+            if has_valid:
+                valid = np.lib.format.open_memmap(cls._valid_path(path), mode='w+', dtype=bool, shape=shape)
+
+        for position, band in enumerate(bands.values()):
+            rasters[position] = band.raster[0]
+            if valid is not None:
+                valid[position] = band.get_valid()[0]
+
+        return cls(names, first.resolution, rasters, valid, first.transform, first.crs)
+
+    @classmethod
+    def load(cls, bands: Sequence[str], resolution: int, path: Path) -> 'BandStack':
+        """Open a spilled stack memory mapped."""
+        path = Path(path)
+        valid_path = cls._valid_path(path)
+        valid = np.load(valid_path, mmap_mode='r') if valid_path.exists() else None
+        return cls(bands, resolution, np.load(path, mmap_mode='r'), valid)
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the bytes used by the rasters and the validity masks."""
+        return self.rasters.nbytes + (self.valid.nbytes if self.valid is not None else 0)
+
+    def band(self, name: str) -> BandView:
+        """Returns a (1, H, W) view of a band."""
+        position = self.bands.index(name)
+        valid = self.valid[position:position + 1] if self.valid is not None else None
+        return BandView(
+            BandNumber(name), self.resolution, self.rasters[position:position + 1], valid, self.transform, self.crs
+        )
+
+    def spill(self, path: Path) -> 'BandStack':
+        """Returns a copy of the stack memory mapped to a .npy file."""
+        return BandStack.from_bands({name: self.band(name) for name in self.bands}, path)
 
 
 @dataclass
@@ -67,7 +249,8 @@ class Bands:
     """Represents all the bands for a given instrument.
 
     This class is mainly used to calculate the different indexes using
-        bands algebra.
+        bands algebra. The indexes are masked arrays, masking the pixels that
+        are not valid in all the bands used or where the index is undefined.
     """
     B01: Band = None
     B02: Band = None
@@ -83,83 +266,157 @@ class Bands:
     B12: Band = None
     B8A: Band = None
 
+    @classmethod
+    def from_stack(cls, stack: BandStack) -> 'Bands':
+        """Creates a Bands object whose bands are views into a BandStack."""
+        return cls(**{name: stack.band(name) for name in stack.bands})
+
     def ndvi(self):
         """Returns the ndvi index."""
-        band_nir = self.B08.raster
-        band_red = self.B04.raster
+        band_nir = self.B08.raster.astype(float)
+        band_red = self.B04.raster.astype(float)
 
-        return (
-                (band_nir.astype(float) - band_red.astype(float))
-                / (band_nir.astype(float) + band_red.astype(float))
+        return _masked_divide(
+            band_nir - band_red,
+            band_nir + band_red,
+            _valid(self.B08, self.B04)
         )
 
     def evi(self):
         """Returns the EVI index."""
-        band_nir = self.B08.raster
-        band_red = self.B04.raster
-        band_blue = self.B02.raster
-
-        evi = 2.5 * (
-                (band_nir - band_red) /
-                ((band_nir + (6 * band_red) - (7.5 * band_blue)) + 1)
+        band_nir = self.B08.raster.astype(float)
+        band_red = self.B04.raster.astype(float)
+        band_blue = self.B02.raster.astype(float)
+
+        # The scale goes into the numerator, so the masked pixels keep NaN.
+        evi = _masked_divide(
+            2.5 * (band_nir - band_red),
+            (band_nir + (6 * band_red) - (7.5 * band_blue)) + 1,
+            _valid(self.B08, self.B04, self.B02)
         )
         return evi
 
     def savi(self):
         """Returns the Soil Adjusted Vegetation Index (SAVI)."""
-        band_nir = self.B08.raster
-        band_red = self.B04.raster
+        band_nir = self.B08.raster.astype(float)
+        band_red = self.B04.raster.astype(float)
 
-        savi = 1.5 * (
-                (band_nir - band_red) /
-                (band_nir + band_red + 0.5)
+        savi = _masked_divide(
+            1.5 * (band_nir - band_red),
+            band_nir + band_red + 0.5,
+            _valid(self.B08, self.B04)
         )
         return savi
 
     def osavi(self):
         """Returns the Optimized SAVI index."""
-        band_nir = self.B08.raster
-        band_red = self.B04.raster
+        band_nir = self.B08.raster.astype(float)
+        band_red = self.B04.raster.astype(float)
 
-        osavi = (
-                (band_nir - band_red) /
-                (band_nir + band_red + 0.16)
+        osavi = _masked_divide(
+            band_nir - band_red,
+            band_nir + band_red + 0.16,
+            _valid(self.B08, self.B04)
         )
         return osavi
 
     def arvi(self):
         """Returns the Atmospheric Resistant Vegetation Index (ARVI)."""
-        band_nir = self.B08.raster
-        band_red = self.B04.raster
-        band_blue = self.B02.raster
-
-        arvi = (
-                (band_nir - (2 * band_red) + band_blue) /
-                (band_nir + (2 * band_red) + band_blue)
+        band_nir = self.B08.raster.astype(float)
+        band_red = self.B04.raster.astype(float)
+        band_blue = self.B02.raster.astype(float)
+
+        arvi = _masked_divide(
+            band_nir - (2 * band_red) + band_blue,
+            band_nir + (2 * band_red) + band_blue,
+            _valid(self.B08, self.B04, self.B02)
         )
         return arvi
 
     def gci(self):
         """Returns the Green Chlorophyll Index (GCI)."""
-        band_nir = self.B08.raster
-        band_green = self.B03.raster
+        band_nir = self.B08.raster.astype(float)
+        band_green = self.B03.raster.astype(float)
 
-        gci = (band_nir / band_green) - 1
+        gci = _masked_divide(band_nir, band_green, _valid(self.B08, self.B03)) - 1
         return gci
 
     def sipi(self):
         """Returns the Structure Insensitive Pigment Index (SIPI)."""
-        band_nir = self.B08.raster
-        band_red = self.B04.raster
-        band_blue = self.B02.raster
-
-        sipi = (
-                (band_nir - band_blue) /
-                (band_nir - band_red)
+        band_nir = self.B08.raster.astype(float)
+        band_red = self.B04.raster.astype(float)
+        band_blue = self.B02.raster.astype(float)
+
+        sipi = _masked_divide(
+            band_nir - band_blue,
+            band_nir - band_red,
+            _valid(self.B08, self.B04, self.B02)
         )
         return sipi
 
 
+@dataclass(frozen=True)
+class IndexDefinition:
+    """Describes a vegetation index that can be calculated from the bands.
+
+    Attributes:
+        name (str): The name of the index.
+        function (Callable): The Bands method that calculates the index.
+        bands (Tuple[str, ...]): The names of the bands needed by the index.
+    """
+    name: str
+    function: Callable[[Bands], ndarray]
+    bands: Tuple[str, ...]
+
+
+INDEXES: Dict[str, IndexDefinition] = {
+    definition.name: definition for definition in (
+        IndexDefinition('arvi', Bands.arvi, ('B02', 'B04', 'B08')),
+        IndexDefinition('evi', Bands.evi, ('B02', 'B04', 'B08')),
+        IndexDefinition('gci', Bands.gci, ('B03', 'B08')),
+        IndexDefinition('ndvi', Bands.ndvi, ('B04', 'B08')),
+        IndexDefinition('osavi', Bands.osavi, ('B04', 'B08')),
+        IndexDefinition('savi', Bands.savi, ('B04', 'B08')),
+        IndexDefinition('sipi', Bands.sipi, ('B02', 'B04', 'B08')),
+    )
+}
+
+
+def get_index_definitions(indexes: Iterable[str] = None) -> List[IndexDefinition]:
+    """Get the definitions of the desired indexes.
+
+    Args:
+        indexes (Iterable[str]): The names of the desired indexes.
+            Defaults to all the registered indexes.
+
+    Raises:
+        ValueError if an index is not registered.
+
+    Returns:
+        A list with the index definitions in the requested order.
+    """
+    if indexes is None:
+        return list(INDEXES.values())
+
+    definitions = []
+    for index in indexes:
+        if index not in INDEXES:
+            raise ValueError(f'Unknown index: {index}')
+        definitions.append(INDEXES[index])
+
+    return definitions
+
+
+def get_required_bands(indexes: Iterable[str] = None) -> List[str]:
+    """Returns the sorted names of the bands needed by the desired indexes."""
+    return sorted({band for definition in get_index_definitions(indexes) for band in definition.bands})
+
+
+def geometry_hash(geometry: dict) -> str:
+    """Returns a stable hash of a geojson like geometry."""
+    return hashlib.sha256(shape(geometry).wkb).hexdigest()
+
+
 @dataclass
 class FieldData:
     """Encapsulates all the information of a particular Field.
@@ -179,21 +436,26 @@ class FieldData:
         """Returns the farm_name if exists in the properties."""
         return self.properties.get('farm_name', "")
 
-    def get_all_indexes(self) -> dict:
+    @property
+    def geometry_hash(self) -> str:
+        """Returns a stable hash of the field geometry."""
+        return geometry_hash(self.geometry)
+
+    def get_all_indexes(self, indexes: Iterable[str] = None) -> dict:
         """Returns all indexes for a given bands object.
 
+        Args:
+            indexes (Iterable[str]): The names of the indexes to calculate.
+                Defaults to all the registered indexes.
+
         Returns:
             A dict with the name of the index as the key and the
                 calculated index raster as the value.
         """
-        indexes = [
-            index for index in dir(Bands) if callable(getattr(Bands, index)) and index.startswith('__') is False
-        ]
-        calculated_indexes = {}
-        for index in indexes:
-            calculated_indexes.update({index: self.bands.__getattribute__(index)()})
-
-        return calculated_indexes
+        return {
+            definition.name: definition.function(self.bands)
+            for definition in get_index_definitions(indexes)
+        }
 
 
 class Fields:
@@ -203,29 +465,95 @@ class Fields:
         directory containing all the shape files of the
         fields that want to be analyzed.
 
+    The shapefiles can be read in parallel processes, and their parsed
+    geometries cached as GeoParquet files, keyed by the shapefile
+    modification time, so the next runs skip the parsing. An STRtree of
+    the field geometries is built on first use to find the fields
+    intersecting an area.
+
     Args:
         shp_files_path (Path): A Path object of a directory
             containing the shapefiles of the fields that
             want to be analyzed.
+        workers (int): Number of processes used to read the shapefiles.
+        cache_directory (Path): Optional directory where the parsed
+            shapefiles are cached.
 
     Attributes:
         fields (List[FieldData]): All the Field objects
             with information about the fields.
+        crs (str): The WKT of the crs of the field geometries, or None if
+            it is unknown.
+
+    Raises:
+        ValueError if the shapefiles are not in the same crs.
     """
 
-    def __init__(self, shp_files_path: Path):
-        fiona_geometries = []
+    def __init__(self, shp_files_path: Path, workers: int = 1, cache_directory: Path = None):
+        shp_paths = sorted(shp_files_path.glob('./*.shp'))
+        arguments = (shp_paths, repeat(cache_directory))
+
+        if workers > 1 and len(shp_paths) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                parsed_shapefiles = list(executor.map(load_shapefile, *arguments))
+        else:
+            parsed_shapefiles = list(map(load_shapefile, *arguments))
+
+        crs = {shapefile_crs for _, _, shapefile_crs in parsed_shapefiles if shapefile_crs}
+        if len(crs) > 1:
+            raise ValueError('The shapefiles of the fields must share the same crs')
+        self.crs = crs.pop() if crs else None
+
+        # The parsed geometries are kept for the tree, so they are decoded once.
+        self._geometries = [wkb.loads(geometry) for geometries, _, _ in parsed_shapefiles for geometry in geometries]
+        self.fields = [
+            FieldData(properties=properties, geometry=mapping(geometry))
+            for geometry, properties in zip(
+                self._geometries,
+                (properties for _, fields_properties, _ in parsed_shapefiles for properties in fields_properties)
+            )
+        ]
+        self._tree = None
+
+    @classmethod
+    def from_field_data(cls, fields: List[FieldData], crs: str = None) -> 'Fields':
+        """Creates a Fields object from already loaded fields, in the crs given as WKT."""
+        instance = cls.__new__(cls)
+        instance.fields = list(fields)
+        instance.crs = crs
+        instance._geometries = None
+        instance._tree = None
+        return instance
+
+    @property
+    def tree(self) -> Tuple[STRtree, List[BaseGeometry]]:
+        """Returns the STRtree of the field geometries, and the geometries."""
+        if self._tree is None:
+            geometries = self._geometries or [shape(field.geometry) for field in self.fields]
+            self._tree = STRtree(geometries), geometries
+        return self._tree
+
+    def intersecting(self, area) -> List[FieldData]:
+        """Get the fields intersecting an area.
+
+        Args:
+            area: A shapely geometry, or a geojson like geometry dict, in
+                the crs of the fields.
+
+        Returns:
+            The intersecting fields, in their loading order.
+        """
+        area = shape(area) if isinstance(area, dict) else area
+        tree, geometries = self.tree
 
-        for field in shp_files_path.glob('./*.shp'):
-            file = fiona.open(field)
-            for geometry in file:
-                fiona_geometries.append(
-                    FieldData(
-                        properties=geometry['properties'], geometry=geometry['geometry']
-                    )
-                )
+        if hasattr(tree, 'query_items'):
+            # shapely 1.8 returns the geometries from query, and their
+            # indexes from query_items.
+            candidates = tree.query_items(area)
+        else:
+            candidates = tree.query(area).tolist()
 
-        self.fields = fiona_geometries
+        return [self.fields[index] for index in sorted(candidates) if geometries[index].intersects(area)]
 
 
 def get_sentinel2_bands(resolution: int, data_path: Path, fields_path: Path) -> List[Bands]:
@@ -247,30 +575,13 @@ def get_sentinel2_bands(resolution: int, data_path: Path, fields_path: Path) ->
     Returns:
         A List[Bands] object each one representing a field's band.
     """
-    clipped_rasters = []
-    fields = Fields(fields_path)
-
-    for field in fields.fields:
-
-        bands = {}
-        images_paths = data_path.glob(f'**/*B*_{resolution}m.jp2')
-
-        for image in images_paths:
-            band = str(image).split('_')[-2]
+    # Imported here because the clipping engine builds on the models.
+    from clipping import clip_fields
 
-            with rasterio.open(image) as f:
-
-                clipped_band, _ = mask(f, [field], crop=True)
-
-                bands[band] = Band(
-                    BandNumber(band),
-                    resolution,
-                    clipped_band
-                )
-
-        clipped_rasters.append(Bands(**bands))
+    fields = Fields(fields_path)
+    fields_bands = clip_fields(data_path, resolution, [field.geometry for field in fields.fields])
 
-    return clipped_rasters
+    return [Bands(**bands) for bands in fields_bands]
 
 
 class Sentinel2Bands:
@@ -285,13 +596,12 @@ class Sentinel2Bands:
         self.fields_path = fields_path
 
     def get_ndvi_raster(self):
-        np.seterr(divide='ignore', invalid='ignore')
         fields_bands = get_sentinel2_bands(10, self.data_path, self.fields_path)
 
         fields_ndvi = []
 
         for field_bands in fields_bands:
 
-            fields_ndvi.append(field_bands.ndvi)
+            fields_ndvi.append(field_bands.ndvi())
 
         return fields_ndvi
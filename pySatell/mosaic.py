@@ -0,0 +1,278 @@
+from dataclasses import dataclass
+from math import ceil, floor
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from affine import Affine
+from numpy import ndarray
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.io import DatasetReader
+from rasterio.vrt import WarpedVRT
+from shapely.geometry import shape
+
+import numpy as np
+import rasterio
+
+from clipping import get_band_paths
+from cloudmask import CloudMask, get_scl_path
+from models import Band, BandNumber
+from scheduling import reproject_geometries
+
+
+@dataclass
+class FieldGrid:
+    """The pixel grid of a field raster merged from several tiles.
+
+    Attributes:
+        transform (Affine): The georeferencing transform of the field raster.
+        width (int): The width of the field raster in pixels.
+        height (int): The height of the field raster in pixels.
+    """
+    transform: Affine
+    width: int
+    height: int
+
+
+def get_field_grid(geometry: dict, origin: Tuple[float, float], resolution: int) -> FieldGrid:
+    """Snap the bounds of a geometry to the pixel grid of a tile.
+
+    Args:
+        geometry (dict): The geojson like geometry of the field.
+        origin (Tuple[float, float]): The upper left corner of the tile.
+        resolution (int): The pixel resolution in meters.
+
+    Returns:
+        The smallest grid covering the geometry, aligned with the tile pixels.
+    """
+    left, bottom, right, top = shape(geometry).bounds
+    col_start = floor((left - origin[0]) / resolution)
+    col_stop = ceil((right - origin[0]) / resolution)
+    row_start = floor((origin[1] - top) / resolution)
+    row_stop = ceil((origin[1] - bottom) / resolution)
+
+    return FieldGrid(
+        Affine(resolution, 0, origin[0] + col_start * resolution, 0, -resolution, origin[1] - row_start * resolution),
+        max(col_stop - col_start, 1),
+        max(row_stop - row_start, 1)
+    )
+
+
+def get_field_grids(
+        images: Sequence[Union[Path, str]],
+        geometries: Sequence[dict],
+        resolution: int,
+        crs: CRS = None
+) -> Tuple[List[FieldGrid], CRS, List[dict]]:
+    """Get the grids of the fields in the crs of the first tile, reading only its header.
+
+    The grids are aligned with the pixels of the first tile, so its pixels
+    are read without resampling. Every resolution of a Sentinel-2 tile
+    shares the same upper left corner, so any band of the tile defines
+    them. The geometries are reprojected to the crs of the tile, since the
+    resolution is in its units (meters for the UTM zones of the tiles).
+
+    Args:
+        images (Sequence[Union[Path, str]]): A band file of every tile, the
+            preferred one first.
+        geometries (Sequence[dict]): The geojson like geometries of the fields.
+        resolution (int): The pixel resolution in meters.
+        crs (CRS): The crs of the geometries. Defaults to the crs of the
+            first tile.
+
+    Raises:
+        ValueError if the first tile is in a geographic crs, where a
+            resolution in meters cannot define a grid.
+
+    Returns:
+        The grid of every field, in the same order as the geometries, their
+            crs, and the geometries in that crs.
+    """
+    with rasterio.open(images[0]) as dataset:
+        grid_crs = dataset.crs
+        origin = dataset.transform.c, dataset.transform.f
+
+    if grid_crs.is_geographic:
+        raise ValueError(f'The tile {images[0]} is in a geographic crs, expected a projected one in meters')
+
+    geometries = reproject_geometries(list(geometries), crs, grid_crs)
+    return [get_field_grid(geometry, origin, resolution) for geometry in geometries], grid_crs, geometries
+
+
+def read_field(
+        dataset: DatasetReader,
+        grid: FieldGrid,
+        crs: CRS,
+        resampling: Resampling = Resampling.nearest
+) -> np.ma.MaskedArray:
+    """Read the pixels of a field grid from a band file, warping them if needed.
+
+    The warped dataset only covers the field grid, so only the pixels of
+    the tile overlapping it are read, whatever the crs and resolution of
+    the tile are. Pixels outside the tile (or without data) are masked.
+
+    Returns:
+        The masked raster with shape (count, height, width).
+    """
+    nodata = dataset.nodata or 0
+    with WarpedVRT(
+            dataset,
+            crs=crs,
+            transform=grid.transform,
+            width=grid.width,
+            height=grid.height,
+            resampling=resampling,
+            src_nodata=nodata,
+            nodata=nodata
+    ) as vrt:
+        return vrt.read(masked=True)
+
+
+def mosaic_band(
+        images: Sequence[Union[Path, str]],
+        geometries: Sequence[dict],
+        grids: Sequence[FieldGrid],
+        crs: CRS,
+        resampling: Resampling = Resampling.nearest
+) -> List[np.ma.MaskedArray]:
+    """Merge the rasters of the fields from the band files of several tiles.
+
+    Every band file is opened once, and only the window of each field is
+    read from it. The pixels are taken from the first tile with data, so
+    the overlap of adjacent tiles is not read twice into the result.
+
+    Args:
+        images (Sequence[Union[Path, str]]): The files of the same band in
+            every tile, the preferred one first.
+        geometries (Sequence[dict]): The geojson like geometries of the fields.
+        grids (Sequence[FieldGrid]): The grid of every field.
+        crs (CRS): The crs of the grids.
+        resampling (Resampling): The kernel used for the tiles whose pixels
+            are not on the grids.
+
+    Returns:
+        A list with the merged masked raster of every field, filled with 0
+            in the pixels outside the field or without data in every tile.
+    """
+    merged: List[Optional[np.ma.MaskedArray]] = [None] * len(grids)
+
+    for image in images:
+        with rasterio.open(image) as dataset:
+            for position, grid in enumerate(grids):
+                raster = read_field(dataset, grid, crs, resampling)
+                if merged[position] is None:
+                    merged[position] = raster
+                    continue
+                missing = np.ma.getmaskarray(merged[position]) & ~np.ma.getmaskarray(raster)
+                merged[position] = np.ma.where(missing, raster, merged[position])
+
+    rasters = []
+    for geometry, grid, raster in zip(geometries, grids, merged):
+        outside = geometry_mask([geometry], out_shape=(grid.height, grid.width), transform=grid.transform)
+        rasters.append(np.ma.masked_array(raster.filled(0), mask=np.ma.getmaskarray(raster) | outside))
+
+    return rasters
+
+
+def mosaic_fields(
+        product_paths: Sequence[Path],
+        geometries: Sequence[dict],
+        resolution: int,
+        bands: Sequence[str] = None,
+        zipped: bool = False,
+        resampling: Resampling = Resampling.nearest,
+        crs: CRS = None
+) -> List[Dict[str, Band]]:
+    """Clip the bands of fields straddling several tiles of the same date.
+
+    The fields are clipped on a grid of the first product (see get_field_grids),
+    reading only the windows overlapping them from every product, so no
+    virtual mosaic of the full tiles is built. The products in another crs
+    (an adjacent UTM zone) or without a file at the resolution are warped
+    to the grid over the field windows only. The bands are georeferenced
+    in the crs of the first product.
+
+    Args:
+        product_paths (Sequence[Path]): The SAFE directories (or zip files)
+            of the products, the one covering most of the fields first.
+        geometries (Sequence[dict]): The geojson like geometries of the fields.
+        resolution (int): The bands resolution in meters.
+        bands (Sequence[str]): The names of the desired bands. Defaults to
+            the bands found in every product.
+        zipped (bool): Also look for the bands inside the zipped products.
+        resampling (Resampling): The kernel used to warp the products.
+        crs (CRS): The crs of the geometries. Defaults to the crs of the
+            first product.
+
+    Returns:
+        A list with a dict of every field bands, in the same order as the
+            geometries.
+    """
+    band_paths = [
+        get_band_paths(Path(product_path), resolution, bands, zipped=zipped, any_resolution=True)
+        for product_path in product_paths
+    ]
+    names = sorted(set.intersection(*(set(paths) for paths in band_paths))) if band_paths else []
+    fields_bands = [{} for _ in geometries]
+    if not names:
+        return fields_bands
+
+    grids, crs, geometries = get_field_grids(
+        [paths[names[0]] for paths in band_paths], geometries, resolution, crs
+    )
+
+    for name in names:
+        rasters = mosaic_band([paths[name] for paths in band_paths], geometries, grids, crs, resampling)
+        for field_bands, raster, grid in zip(fields_bands, rasters, grids):
+            field_bands[name] = Band(
+                BandNumber(name),
+                resolution,
+                np.ma.getdata(raster),
+                ~np.ma.getmaskarray(raster),
+                grid.transform,
+                crs
+            )
+
+    return fields_bands
+
+
+def get_mosaic_clear_masks(
+        product_paths: Sequence[Path],
+        geometries: Sequence[dict],
+        resolution: int,
+        cloud_mask: CloudMask,
+        zipped: bool = False,
+        crs: CRS = None
+) -> List[Optional[ndarray]]:
+    """Get the clear pixels of fields straddling several tiles of the same date.
+
+    The Scene Classification layers of the products are merged like the
+    bands in mosaic_fields, with the nearest kernel since they are
+    categorical, so the masks have the same shape as the merged bands.
+
+    Raises:
+        FileNotFoundError if a product has no SCL file.
+
+    Returns:
+        A list with a (1, H, W) boolean array of the clear pixels of every
+            field, in the same order as the geometries, or None for the
+            fields under the minimum clear fraction.
+    """
+    images = []
+    for product_path in product_paths:
+        image = get_scl_path(Path(product_path), zipped)
+        if image is None:
+            raise FileNotFoundError(f'No scene classification layer found in {product_path}')
+        images.append(image)
+
+    grids, crs, geometries = get_field_grids(images, geometries, resolution, crs)
+
+    clear_masks = []
+    for scl in mosaic_band(images, geometries, grids, crs, Resampling.nearest):
+        clear = cloud_mask.clear(scl)
+        if cloud_mask.clear_fraction(scl, clear) < cloud_mask.min_clear_fraction:
+            clear = None
+        clear_masks.append(clear)
+
+    return clear_masks
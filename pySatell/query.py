@@ -0,0 +1,476 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from requests.adapters import HTTPAdapter
+from shapely import wkt
+from shapely.ops import unary_union
+
+import asyncio
+import time
+
+import requests
+
+from catalog import ProductCatalog
+from data.config import DEFAULT_SENTINEL_API_URL, read_config
+from downloads import ProductDownload
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+@dataclass(frozen=True)
+class AreaQuery:
+    """The products query of an area of interest, for example a farm.
+
+    Attributes:
+        name (str): The name identifying the area in the results.
+        footprint (str): WKT of the area.
+        date_from (datetime): Starting date of the time window.
+        date_to (datetime): End date of the time window.
+        platform_name (str): The name of the satellite.
+        cloud_coverage_percentage (Tuple): The accepted range of cloud coverage.
+    """
+    name: str
+    footprint: str
+    date_from: datetime
+    date_to: datetime
+    platform_name: str = 'Sentinel-2'
+    cloud_coverage_percentage: Tuple = (0, 100)
+
+
+@dataclass
+class CoalescedQuery:
+    """A hub query covering the footprints and date windows of several area queries.
+
+    Attributes:
+        footprint (str): WKT of the convex hull of the area footprints.
+        date_from (datetime): The earliest starting date of the areas.
+        date_to (datetime): The latest end date of the areas.
+        platform_name (str): The name of the satellite.
+        cloud_coverage_percentage (Tuple): The accepted range of cloud coverage.
+        queries (List[AreaQuery]): The area queries answered by this query.
+    """
+    footprint: str
+    date_from: datetime
+    date_to: datetime
+    platform_name: str
+    cloud_coverage_percentage: Tuple
+    queries: List[AreaQuery] = field(default_factory=list)
+
+
+def coalesce_queries(
+        queries: Iterable[AreaQuery],
+        merge_distance: float = 0.0,
+        max_gap: timedelta = timedelta(0)
+) -> List[CoalescedQuery]:
+    """Merge the area queries with close footprints and overlapping date windows.
+
+    Two queries with the same platform and cloud coverage range are merged
+    when their footprints are within merge_distance (in the units of the
+    footprints, degrees for the hub) and their date windows overlap or are
+    at most max_gap apart. The merging is transitive, so a chain of
+    neighbouring farms becomes a single query.
+
+    Returns:
+        The coalesced queries, in the order of their first area query.
+    """
+    queries = list(queries)
+    geometries = [wkt.loads(query.footprint) for query in queries]
+    parents = list(range(len(queries)))
+
+    def find(position: int) -> int:
+        while parents[position] != position:
+            parents[position] = parents[parents[position]]
+            position = parents[position]
+        return position
+
+    for first in range(len(queries)):
+        for second in range(first + 1, len(queries)):
+            a, b = queries[first], queries[second]
+            if (
+                    (a.platform_name, a.cloud_coverage_percentage) == (b.platform_name, b.cloud_coverage_percentage)
+                    and a.date_from <= b.date_to + max_gap and b.date_from <= a.date_to + max_gap
+                    and geometries[first].distance(geometries[second]) <= merge_distance
+            ):
+                parents[find(second)] = find(first)
+
+    groups: Dict[int, List[int]] = OrderedDict()
+    for position in range(len(queries)):
+        groups.setdefault(find(position), []).append(position)
+
+    coalesced = []
+    for positions in groups.values():
+        members = [queries[position] for position in positions]
+        footprint = members[0].footprint if len(members) == 1 else unary_union(
+            [geometries[position] for position in positions]
+        ).convex_hull.wkt
+        coalesced.append(
+            CoalescedQuery(
+                footprint,
+                min(query.date_from for query in members),
+                max(query.date_to for query in members),
+                members[0].platform_name,
+                members[0].cloud_coverage_percentage,
+                members
+            )
+        )
+
+    return coalesced
+
+
+def fan_out(coalesced: CoalescedQuery, products: Dict[str, dict]) -> Dict[str, Dict[str, dict]]:
+    """Split the products of a coalesced query between its area queries.
+
+    Returns:
+        A dict with the area name as the key and the products intersecting
+            the area footprint, sensed in its date window, as the value.
+    """
+    footprints = {product_id: wkt.loads(properties['footprint']) for product_id, properties in products.items()}
+    results = {}
+
+    for query in coalesced.queries:
+        area = wkt.loads(query.footprint)
+        results[query.name] = OrderedDict(
+            (product_id, properties) for product_id, properties in products.items()
+            if query.date_from <= properties['beginposition'] <= query.date_to
+            and footprints[product_id].intersects(area)
+        )
+
+    return results
+
+
+def format_query(
+        footprint: str,
+        date_from: datetime,
+        date_to: datetime,
+        platform_name: str,
+        cloud_coverage_percentage: Tuple
+) -> str:
+    """Returns the OpenSearch query of an area and a date window, as SentinelAPI.query builds it."""
+    def format_date(date: datetime) -> str:
+        return f'{date:%Y-%m-%dT%H:%M:%S.%f}'[:-3] + 'Z'
+
+    return ' '.join((
+        f'beginPosition:[{format_date(date_from)} TO {format_date(date_to)}]',
+        f'platformname:{platform_name}',
+        f'cloudcoverpercentage:[{cloud_coverage_percentage[0]} TO {cloud_coverage_percentage[1]}]',
+        f'footprint:"Intersects({footprint})"',
+    ))
+
+
+def _parse_date(value: str) -> datetime:
+    """Returns the naive UTC datetime of a hub date, like 2021-01-01T14:01:31.024Z."""
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+
+def parse_opensearch_entry(entry: dict) -> dict:
+    """Convert an OpenSearch entry to the product properties returned by SentinelAPI.query."""
+    properties = {'id': entry['id'], 'title': entry['title']}
+    converters = {'str': str, 'int': int, 'double': float, 'date': _parse_date}
+
+    for kind, convert in converters.items():
+        values = entry.get(kind, [])
+        for value in [values] if isinstance(values, dict) else values:
+            properties[value['name']] = convert(value['content'])
+
+    return properties
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """Returns the seconds to wait before retrying a response, from its Retry-After header.
+
+    The header holds either a number of seconds or an http date. None is
+    returned when there is no header or it cannot be parsed.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RateLimiter:
+    """An asyncio token bucket limiting the requests per second.
+
+    Args:
+        rate (float): Requests allowed per second on average.
+        burst (int): Requests allowed at once after an idle period.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # Created on first use, so the limiter can be built outside the event loop.
+        self._lock = None
+
+    async def acquire(self) -> None:
+        """Wait until a request is allowed."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class AsyncQueryClient:
+    """Queries the products of many areas of interest concurrently.
+
+    The requests go through a single pooled http session, at most
+    max_connections at once and at most `rate` per second. The area
+    queries are coalesced into fewer hub queries (see coalesce_queries),
+    and identical queries in flight at the same time are sent only once.
+    Since the client only needs the hub urls, it can run against any http
+    server implementing the OpenSearch and OData endpoints, like a local
+    mock server.
+
+    The requests are blocking calls of the session, run in a thread pool
+    sized as the connection pool, so the event loop is never blocked. The
+    failed requests are retried with an exponential backoff, and the
+    throttled ones wait at least what their Retry-After header asks.
+
+    Args:
+        api_url (str): The hub url. Defaults to the config.ini one.
+        user (str): The hub user. Defaults to the config.ini one.
+        password (str): The hub password. Defaults to the config.ini one.
+        max_connections (int): Maximum number of simultaneous requests.
+        rate (float): Maximum number of requests per second.
+        burst (int): Requests allowed at once after an idle period.
+        page_size (int): Products requested per OpenSearch page.
+        max_attempts (int): Maximum number of attempts for every request.
+        backoff (float): Seconds waited after the first failed attempt,
+            doubled after every new failure.
+        timeout (float): Seconds waited for every response.
+    """
+
+    def __init__(
+            self,
+            api_url: str = None,
+            user: str = None,
+            password: str = None,
+            max_connections: int = 8,
+            rate: float = 2.0,
+            burst: int = 4,
+            page_size: int = 100,
+            max_attempts: int = 5,
+            backoff: float = 2.0,
+            timeout: float = 60
+    ):
+        config = read_config()
+        self.api_url = (api_url or config.get('API_URL', DEFAULT_SENTINEL_API_URL)).rstrip('/') + '/'
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(rate, burst)
+
+        self.session = requests.Session()
+        self.session.auth = (user or config.get('API_USER'), password or config.get('API_PASSWORD'))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_connections)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    async def __aenter__(self) -> 'AsyncQueryClient':
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    def close(self) -> None:
+        """Wait for the pending requests and close the session. Blocking, see aclose."""
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+    async def aclose(self) -> None:
+        """Close the client without blocking the event loop while the pending requests end."""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def _request(self, method: str, url: str, **kwargs) -> dict:
+        """Send a rate limited request, retrying the throttled and failed ones.
+
+        Raises:
+            requests.RequestException if the request failed after all the attempts.
+
+        Returns:
+            The decoded JSON response.
+        """
+        loop = asyncio.get_running_loop()
+
+        for attempt in range(self.max_attempts):
+            await self.rate_limiter.acquire()
+            try:
+                response = await loop.run_in_executor(
+                    self._executor, partial(self.session.request, method, url, timeout=self.timeout, **kwargs)
+                )
+                if response.status_code in RETRY_STATUS_CODES and attempt < self.max_attempts - 1:
+                    raise requests.HTTPError(f'{response.status_code} for {url}', response=response)
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as error:
+                if attempt == self.max_attempts - 1:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                if error.response is not None and error.response.status_code == 429:
+                    delay = max(delay, get_retry_after(error.response) or 0.0)
+                await asyncio.sleep(delay)
+
+    async def _search_page(self, query: str, start: int) -> dict:
+        return (await self._request(
+            'POST',
+            f'{self.api_url}search',
+            params={'format': 'json', 'rows': self.page_size, 'start': start},
+            data={'q': query},
+            headers={'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8'}
+        ))['feed']
+
+    async def _query(self, query: str) -> Dict[str, dict]:
+        first_page = await self._search_page(query, 0)
+        total = int(first_page.get('opensearch:totalResults', 0))
+        # The remaining pages are requested concurrently once the total is known.
+        pages = [first_page] + list(await asyncio.gather(
+            *(self._search_page(query, start) for start in range(self.page_size, total, self.page_size))
+        ))
+
+        products = OrderedDict()
+        for page in pages:
+            entries = page.get('entry', [])
+            for entry in [entries] if isinstance(entries, dict) else entries:
+                properties = parse_opensearch_entry(entry)
+                products[properties['id']] = properties
+        return products
+
+    async def query(
+            self,
+            footprint: str,
+            date_from: datetime,
+            date_to: datetime,
+            platform_name: str = 'Sentinel-2',
+            cloud_coverage_percentage: Tuple = (0, 100)
+    ) -> Dict[str, dict]:
+        """Query the products of an area and a date window, like SentinelAPI.query.
+
+        Concurrent calls with the same arguments share a single request.
+
+        Returns:
+            An OrderedDict with the product id as the key and its properties
+                as the value.
+        """
+        query = format_query(footprint, date_from, date_to, platform_name, cloud_coverage_percentage)
+
+        if query not in self._in_flight:
+            task = asyncio.ensure_future(self._query(query))
+            self._in_flight[query] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(query, None))
+
+        # A cancelled caller does not cancel the request shared with the others.
+        return await asyncio.shield(self._in_flight[query])
+
+    async def query_areas(
+            self,
+            queries: Iterable[AreaQuery],
+            merge_distance: float = 0.0,
+            max_gap: timedelta = timedelta(0),
+            catalog: ProductCatalog = None
+    ) -> Dict[str, Dict[str, dict]]:
+        """Query the products of many areas, coalescing the close ones into fewer queries.
+
+        Args:
+            queries (Iterable[AreaQuery]): The queries of the areas.
+            merge_distance (float): Maximum distance between footprints
+                merged into the same query.
+            max_gap (timedelta): Maximum gap between date windows merged
+                into the same query.
+            catalog (ProductCatalog): Optional local catalog where the
+                returned products are added.
+
+        Returns:
+            A dict with the area name as the key and its products, as
+                returned by query, as the value.
+        """
+        coalesced = coalesce_queries(queries, merge_distance, max_gap)
+        results = await asyncio.gather(
+            *(
+                self.query(
+                    merged.footprint,
+                    merged.date_from,
+                    merged.date_to,
+                    merged.platform_name,
+                    merged.cloud_coverage_percentage
+                )
+                for merged in coalesced
+            )
+        )
+
+        areas_products = {}
+        for merged, products in zip(coalesced, results):
+            if catalog is not None:
+                catalog.add_products(products)
+            areas_products.update(fan_out(merged, products))
+
+        return areas_products
+
+    async def get_product_download(self, product_id: str) -> ProductDownload:
+        """Get the download information of a product from the OData endpoint."""
+        odata = (await self._request('GET', f"{self.api_url}odata/v1/Products('{product_id}')?$format=json"))['d']
+        checksum = odata.get('Checksum') or {}
+        return ProductDownload(
+            id=odata['Id'],
+            title=odata['Name'],
+            url=f"{self.api_url}odata/v1/Products('{product_id}')/$value",
+            md5=checksum.get('Value'),
+            size=int(odata['ContentLength']) if odata.get('ContentLength') is not None else None
+        )
+
+    async def get_products_downloads(self, products: Iterable[str]) -> List[ProductDownload]:
+        """Get the download information of several products concurrently.
+
+        The returned downloads can be passed to a DownloadScheduler built
+        with the session of this client, sharing its connection pool.
+        """
+        return list(await asyncio.gather(*(self.get_product_download(product_id) for product_id in products)))
+
+
+def get_products_by_areas(
+        queries: Iterable[AreaQuery],
+        merge_distance: float = 0.0,
+        max_gap: timedelta = timedelta(0),
+        catalog: ProductCatalog = None,
+        **client_options
+) -> Dict[str, Dict[str, dict]]:
+    """Blocking version of AsyncQueryClient.query_areas, for callers outside an event loop.
+
+    Args:
+        client_options: Keyword arguments of the AsyncQueryClient.
+    """
+    async def query_areas() -> Dict[str, Dict[str, dict]]:
+        async with AsyncQueryClient(**client_options) as client:
+            return await client.query_areas(queries, merge_distance, max_gap, catalog)
+
+    return asyncio.run(query_areas())
@@ -0,0 +1,177 @@
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from functools import lru_cache
+from itertools import repeat
+from pathlib import Path
+from typing import Iterable, List, Tuple
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import Colormap
+from matplotlib.figure import Figure
+from numpy import ndarray
+from PIL import Image
+
+import numpy as np
+
+from classification import NDVI_BREAKPOINTS, NODATA_CLASS, classify
+from colormaps import ndvi_cmap
+
+
+class RenderStyle(Enum):
+    """Enum used to represent how an index raster is rendered.
+
+    CLASSES colors the index classes delimited by the NDVI breakpoints, and
+    HEAT_MAP stretches the colormap between the 1st and 99th percentiles.
+    """
+    CLASSES = 'classes'
+    HEAT_MAP = 'heat_map'
+
+
+@dataclass
+class Quicklook:
+    """An index raster to render.
+
+    Attributes:
+        path (Path): Path of the output image. Its suffix (.png or .webp)
+            selects the format.
+        raster (ndarray): The (1, H, W) or (H, W) index raster, with NaN (or
+            masked pixels) as nodata.
+        title (str): Title drawn when the axes decorations are rendered.
+    """
+    path: Path
+    raster: ndarray
+    title: str = ''
+
+
+def colormap_lut(cmap: Colormap = ndvi_cmap, size: int = 256) -> ndarray:
+    """Returns the (size, 4) uint8 RGBA lookup table of a colormap."""
+    return cmap(np.linspace(0, 1, size), bytes=True)
+
+
+NDVI_LUT = colormap_lut(ndvi_cmap)
+
+
+def _stretch_limits(raster: ndarray) -> Tuple[float, float]:
+    values = raster[~np.isnan(raster)]
+    if not values.size:
+        return 0.0, 1.0
+    return tuple(np.percentile(values, (1, 99)))
+
+
+def _lut_positions(raster: ndarray, style: RenderStyle, size: int) -> Tuple[ndarray, ndarray]:
+    """Returns the lookup table position of every pixel, and the nodata pixels."""
+    nodata = np.isnan(raster)
+
+    if style is RenderStyle.CLASSES:
+        classes = classify(raster)
+        # The classes are spread over the whole colormap, as imshow does.
+        positions = classes.astype(np.intp) * (size - 1) // len(NDVI_BREAKPOINTS)
+        positions[classes == NODATA_CLASS] = 0
+        return positions, nodata
+
+    vmin, vmax = _stretch_limits(raster)
+    scaled = np.subtract(raster, vmin, dtype=np.float32)
+    scaled *= (size - 1) / (vmax - vmin) if vmax > vmin else 0
+    np.clip(scaled, 0, size - 1, out=scaled)
+    scaled[nodata] = 0
+    return scaled.astype(np.intp), nodata
+
+
+def render_rgba(raster: ndarray, style: RenderStyle = RenderStyle.HEAT_MAP, lut: ndarray = NDVI_LUT) -> ndarray:
+    """Color an index raster through the lookup table of a colormap.
+
+    Args:
+        raster (ndarray): The (1, H, W) or (H, W) index raster, with NaN (or
+            masked pixels) as nodata.
+        style (RenderStyle): How the values are mapped to colors.
+        lut (ndarray): The RGBA lookup table, as returned by colormap_lut.
+
+    Returns:
+        A (H, W, 4) uint8 RGBA image, transparent in the nodata pixels.
+    """
+    raster = np.ma.filled(raster, np.nan) if np.ma.isMaskedArray(raster) else np.asarray(raster)
+    raster = raster.reshape(raster.shape[-2:])
+
+    positions, nodata = _lut_positions(raster, style, len(lut))
+    rgba = lut[positions]
+    rgba[nodata, 3] = 0
+    return rgba
+
+
+@lru_cache(maxsize=None)
+def _figure() -> tuple:
+    """Returns the figure reused by every decorated quicklook of a process."""
+    figure = Figure(figsize=(6, 5), dpi=100)
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    image = axes.imshow(np.zeros((1, 1)), cmap=ndvi_cmap)
+    colorbar = figure.colorbar(image, ax=axes)
+    return figure, axes, image, colorbar
+
+
+def render_figure(quicklook: Quicklook, style: RenderStyle = RenderStyle.HEAT_MAP) -> Path:
+    """Render a quicklook with axes, title and colorbar on the Agg backend."""
+    figure, axes, image, colorbar = _figure()
+    raster = np.ma.filled(quicklook.raster, np.nan) if np.ma.isMaskedArray(quicklook.raster) else quicklook.raster
+    raster = np.asarray(raster).reshape(raster.shape[-2:])
+
+    if style is RenderStyle.CLASSES:
+        image.set_data(np.ma.masked_equal(classify(raster), NODATA_CLASS))
+        image.set_clim(0, len(NDVI_BREAKPOINTS))
+    else:
+        image.set_data(raster)
+        image.set_clim(*_stretch_limits(raster))
+    image.set_extent((-0.5, raster.shape[1] - 0.5, raster.shape[0] - 0.5, -0.5))
+    axes.set_title(quicklook.title)
+    colorbar.update_normal(image)
+
+    figure.savefig(quicklook.path)
+    return quicklook.path
+
+
+def render_quicklook(
+        quicklook: Quicklook,
+        style: RenderStyle = RenderStyle.HEAT_MAP,
+        decorations: bool = False
+) -> Path:
+    """Write a quicklook image.
+
+    Without decorations the RGBA pixels are written directly, one image
+    pixel per raster pixel, without building any figure.
+
+    Returns:
+        The path of the written image.
+    """
+    path = Path(quicklook.path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    if decorations:
+        return render_figure(quicklook, style)
+
+    Image.fromarray(render_rgba(quicklook.raster, style)).save(path)
+    return path
+
+
+def render_quicklooks(
+        quicklooks: Iterable[Quicklook],
+        style: RenderStyle = RenderStyle.HEAT_MAP,
+        decorations: bool = False,
+        workers: int = 1
+) -> List[Path]:
+    """Write several quicklook images, in parallel worker processes.
+
+    Every worker reuses the same figure and colormap lookup table for all
+    the quicklooks it renders.
+
+    Returns:
+        The paths of the written images, in the same order as the quicklooks.
+    """
+    quicklooks = list(quicklooks)
+    arguments = (quicklooks, repeat(style), repeat(decorations))
+
+    if workers > 1 and len(quicklooks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(render_quicklook, *arguments, chunksize=max(len(quicklooks) // workers, 1)))
+
+    return list(map(render_quicklook, *arguments))
@@ -0,0 +1,200 @@
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from rasterio.crs import CRS
+from rasterio.warp import transform_geom
+from shapely.geometry import box, mapping, shape
+from shapely.geometry.base import BaseGeometry
+
+import rasterio
+
+from clipping import get_band_paths, get_product_paths
+from models import FieldData, Fields
+from timeseries import get_sensing_date
+
+
+@dataclass
+class ProductWork:
+    """A work unit of the tile aware scheduling.
+
+    Attributes:
+        product (str): The product name.
+        path (Path): The SAFE directory (or zip file) of the product.
+        footprint (BaseGeometry): The extent of the product tile, in the
+            crs of the fields.
+        fields (List[FieldData]): The fields processed with this product.
+        geometries (List[dict]): The geometries of the fields in the crs
+            of the product bands, the ones to clip.
+    """
+    product: str
+    path: Path
+    footprint: BaseGeometry
+    fields: List[FieldData]
+    geometries: List[dict]
+
+
+@dataclass
+class MosaicWork:
+    """A work unit of fields straddling several tiles of the same date.
+
+    Attributes:
+        products (List[str]): The product names, the one covering most of
+            the fields first.
+        paths (List[Path]): The SAFE directories (or zip files) of the products.
+        fields (List[FieldData]): The fields merged from these products.
+        crs (CRS): The crs of the field geometries. Their rasters are merged
+            on a grid of the first product (see get_field_grids).
+    """
+    products: List[str]
+    paths: List[Path]
+    fields: List[FieldData]
+    crs: CRS
+
+    @property
+    def product(self) -> str:
+        """Returns the name of the merged products, joined with a '+'."""
+        return '+'.join(self.products)
+
+
+def get_product_footprint(
+        product_path: Union[Path, str],
+        resolution: int,
+        zipped: bool = False,
+        crs: CRS = None
+) -> Optional[Tuple[BaseGeometry, CRS]]:
+    """Returns the extent of the tile of a product, read from the header of one of its bands.
+
+    Args:
+        product_path (Union[Path, str]): The SAFE directory (or zip file)
+            of the product.
+        resolution (int): The bands resolution in meters.
+        zipped (bool): Also look for the bands inside the zipped product.
+        crs (CRS): The crs of the returned extent. Defaults to the crs of
+            the bands.
+
+    Returns:
+        The extent as a polygon and the crs of the bands, or None if the
+            product has no band.
+    """
+    band_paths = get_band_paths(Path(product_path), resolution, zipped=zipped, any_resolution=True)
+    if not band_paths:
+        return None
+
+    with rasterio.open(next(iter(band_paths.values()))) as dataset:
+        footprint = box(*dataset.bounds)
+        if crs is not None and crs != dataset.crs:
+            footprint = shape(transform_geom(dataset.crs, crs, mapping(footprint)))
+        return footprint, dataset.crs
+
+
+def _sensing_day(product: str) -> Optional[date]:
+    """Returns the sensing day of a product, or None if its name is not a sentinel2 product name."""
+    try:
+        return get_sensing_date(product).date()
+    except (IndexError, ValueError):
+        return None
+
+
+def reproject_geometries(geometries: List[dict], source: CRS, target: CRS) -> List[dict]:
+    """Returns the geojson like geometries in the target crs, or the same geometries if the crs are equal."""
+    if source is None or target is None or source == target:
+        return list(geometries)
+    return [transform_geom(source, target, geometry) for geometry in geometries]
+
+
+def _group_by_day(products: List[str]) -> Dict[Union[date, str], List[str]]:
+    """Group product names by sensing day, keeping the products without a sentinel2 name apart."""
+    groups: Dict[Union[date, str], List[str]] = {}
+    for product in products:
+        groups.setdefault(_sensing_day(product) or product, []).append(product)
+    return groups
+
+
+def schedule_products(
+        data_path: Path,
+        fields: Fields,
+        resolution: int,
+        zipped: bool = False,
+        mosaic: bool = True
+) -> List[Union[ProductWork, MosaicWork]]:
+    """Group the fields by the product tiles they have to be clipped from.
+
+    The products are grouped as in Sentinel2Bands, one per SAFE directory
+    (or zip file), and only the fields intersecting the footprint of a
+    tile are considered for it, through the STRtree of the fields. Every
+    field is scheduled once per sensing day it is seen, so all the dates
+    of a tile are processed. Among the tiles of the same day, a field is
+    assigned to the first one (by name) that contains it. If none does,
+    it is merged from all of them (see mosaic_fields), or assigned to the
+    one covering most of it when mosaic is False or only one tile of the
+    day intersects it. Fields outside every footprint are not scheduled.
+    The footprints are reprojected to the crs of the fields (or of the
+    first product, if the fields crs is unknown), and the geometries of
+    every product unit are reprojected to the crs of its bands.
+
+    Args:
+        data_path (Path): Path object where the sentinel2 products are
+            located. A single SAFE directory (or zip file) is scheduled as
+            one product.
+        fields (Fields): The fields to analyze.
+        resolution (int): The bands resolution in meters.
+        zipped (bool): Also schedule the zipped products.
+        mosaic (bool): Merge the fields straddling several tiles of the
+            same day, instead of clipping them from a single tile.
+
+    Returns:
+        A list with a ProductWork for every product with fields, sorted
+            by product name, followed by a MosaicWork for every group of
+            products with straddling fields.
+    """
+    product_paths = get_product_paths(data_path, zipped) or {data_path.stem.replace('.SAFE', ''): data_path}
+
+    crs = CRS.from_user_input(fields.crs) if fields.crs else None
+    footprints: Dict[str, BaseGeometry] = {}
+    products_crs: Dict[str, CRS] = {}
+    candidates: Dict[int, List[str]] = {}
+    for product, product_path in product_paths.items():
+        footprint = get_product_footprint(product_path, resolution, zipped, crs)
+        if footprint is None:
+            continue
+        footprints[product], products_crs[product] = footprint
+        crs = crs or products_crs[product]
+        for field in fields.intersecting(footprints[product]):
+            candidates.setdefault(id(field), []).append(product)
+
+    assigned: Dict[str, List[FieldData]] = {product: [] for product in footprints}
+    mosaics: Dict[Tuple[str, ...], List[FieldData]] = {}
+    for field in fields.fields:
+        if id(field) not in candidates:
+            continue
+        geometry = shape(field.geometry)
+        coverage = {product: footprints[product].intersection(geometry).area for product in candidates[id(field)]}
+
+        # Only one tile (or one mosaic) is used per day, but every day is scheduled.
+        for products in _group_by_day(candidates[id(field)]).values():
+            containing = [product for product in products if footprints[product].contains(geometry)]
+            if containing:
+                assigned[containing[0]].append(field)
+                continue
+
+            products = sorted(products, key=coverage.get, reverse=True)
+            if mosaic and len(products) > 1:
+                mosaics.setdefault(tuple(products), []).append(field)
+            else:
+                assigned[products[0]].append(field)
+
+    return [
+        ProductWork(
+            product,
+            product_paths[product],
+            footprints[product],
+            product_fields,
+            reproject_geometries([field.geometry for field in product_fields], crs, products_crs[product])
+        )
+        for product, product_fields in assigned.items() if product_fields
+    ] + [
+        MosaicWork(list(products), [product_paths[product] for product in products], mosaic_fields, crs)
+        for products, mosaic_fields in mosaics.items()
+    ]
@@ -1,15 +1,27 @@
-import rasterio
-
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
 from datetime import datetime
+from itertools import repeat
 from pathlib import Path
-
-from data import sentinel_api
-from models import Band, BandNumber, Bands, Fields
-
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from cache import ClippedRasterCache
+from catalog import ProductCatalog
+from clipping import ReaderMode, clip_fields, get_product_paths
+from cloudmask import CloudMask, get_clear_masks
+from data import get_sentinel_api
+from downloads import DownloadResult, DownloadScheduler, ProductDownload, get_products_downloads
+from export import IndexEncoding, export_field_indexes, export_mosaic
+from models import Band, BandStack, Bands, FieldData, Fields, get_index_definitions, get_required_bands
+from mosaic import get_mosaic_clear_masks, mosaic_fields
+from scheduling import MosaicWork, ProductWork, schedule_products
+from timeseries import FieldOutcome, TimeSeriesStore
+from zonal import zonal_statistics
+
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
 from sentinelsat import geojson_to_wkt
-from rasterio.mask import mask
 
 
 @dataclass
@@ -23,6 +35,7 @@ class QueryParams:
 class SentinelQueryParams(QueryParams):
     platform_name: str = 'Sentinel-2'
     cloud_coverage_percentage: tuple = (0, 100)
+    catalog: ProductCatalog = None
 
 
 @dataclass
@@ -34,6 +47,14 @@ class ProcessingParams:
 @dataclass
 class SentinelProcessingParams(ProcessingParams):
     resolution: int
+    reader: ReaderMode = ReaderMode.MASK
+    cache: ClippedRasterCache = None
+    zipped: bool = False
+    compact_bands: bool = False
+    spill_directory: Path = None
+    resampling: Resampling = None
+    aligned_directory: Path = None
+    cloud_mask: CloudMask = None
 
 
 @dataclass
@@ -53,41 +74,203 @@ class MSIManagerCreator(ABC):
     def create_msi_image_manager(self):
         pass
 
-    def get_fields(self, processing_params: ProcessingParams):
-        msi_manager = self.create_msi_image_manager()
-        return msi_manager.get_msi_bands(processing_params)
+    def get_product_fields(
+            self,
+            processing_params: ProcessingParams,
+            workers: int = 1,
+            indexes: List[str] = None
+    ) -> Dict[str, List[FieldData]]:
+        """Returns the fields of every product, with the product name as the key.
 
-    def get_indexes(self, processing_params: ProcessingParams):
+        The fields skipped by the cloud mask are included, without bands.
+        """
         msi_manager = self.create_msi_image_manager()
-        bands = msi_manager.get_msi_bands(processing_params)
-        indexes = [
-            index for index in dir(Bands) if callable(getattr(Bands, index)) and index.startswith('__') is False
-        ]
-        calculated_indexes = []
-        for index in indexes:
-            for band in bands:
-                calculated_indexes.append(band.bands.__getattribute__(index)())
+        bands = get_required_bands(indexes)
+        return msi_manager.get_msi_bands(processing_params, workers=workers, bands=bands)
 
-        return calculated_indexes
+    def get_fields(self, processing_params: ProcessingParams, workers: int = 1, indexes: List[str] = None):
+        """Returns the fields with bands of all the products, sorted by product."""
+        product_fields = self.get_product_fields(processing_params, workers=workers, indexes=indexes)
+        return [field for fields in product_fields.values() for field in fields if field.bands is not None]
 
-    def get_new_indexes(self, query_params: QueryParams, processing_params: ProcessingParams):
-        msi_manager = self.create_msi_image_manager()
-        new_images = msi_manager.download_new_images(query_params.desired_zone)
+    def get_indexes(self, processing_params: ProcessingParams, workers: int = 1, indexes: List[str] = None):
+        definitions = get_index_definitions(indexes)
+        fields = self.get_fields(processing_params, workers=workers, indexes=indexes)
 
-        if new_images:
-            msi_manager.download_images(query_params.desired_zone)
-            bands = msi_manager.get_msi_bands(processing_params)
+        calculated_indexes = []
+        for definition in definitions:
+            for field in fields:
+                calculated_indexes.append(definition.function(field.bands))
 
-            indexes = [
-                index for index in dir(Bands) if callable(getattr(Bands, index)) and index.startswith('__') is False
-            ]
+        return calculated_indexes
 
-            calculated_indexes = []
-            for index in indexes:
-                for band in bands:
-                    calculated_indexes.append(band.bands.__getattribute__(index)())
+    def export_indexes(
+            self,
+            processing_params: ProcessingParams,
+            directory: Path,
+            workers: int = 1,
+            indexes: List[str] = None,
+            encoding: IndexEncoding = IndexEncoding.FLOAT32,
+            mosaic: bool = False
+    ) -> List[Path]:
+        """Write the indexes of the fields as georeferenced Cloud Optimized GeoTIFFs.
+
+        The files of every product are written to a `<directory>/<product>`
+        directory, so the dates of a tile do not overwrite each other.
+
+        Args:
+            processing_params (ProcessingParams): The product and fields to process.
+            directory (Path): Directory where the files are written.
+            workers (int): Number of processes used to clip the bands.
+            indexes (List[str]): The names of the indexes. Defaults to all
+                the registered indexes.
+            encoding (IndexEncoding): How the values are stored.
+            mosaic (bool): Write a single `<index>.tif` mosaic with all the
+                fields instead of a file per field and index.
+
+        Returns:
+            The paths of the written files.
+        """
+        product_fields = self.get_product_fields(processing_params, workers=workers, indexes=indexes)
+        paths = []
+
+        for product, fields in product_fields.items():
+            fields = [field for field in fields if field.bands is not None]
+            if not fields:
+                continue
+            product_directory = Path(directory) / product
+            if mosaic:
+                paths += [
+                    export_mosaic(fields, product_directory / f'{definition.name}.tif', definition.name, encoding)
+                    for definition in get_index_definitions(indexes)
+                ]
+            else:
+                field_paths = export_field_indexes(fields, product_directory, indexes, encoding)
+                paths += [path for product_paths in field_paths.values() for path in product_paths]
+
+        return paths
+
+    def get_zonal_statistics(
+            self,
+            processing_params: ProcessingParams,
+            indexes: List[str] = None,
+            percentiles: Sequence[float] = (10, 25, 75, 90)
+    ):
+        msi_manager = self.create_msi_image_manager()
+        return msi_manager.get_zonal_statistics(processing_params, indexes=indexes, percentiles=percentiles)
+
+    def update_time_series(
+            self,
+            processing_params: ProcessingParams,
+            store: TimeSeriesStore,
+            workers: int = 1,
+            indexes: List[str] = None
+    ) -> List[Tuple[str, str, str]]:
+        """Calculate only the indexes missing in a time series store.
+
+        The products under processing_params.data_path are processed one by
+        one. Products whose (field, index) results are all stored are skipped
+        without reading any band, and for the rest only the fields with
+        missing results are clipped. The fields outside the product tile,
+        or skipped by the cloud mask, are recorded as such in the store, so
+        the product is not processed again for them.
+
+        Returns:
+            The (product, field, index) results calculated in this run.
+        """
+        definitions = get_index_definitions(indexes)
+        fields_by_hash = {field.geometry_hash: field for field in processing_params.fields.fields}
+        calculated = []
+
+        for product, product_path in get_product_paths(
+                processing_params.data_path, getattr(processing_params, 'zipped', False)
+        ).items():
+            missing = store.missing(product, fields_by_hash, [definition.name for definition in definitions])
+            if not missing:
+                continue
+
+            missing_fields = Fields.from_field_data(
+                [
+                    field for field_hash, field in fields_by_hash.items()
+                    if any((field_hash, definition.name) in missing for definition in definitions)
+                ],
+                processing_params.fields.crs
+            )
+            product_fields = self.get_product_fields(
+                replace(processing_params, data_path=product_path, fields=missing_fields),
+                workers=workers,
+                indexes=indexes
+            )
+            fields = [field for fields in product_fields.values() for field in fields]
+
+            scheduled = {field.geometry_hash for field in fields}
+            store.record_outcome(
+                product,
+                [field.geometry_hash for field in missing_fields.fields if field.geometry_hash not in scheduled],
+                FieldOutcome.NO_DATA
+            )
+            store.record_outcome(
+                product, [field.geometry_hash for field in fields if field.bands is None], FieldOutcome.SKIPPED
+            )
+
+            for field in fields:
+                if field.bands is None:
+                    continue
+                for definition in definitions:
+                    if (field.geometry_hash, definition.name) in missing:
+                        store.append(product, field.geometry_hash, definition.name, definition.function(field.bands))
+                        calculated.append((product, field.geometry_hash, definition.name))
+
+        return calculated
+
+    def get_new_indexes(
+            self,
+            query_params: QueryParams,
+            processing_params: ProcessingParams,
+            workers: int = 1,
+            indexes: List[str] = None,
+            store: TimeSeriesStore = None
+    ):
+        """Download the new products of the zone and calculate their indexes.
+
+        The downloaded zip files are extracted under the data path, unless
+        the processing params read the zipped products directly. With a
+        store, every missing result of the data path is calculated (see
+        update_time_series). Otherwise only the newly downloaded products
+        are processed.
+
+        Returns:
+            The results calculated by update_time_series with a store, or
+                else the indexes of the new products, as get_indexes returns
+                them.
+        """
+        msi_manager = self.create_msi_image_manager()
+        downloads = msi_manager.download_new_images(query_params, processing_params.data_path) or []
+        new_downloads = [download for download in downloads if not (download.skipped or download.failed)]
+
+        new_paths = []
+        for download in new_downloads:
+            if getattr(processing_params, 'zipped', False):
+                new_paths.append(download.path)
+                continue
+            # Imported here because the utils module needs geopandas.
+            from utils import extract_sentinel2_zip
+
+            bands = get_required_bands(indexes)
+            if getattr(processing_params, 'cloud_mask', None) is not None:
+                bands.append('SCL')
+            extract_sentinel2_zip(download.path, processing_params.data_path, bands=bands)
+            new_paths.append(Path(processing_params.data_path) / f'{download.product.title}.SAFE')
+
+        if store is not None:
+            return self.update_time_series(processing_params, store, workers=workers, indexes=indexes)
 
-            return calculated_indexes
+        calculated_indexes = []
+        for path in new_paths:
+            calculated_indexes += self.get_indexes(
+                replace(processing_params, data_path=path), workers=workers, indexes=indexes
+            )
+        return calculated_indexes
 
 
 class SentinelMSIManagerCreator(MSIManagerCreator):
@@ -105,61 +288,306 @@ class LandsatMSIManagerCreator(MSIManagerCreator):
 class MSIManager(ABC):
 
     @abstractmethod
-    def download_new_images(self, query_params: QueryParams):
+    def download_new_images(self, query_params: QueryParams, directory: Path = Path('.')) -> List[DownloadResult]:
+        pass
+
+    @abstractmethod
+    def get_msi_bands(self, processing_params: ProcessingParams, workers: int = 1, bands: List[str] = None):
         pass
 
     @abstractmethod
-    def get_msi_bands(self, processing_params: ProcessingParams):
+    def get_zonal_statistics(
+            self,
+            processing_params: ProcessingParams,
+            indexes: List[str] = None,
+            percentiles: Sequence[float] = (10, 25, 75, 90)
+    ):
         pass
 
 
 class SentinelMSIManager(MSIManager):
 
-    def download_new_images(self, query_params: SentinelQueryParams):
+    def download_new_images(
+            self,
+            query_params: SentinelQueryParams,
+            directory: Path = Path('.'),
+            max_concurrent: int = 4,
+            progress: Callable[[ProductDownload, int, int], None] = None
+    ) -> List[DownloadResult]:
+        sentinel_api = get_sentinel_api()
         footprint = geojson_to_wkt(query_params.desired_zone)
+        catalog = query_params.catalog
+
+        if catalog is None:
+            products = sentinel_api.query(
+                footprint,
+                date=(
+                    datetime.strftime(query_params.date_from, "%Y%m%d"),
+                    query_params.date_to.date()
+                ),
+                platformname=query_params.platform_name,
+                cloudcoverpercentage=query_params.cloud_coverage_percentage
+            )
+        else:
+            # Only the dates not synced yet are queried, and only the
+            # products not downloaded yet are requested.
+            catalog.sync(
+                sentinel_api,
+                footprint,
+                query_params.date_from,
+                query_params.date_to,
+                query_params.platform_name,
+                query_params.cloud_coverage_percentage
+            )
+            products = [
+                row['id'] for row in catalog.search(
+                    footprint,
+                    query_params.date_from,
+                    query_params.date_to,
+                    query_params.cloud_coverage_percentage,
+                    downloaded=False
+                )
+            ]
 
-        products = sentinel_api.query(
-            footprint,
-            date=(
-                datetime.strftime(query_params.date_from, "%Y%m%d"),
-                query_params.date_to.date()
-            ),
-            platformname=query_params.platform_name,
-            cloudcoverpercentage=query_params.cloud_coverage_percentage
+        scheduler = DownloadScheduler(
+            sentinel_api.session, directory, max_concurrent=max_concurrent, progress=progress
         )
+        downloads = scheduler.download_all(get_products_downloads(sentinel_api, products))
+
+        if catalog is not None:
+            for download in downloads:
+                if not download.failed:
+                    catalog.set_local_path(download.product.id, download.path)
+
+        return downloads
+
+    def get_msi_bands(
+            self,
+            processing_params: SentinelProcessingParams,
+            workers: int = 1,
+            bands: List[str] = None
+    ) -> Dict[str, List[FieldData]]:
+        """Clip the bands of the fields, only from the product tiles they intersect.
+
+        The fields are scheduled to the products under the data path by
+        footprint (see schedule_products), once per date, and the fields
+        straddling tiles of the same day are merged from all of them. With
+        several work units and more than one worker, the units are
+        processed in parallel.
+
+        Returns:
+            A dict with the product name (the merged names, joined with a
+                '+', for the mosaics) as the key and a copy of its scheduled
+                fields, with their bands, as the value. The fields skipped
+                by the cloud mask have no bands.
+        """
+        fields = processing_params.fields
+        work_units = schedule_products(
+            processing_params.data_path, fields, processing_params.resolution, processing_params.zipped
+        )
+        # The product units clip the geometries reprojected to the crs of their bands.
+        units_params = [
+            replace(
+                processing_params,
+                data_path=unit.paths[0] if isinstance(unit, MosaicWork) else unit.path,
+                fields=Fields.from_field_data(
+                    unit.fields if isinstance(unit, MosaicWork) else [
+                        replace(field, geometry=geometry) for field, geometry in zip(unit.fields, unit.geometries)
+                    ],
+                    fields.crs
+                )
+            )
+            for unit in work_units
+        ]
 
-        sentinel_api.download_all(products)
-
-    def get_msi_bands(self, processing_params: SentinelProcessingParams):
-        clipped_rasters = []
-
-        for field in processing_params.fields.fields:
-
-            bands = {}
-            images_paths = processing_params.data_path.glob(f'**/*B*_{processing_params.resolution}m.jp2')
+        if workers > 1 and len(work_units) > 1:
+            # Every unit clips its bands in a single process, to avoid nested pools.
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(
+                    executor.map(self.get_unit_bands, units_params, work_units, repeat(1), repeat(bands))
+                )
+        else:
+            results = (
+                self.get_unit_bands(unit_params, unit, workers, bands)
+                for unit_params, unit in zip(units_params, work_units)
+            )
+
+        product_fields = {}
+        for unit, unit_bands in zip(work_units, results):
+            product_fields[unit.product] = [
+                replace(field, bands=field_bands) for field, field_bands in zip(unit.fields, unit_bands)
+            ]
 
-            for image in images_paths:
-                band = str(image).split('_')[-2]
+        return product_fields
+
+    def get_unit_bands(
+            self,
+            processing_params: SentinelProcessingParams,
+            unit: Union[ProductWork, MosaicWork],
+            workers: int = 1,
+            bands: List[str] = None
+    ) -> List[Optional[Bands]]:
+        """Clip the bands of the fields of a work unit, from one product or merged from several."""
+        if isinstance(unit, MosaicWork):
+            return self.get_mosaic_bands(processing_params, unit.paths, bands, unit.crs)
+        return self.get_product_bands(processing_params, workers, bands)
+
+    def get_product_bands(
+            self,
+            processing_params: SentinelProcessingParams,
+            workers: int = 1,
+            bands: List[str] = None
+    ) -> List[Optional[Bands]]:
+        """Clip the bands of the fields from a single product.
+
+        Returns:
+            The Bands of every field, in the same order as the fields, or
+                None for the fields skipped by the cloud mask.
+        """
+        fields = processing_params.fields.fields
+        positions = list(range(len(fields)))
+
+        clear_masks = None
+        if processing_params.cloud_mask is not None:
+            # The fields under the minimum clear fraction are skipped before
+            # reading any band.
+            clear_masks = get_clear_masks(
+                processing_params.data_path,
+                processing_params.resolution,
+                [field.geometry for field in fields],
+                processing_params.cloud_mask,
+                reader=processing_params.reader,
+                zipped=processing_params.zipped,
+                aligned_directory=processing_params.aligned_directory
+            )
+            positions = [position for position, clear in enumerate(clear_masks) if clear is not None]
+
+        fields_bands = clip_fields(
+            processing_params.data_path,
+            processing_params.resolution,
+            [fields[position].geometry for position in positions],
+            workers=workers,
+            bands=bands,
+            reader=processing_params.reader,
+            cache=processing_params.cache,
+            zipped=processing_params.zipped,
+            resampling=processing_params.resampling,
+            aligned_directory=processing_params.aligned_directory
+        )
 
-                with rasterio.open(image) as f:
-                    clipped_band, _ = mask(f, [field.geometry], crop=True)
+        return self._to_bands(processing_params, positions, fields_bands, clear_masks, 'product')
+
+    def get_mosaic_bands(
+            self,
+            processing_params: SentinelProcessingParams,
+            product_paths: List[Path],
+            bands: List[str] = None,
+            crs: CRS = None
+    ) -> List[Optional[Bands]]:
+        """Merge the bands of fields straddling several tiles of the same day.
+
+        Only the windows of the fields are read from every product (see
+        mosaic_fields), on a grid in the crs of the fields (or of the first
+        product, if it is not given). The merged rasters are not cached.
+
+        Returns:
+            The Bands of every field, in the same order as the fields, or
+                None for the fields skipped by the cloud mask.
+        """
+        fields = processing_params.fields.fields
+        positions = list(range(len(fields)))
+
+        clear_masks = None
+        if processing_params.cloud_mask is not None:
+            clear_masks = get_mosaic_clear_masks(
+                product_paths,
+                [field.geometry for field in fields],
+                processing_params.resolution,
+                processing_params.cloud_mask,
+                zipped=processing_params.zipped,
+                crs=crs
+            )
+            positions = [position for position, clear in enumerate(clear_masks) if clear is not None]
+
+        fields_bands = mosaic_fields(
+            product_paths,
+            [fields[position].geometry for position in positions],
+            processing_params.resolution,
+            bands=bands,
+            zipped=processing_params.zipped,
+            resampling=processing_params.resampling or Resampling.nearest,
+            crs=crs
+        )
 
-                    bands[band] = Band(
-                        BandNumber(band),
-                        processing_params.resolution,
-                        clipped_band
+        return self._to_bands(processing_params, positions, fields_bands, clear_masks, 'mosaic')
+
+    @staticmethod
+    def _to_bands(
+            processing_params: SentinelProcessingParams,
+            positions: List[int],
+            fields_bands: List[Dict[str, Band]],
+            clear_masks: Optional[List],
+            kind: str
+    ) -> List[Optional[Bands]]:
+        """Build the Bands of the clipped fields, stacking (or spilling) them if requested."""
+        fields = processing_params.fields.fields
+        unit_bands = [None] * len(fields)
+        compact = processing_params.compact_bands or processing_params.spill_directory is not None
+        for index, position in enumerate(positions):
+            field_bands = fields_bands[index]
+            if clear_masks is not None:
+                for band in field_bands.values():
+                    band.valid = band.get_valid() & clear_masks[position]
+            if compact and field_bands:
+                path = None
+                if processing_params.spill_directory is not None:
+                    path = Path(processing_params.spill_directory) / (
+                        f'{Path(processing_params.data_path).stem}_{kind}_{position}_'
+                        f'{fields[position].geometry_hash}.npy'
                     )
-
-            field.bands = Bands(**bands)
-            clipped_rasters.append(field)
-
-        return clipped_rasters
+                unit_bands[position] = Bands.from_stack(BandStack.from_bands(field_bands, path))
+            else:
+                unit_bands[position] = Bands(**field_bands)
+            # The per band arrays are released as soon as they are stacked.
+            fields_bands[index] = None
+
+        return unit_bands
+
+    def get_zonal_statistics(
+            self,
+            processing_params: SentinelProcessingParams,
+            indexes: List[str] = None,
+            percentiles: Sequence[float] = (10, 25, 75, 90)
+    ):
+        return zonal_statistics(
+            processing_params.data_path,
+            processing_params.resolution,
+            processing_params.fields,
+            indexes=indexes,
+            percentiles=percentiles,
+            zipped=processing_params.zipped,
+            resampling=processing_params.resampling,
+            aligned_directory=processing_params.aligned_directory
+        )
 
 
 class LandsatMSIManager(MSIManager):
 
-    def download_new_images(self, query_params: QueryParams):
-        pass
-
-    def get_msi_bands(self, processing_params: ProcessingParams):
+    def download_new_images(self, query_params: QueryParams, directory: Path = Path('.')) -> List[DownloadResult]:
+        return []
+
+    def get_msi_bands(
+            self,
+            processing_params: ProcessingParams,
+            workers: int = 1,
+            bands: List[str] = None
+    ) -> Dict[str, List[FieldData]]:
+        return {}
+
+    def get_zonal_statistics(
+            self,
+            processing_params: ProcessingParams,
+            indexes: List[str] = None,
+            percentiles: Sequence[float] = (10, 25, 75, 90)
+    ):
         pass
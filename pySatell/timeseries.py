@@ -0,0 +1,145 @@
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+from typing import Dict, Iterable, List, Set, Tuple
+
+from numpy import ndarray
+
+import os
+import sqlite3
+import numpy as np
+
+
+def get_sensing_date(product: str) -> datetime:
+    """Returns the sensing date encoded in a sentinel2 product name."""
+    return datetime.strptime(product.split('_')[2], "%Y%m%dT%H%M%S")
+
+
+class FieldOutcome(Enum):
+    """Enum used to represent why a product has no results for a field.
+
+    NO_DATA means that the field is outside the product tile, and SKIPPED
+    that the field was skipped by the cloud mask.
+    """
+    NO_DATA = 'no_data'
+    SKIPPED = 'skipped'
+
+
+class TimeSeriesStore:
+    """Per field time series of the calculated indexes.
+
+    Every (product, field, index) result is stored as a .npy file under
+    `<directory>/<field>/<index>/`, and a SQLite manifest records which
+    results already exist, so a pipeline can compute only the missing ones.
+    The fields a product has no results for are recorded with their
+    outcome, so they are not missing in the next runs either. Fields are
+    identified by their geometry hash.
+
+    Args:
+        directory (Path): Directory of the store. It is created if it does
+            not exist.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(str(self.directory / 'manifest.sqlite'))
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    product TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    index_name TEXT NOT NULL,
+                    sensing_date TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    PRIMARY KEY (product, field, index_name)
+                )
+                """
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS results_series ON results (field, index_name, sensing_date)'
+            )
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outcomes (
+                    product TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    outcome TEXT NOT NULL,
+                    PRIMARY KEY (product, field)
+                )
+                """
+            )
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def existing(self, product: str) -> Set[Tuple[str, str]]:
+        """Returns the (field, index) results already stored for a product."""
+        rows = self.connection.execute(
+            'SELECT field, index_name FROM results WHERE product = ?', (product,)
+        )
+        return set(rows)
+
+    def missing(self, product: str, fields: Iterable[str], indexes: Iterable[str]) -> Set[Tuple[str, str]]:
+        """Returns the (field, index) results not stored yet for a product.
+
+        The fields with a recorded outcome for the product are not missing.
+        """
+        without_results = self.outcomes(product)
+        return {
+            (field, index) for field in fields if field not in without_results for index in indexes
+        } - self.existing(product)
+
+    def record_outcome(self, product: str, fields: Iterable[str], outcome: FieldOutcome) -> None:
+        """Record that a product has no results for some fields, and why."""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?)',
+                ((product, field, outcome.value) for field in fields)
+            )
+
+    def outcomes(self, product: str) -> Dict[str, FieldOutcome]:
+        """Returns the outcome of the fields without results for a product."""
+        rows = self.connection.execute('SELECT field, outcome FROM outcomes WHERE product = ?', (product,))
+        return {field: FieldOutcome(outcome) for field, outcome in rows}
+
+    def append(self, product: str, field: str, index: str, raster: ndarray) -> Path:
+        """Store the index raster of a field for a product.
+
+        Returns:
+            The path of the stored raster.
+        """
+        sensing_date = get_sensing_date(product)
+        path = self.directory / field / index / f'{sensing_date:%Y%m%dT%H%M%S}_{product}.npy'
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        partial_path = path.with_name(f'{path.stem}.{os.getpid()}.partial')
+        with open(partial_path, 'wb') as file:
+            np.save(file, np.ma.filled(raster, np.nan) if np.ma.isMaskedArray(raster) else raster)
+        os.replace(partial_path, path)
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                (product, field, index, sensing_date.isoformat(), str(path.relative_to(self.directory)))
+            )
+
+        return path
+
+    def get_series(self, field: str, index: str) -> List[Tuple[datetime, ndarray]]:
+        """Returns the time series of an index for a field.
+
+        Returns:
+            A list of (sensing date, memory mapped raster) tuples sorted
+                by date.
+        """
+        rows = self.connection.execute(
+            'SELECT sensing_date, path FROM results WHERE field = ? AND index_name = ? ORDER BY sensing_date',
+            (field, index)
+        )
+        return [
+            (datetime.fromisoformat(sensing_date), np.load(self.directory / path, mmap_mode='r'))
+            for sensing_date, path in rows
+        ]
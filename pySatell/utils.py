@@ -1,8 +1,12 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
-from typing import Generator, Dict, Tuple
+from typing import Generator, Dict, Iterable, List, Optional, Set, Tuple
 from datetime import datetime
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
-from data import config
+from sentinelsat import read_geojson, geojson_to_wkt
+from catalog import ProductCatalog
+from data import get_sentinel_api
 
 import geopandas
 import itertools
@@ -64,7 +68,8 @@ def get_products_by_date_and_area(
         date_to: datetime,
         geojson_path: Path,
         platform_name: str,
-        cloud_coverage_percentage: Tuple = (0, 100)
+        cloud_coverage_percentage: Tuple = (0, 100),
+        catalog: ProductCatalog = None
 ) -> Dict[str, dict]:
     """Gets the available products for a specific date and specifics coordinates.
 
@@ -84,13 +89,24 @@ def get_products_by_date_and_area(
         cloud_coverage_percentage (Tuple): Percentage of cloud coverage of S2 products for
             each area covered by a reference band. Possible values go from 0 to 100.
 
+        catalog (ProductCatalog): Optional local catalog. When given, only the dates not
+            synced yet for the area are queried, and the products are read from the catalog.
+
     Returns:
         An OrderedDict with information of all the available products for the desired
-            date and area.
+            date and area. With a catalog, the information is the catalog row of every product.
     """
-    api = SentinelAPI(config.API_USER, config.API_PASSWORD, config.SENTINEL_API_URL)
+    api = get_sentinel_api()
 
     footprint = geojson_to_wkt(read_geojson(geojson_path))
+
+    if catalog is not None:
+        catalog.sync(api, footprint, date_from, date_to, platform_name, cloud_coverage_percentage)
+        return OrderedDict(
+            (row['id'], dict(row))
+            for row in catalog.search(footprint, date_from, date_to, cloud_coverage_percentage)
+        )
+
     products = api.query(
         footprint,
         date=(datetime.strftime(date_from, "%Y%m%d"), date_to.date()),
@@ -101,15 +117,83 @@ def get_products_by_date_and_area(
     return products
 
 
-def unzip_sentinel2_data(directory: Path) -> None:
+def _is_band_member(name: str, bands: Optional[Set[str]], resolution: Optional[int]) -> bool:
+    """Returns True if a zip member is an image of the desired bands and resolution."""
+    if 'IMG_DATA' not in name or not name.endswith('.jp2'):
+        return False
+
+    parts = name.split('/')[-1][:-len('.jp2')].split('_')
+    if parts[-1].endswith('m') and parts[-1][:-1].isdigit():
+        band, band_resolution = parts[-2], int(parts[-1][:-1])
+    else:
+        band, band_resolution = parts[-1], None
+
+    return (
+            (bands is None or band in bands)
+            and (resolution is None or band_resolution is None or band_resolution == resolution)
+    )
+
+
+def extract_sentinel2_zip(
+        zip_path: Path,
+        directory: Path,
+        bands: Iterable[str] = None,
+        resolution: int = None
+) -> List[Path]:
+    """Extract the desired members of a zip file containing sentinel 2 data.
+
+    When neither bands nor resolution are given, the whole product is
+    extracted. Otherwise only the IMG_DATA images matching them are.
+    Members already extracted (with the same size) are skipped, so running
+    it again over an extracted product does not write anything.
+
+    Args:
+        zip_path (Path): Path of the zip file.
+        directory (Path): Directory where the members are extracted.
+        bands (Iterable[str]): The names of the bands to extract.
+        resolution (int): The resolution of the bands to extract.
+
+    Returns:
+        The paths of the newly extracted files.
+    """
+    bands = None if bands is None else set(bands)
+    selective = bands is not None or resolution is not None
+    extracted = []
+
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            if member.is_dir() or (selective and not _is_band_member(member.filename, bands, resolution)):
+                continue
+
+            target = directory / member.filename
+            if target.exists() and target.stat().st_size == member.file_size:
+                continue
+
+            extracted.append(Path(zip_ref.extract(member, directory)))
+
+    return extracted
+
+
+def unzip_sentinel2_data(
+        directory: Path,
+        bands: Iterable[str] = None,
+        resolution: int = None,
+        workers: int = 1
+) -> None:
     """Unzip all the zip files containing sentinel 2 data in a directory.
 
     Args:
         directory (Path): Path of a directory containing the zip files to
             extract.
+        bands (Iterable[str]): The names of the bands to extract. Defaults
+            to all of them.
+        resolution (int): The resolution of the bands to extract. Defaults
+            to all of them.
+        workers (int): Number of zip files extracted at the same time.
     """
-    zipfiles = directory.glob('**/*.zip')
+    zipfiles = list(directory.glob('**/*.zip'))
 
-    for zipfile_ in zipfiles:
-        with zipfile.ZipFile(zipfile_, 'r') as zip_ref:
-            zip_ref.extractall(directory)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(
+            extract_sentinel2_zip, zipfiles, repeat(directory), repeat(bands), repeat(resolution)
+        ))
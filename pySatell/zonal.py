@@ -0,0 +1,250 @@
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Union
+
+from numpy import ndarray
+from rasterio.enums import Resampling
+from rasterio.features import geometry_window, rasterize
+from rasterio.windows import Window, union
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from alignment import align_band_paths, default_aligned_directory
+from clipping import get_band_paths
+from indexes import compute_indexes
+from models import Band, BandNumber, Bands, FieldData, Fields, get_index_definitions, get_required_bands
+from scheduling import schedule_products
+
+
+def _group_percentiles(sorted_values: ndarray, starts: ndarray, counts: ndarray, percentile: float) -> ndarray:
+    """Linearly interpolated percentile of every group of a grouped, sorted array."""
+    result = np.full(len(counts), np.nan)
+    present = counts > 0
+
+    position = starts[present] + (counts[present] - 1) * percentile / 100
+    lower = np.floor(position).astype(np.intp)
+    upper = np.ceil(position).astype(np.intp)
+    fraction = position - lower
+
+    result[present] = sorted_values[lower] * (1 - fraction) + sorted_values[upper] * fraction
+    return result
+
+
+def zonal_reduce(
+        values: ndarray,
+        labels: ndarray,
+        groups: int,
+        percentiles: Sequence[float] = (10, 25, 75, 90)
+) -> Dict[str, ndarray]:
+    """Calculate the statistics of the values of every label in one pass.
+
+    The counts, means and standard deviations come from bincount
+    reductions, and the median and percentiles from a single sort of the
+    values by label.
+
+    Args:
+        values (ndarray): The values, with the same shape as the labels.
+        labels (ndarray): The label (1 to groups) of every value. Values
+            labeled with 0 or that are not finite are ignored.
+        groups (int): The number of labels.
+        percentiles (Sequence[float]): The percentiles to calculate besides
+            the median.
+
+    Returns:
+        A dict with the name of the statistic as the key and an array with
+            the statistic of every label as the value.
+    """
+    values = values.ravel()
+    labels = labels.ravel()
+    valid = (labels > 0) & np.isfinite(values)
+    values = values[valid].astype(np.float64)
+    labels = labels[valid] - 1
+
+    counts = np.bincount(labels, minlength=groups)
+    sums = np.bincount(labels, weights=values, minlength=groups)
+    squares = np.bincount(labels, weights=values * values, minlength=groups)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        stds = np.sqrt(np.maximum(squares / counts - means * means, 0))
+
+    sorted_values = values[np.lexsort((values, labels))]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    statistics = {
+        'count': counts,
+        'mean': means,
+        'std': stds,
+        'median': _group_percentiles(sorted_values, starts, counts, 50),
+    }
+    for percentile in percentiles:
+        statistics[f'p{percentile:g}'] = _group_percentiles(sorted_values, starts, counts, percentile)
+
+    return statistics
+
+
+def batch_windows(windows: List[Window], max_pixels: int) -> List[List[int]]:
+    """Group nearby windows into batches whose union window has at most max_pixels.
+
+    The windows are visited row by row, so the fields of a batch are close
+    to each other. A window larger than max_pixels gets a batch of its own.
+
+    Returns:
+        The positions of the windows of every batch.
+    """
+    batches = []
+    batch, bounds = [], None
+    order = sorted(range(len(windows)), key=lambda position: (windows[position].row_off, windows[position].col_off))
+    for position in order:
+        candidate = windows[position] if bounds is None else union(bounds, windows[position])
+        if batch and candidate.width * candidate.height > max_pixels:
+            batches.append(batch)
+            batch, candidate = [], windows[position]
+        batch.append(position)
+        bounds = candidate
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def product_statistics(
+        band_paths: Dict[str, Union[Path, str]],
+        resolution: int,
+        fields: List[FieldData],
+        geometries: List[dict],
+        indexes: Sequence[str],
+        percentiles: Sequence[float] = (10, 25, 75, 90),
+        max_pixels: int = 2048 * 2048
+) -> List[pd.DataFrame]:
+    """Calculate the statistics of the indexes of the fields of a single product.
+
+    The fields are grouped into batches of nearby fields (see
+    batch_windows). Every band is read once per batch, in the window
+    covering its fields, and the fields are rasterized into a label raster
+    over that same window. The indexes are calculated once for the window
+    and reduced per field, so the memory is bounded by max_pixels whatever
+    the spread of the fields. Pixels of overlapping fields of a batch are
+    assigned to the last of them.
+
+    Args:
+        band_paths (Dict[str, Union[Path, str]]): The band files of the
+            product, all on the same grid.
+        resolution (int): The bands resolution in meters.
+        fields (List[FieldData]): The fields to analyze.
+        geometries (List[dict]): The geometries of the fields, in the crs
+            of the bands.
+        indexes (Sequence[str]): The names of the indexes.
+        percentiles (Sequence[float]): The percentiles to calculate besides
+            the median.
+        max_pixels (int): The maximum size of the window read at once.
+
+    Returns:
+        A DataFrame per batch and index, with a row per field.
+    """
+    tables = []
+
+    with ExitStack() as stack:
+        datasets = {band: stack.enter_context(rasterio.open(image)) for band, image in band_paths.items()}
+        first = next(iter(datasets.values()))
+        windows = [geometry_window(first, [geometry]) for geometry in geometries]
+
+        for batch in batch_windows(windows, max_pixels):
+            window = union(*(windows[position] for position in batch))
+            bands = {}
+            for band, dataset in datasets.items():
+                raster = dataset.read(window=window, masked=True)
+                bands[band] = Band(BandNumber(band), resolution, np.ma.getdata(raster), ~np.ma.getmaskarray(raster))
+            labels = rasterize(
+                ((geometries[position], label) for label, position in enumerate(batch, 1)),
+                out_shape=(int(window.height), int(window.width)),
+                transform=first.window_transform(window),
+                dtype='int32'
+            )
+
+            for name, index_raster in zip(indexes, compute_indexes(Bands(**bands), indexes)):
+                table = pd.DataFrame(zonal_reduce(index_raster[0], labels, len(batch), percentiles))
+                table.insert(0, 'index', name)
+                table.insert(0, 'farm_name', [fields[position].farm_name for position in batch])
+                table.insert(0, 'field', [fields[position].geometry_hash for position in batch])
+                tables.append(table)
+
+    return tables
+
+
+def zonal_statistics(
+        data_path: Path,
+        resolution: int,
+        fields: Fields,
+        indexes: Iterable[str] = None,
+        percentiles: Sequence[float] = (10, 25, 75, 90),
+        zipped: bool = False,
+        resampling: Resampling = None,
+        aligned_directory: Path = None,
+        max_pixels: int = 2048 * 2048
+) -> pd.DataFrame:
+    """Calculate the statistics of the indexes of every field, for every product.
+
+    The fields are scheduled to the product tiles they intersect (see
+    schedule_products, without mosaics: a field straddling tiles of the
+    same day is reduced in the tile covering most of it), and the
+    statistics of every product are calculated in windows of nearby
+    fields (see product_statistics).
+
+    Args:
+        data_path (Path): Path object where the sentinel2
+            bands information is located.
+        resolution (int): The bands resolution in meters.
+        fields (Fields): The fields to analyze.
+        indexes (Iterable[str]): The names of the indexes. Defaults to all
+            the registered indexes.
+        percentiles (Sequence[float]): The percentiles to calculate besides
+            the median.
+        zipped (bool): Also read the bands directly from the zipped products.
+        resampling (Resampling): Optional kernel used to align the bands
+            without a file at the resolution.
+        aligned_directory (Path): Directory where the aligned bands are
+            stored. Defaults to an `aligned` directory next to the products.
+        max_pixels (int): The maximum size of the window read at once.
+
+    Raises:
+        FileNotFoundError if there are no bands at the resolution in the
+            data path.
+        ValueError if a product lacks a band needed by the indexes.
+
+    Returns:
+        A DataFrame with one row per product, field and index, with the
+            product name, the field geometry hash, its farm name, the index
+            name, and the count of valid pixels, mean, std, median and
+            percentiles.
+    """
+    names = [definition.name for definition in get_index_definitions(indexes)]
+    needed_bands = get_required_bands(names)
+    work_units = schedule_products(data_path, fields, resolution, zipped, mosaic=False)
+    if not work_units and not get_band_paths(data_path, resolution, zipped=zipped, any_resolution=True):
+        raise FileNotFoundError(f'No bands found in {data_path}')
+
+    tables = []
+    for unit in work_units:
+        band_paths = get_band_paths(
+            Path(unit.path), resolution, needed_bands, zipped=zipped, any_resolution=resampling is not None
+        )
+        if resampling is not None:
+            band_paths = align_band_paths(
+                band_paths, resolution, resampling, aligned_directory or default_aligned_directory(data_path)
+            )
+        missing = sorted(set(needed_bands) - set(band_paths))
+        if missing:
+            raise ValueError(f'The product {unit.product} has no {", ".join(missing)} bands at {resolution}m')
+
+        for table in product_statistics(
+                band_paths, resolution, unit.fields, unit.geometries, names, percentiles, max_pixels
+        ):
+            table.insert(0, 'product', unit.product)
+            tables.append(table)
+
+    if not tables:
+        return pd.DataFrame(columns=['product', 'field', 'farm_name', 'index'])
+    return pd.concat(tables, ignore_index=True)
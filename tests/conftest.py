@@ -0,0 +1,35 @@
+import sys
+import threading
+
+from http.server import ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+# The package modules import each other by their flat names, as the CLI does.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'pySatell'))
+
+
+@pytest.fixture
+def http_server():
+    """Returns a function starting a local http server with a request handler class.
+
+    The server runs in a background thread and is shut down after the test.
+    Its url is available as `server.url`.
+    """
+    servers = []
+
+    def start(handler, **attributes) -> ThreadingHTTPServer:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        for name, value in attributes.items():
+            setattr(server, name, value)
+        server.url = f'http://127.0.0.1:{server.server_port}/'
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,39 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('shapely')
+
+from classification import NODATA_CLASS, classify  # noqa: E402
+from models import Band, BandNumber, Bands  # noqa: E402
+
+
+def make_bands(valid) -> Bands:
+    def band(name: str, value: float) -> Band:
+        return Band(BandNumber(name), 10, np.full((1, 2, 2), value), valid)
+
+    return Bands(B02=band('B02', 500), B04=band('B04', 800), B08=band('B08', 4000))
+
+
+@pytest.mark.parametrize('index', ['evi', 'savi'])
+def test_scaled_index_keeps_nan_in_the_masked_pixels(index):
+    valid = np.array([[[True, False], [True, False]]])
+
+    raster = getattr(make_bands(valid), index)()
+
+    assert np.isnan(np.ma.getdata(raster)[~valid]).all()
+
+
+def test_classify_masked_evi_as_nodata_outside_the_field():
+    valid = np.array([[[True, False], [True, False]]])
+    evi = make_bands(valid).evi()
+
+    classes = classify(evi, breakpoints=(0.0, 0.5))
+
+    assert (classes[~valid] == NODATA_CLASS).all()
+    assert (classes[valid] == 2).all()
+
+
+def test_classify_masked_array_with_finite_data():
+    raster = np.ma.masked_array([0.1, 2.5], mask=[False, True])
+
+    assert classify(raster, breakpoints=(0.0, 0.5)).tolist() == [1, NODATA_CLASS]
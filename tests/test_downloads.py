@@ -0,0 +1,149 @@
+import hashlib
+
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+import downloads  # noqa: E402
+from downloads import ChecksumError, DownloadScheduler, ProductDownload  # noqa: E402
+
+PAYLOAD = bytes(range(256)) * 400
+
+
+class ProductHandler(BaseHTTPRequestHandler):
+    """Serves the server payload, honoring Range requests and failing the first requests."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.path.endswith('missing'):
+            self.send_error(404)
+            return
+        if server.failures:
+            server.failures -= 1
+            self.send_error(503)
+            return
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            start = int(range_header[len('bytes='):-len('-')])
+            if start >= len(server.payload):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(server.payload) - 1}/{len(server.payload)}')
+        else:
+            self.send_response(200)
+
+        body = server.payload[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def product_server(http_server):
+    return http_server(ProductHandler, payload=PAYLOAD, failures=0, requests=[])
+
+
+def make_product(server, md5: bool = True, name: str = 'product') -> ProductDownload:
+    return ProductDownload(
+        id=name,
+        title=f'S2A_MSIL2A_20220101T000000_N0301_R001_T20HNH_{name}',
+        url=f'{server.url}{name}',
+        md5=hashlib.md5(PAYLOAD).hexdigest() if md5 else None,
+        size=len(PAYLOAD)
+    )
+
+
+def test_download_resumes_partial_file(product_server, tmp_path):
+    product = make_product(product_server)
+    partial_path = tmp_path / f'{product.title}.zip.incomplete'
+    partial_path.write_bytes(PAYLOAD[:1000])
+
+    result = DownloadScheduler(requests.Session(), tmp_path).download(product)
+
+    assert result.path.read_bytes() == PAYLOAD
+    assert result.downloaded_bytes == len(PAYLOAD) - 1000
+    assert product_server.requests[0]['Range'] == 'bytes=1000-'
+    assert not partial_path.exists()
+
+
+def test_download_skips_verified_file(product_server, tmp_path):
+    product = make_product(product_server)
+    (tmp_path / f'{product.title}.zip').write_bytes(PAYLOAD)
+
+    result = DownloadScheduler(requests.Session(), tmp_path).download(product)
+
+    assert result.skipped
+    assert product_server.requests == []
+    assert (tmp_path / f'{product.title}.zip.md5').read_text() == product.md5
+
+
+def test_download_retries_with_backoff(product_server, tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(downloads.time, 'sleep', delays.append)
+    product_server.failures = 2
+
+    result = DownloadScheduler(requests.Session(), tmp_path, backoff=0.5).download(make_product(product_server))
+
+    assert result.path.read_bytes() == PAYLOAD
+    assert delays == [0.5, 1.0]
+    assert len(product_server.requests) == 3
+
+
+def test_download_raises_after_the_last_attempt(product_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads.time, 'sleep', lambda seconds: None)
+    product_server.failures = 3
+
+    with pytest.raises(requests.HTTPError):
+        DownloadScheduler(requests.Session(), tmp_path, max_attempts=3).download(make_product(product_server))
+
+
+def test_download_rejects_checksum_mismatch(product_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(downloads.time, 'sleep', lambda seconds: None)
+    product = make_product(product_server)
+    product.md5 = hashlib.md5(b'other').hexdigest()
+
+    with pytest.raises(ChecksumError):
+        DownloadScheduler(requests.Session(), tmp_path, max_attempts=2).download(product)
+
+    assert not (tmp_path / f'{product.title}.zip').exists()
+
+
+def test_download_fails_at_once_on_client_errors(product_server, tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(downloads.time, 'sleep', delays.append)
+
+    with pytest.raises(requests.HTTPError):
+        DownloadScheduler(requests.Session(), tmp_path).download(make_product(product_server, name='missing'))
+
+    assert delays == []
+    assert len(product_server.requests) == 1
+
+
+def test_download_elapsed_excludes_the_backoff(product_server, tmp_path):
+    product_server.failures = 1
+
+    result = DownloadScheduler(requests.Session(), tmp_path, backoff=0.3).download(make_product(product_server))
+
+    assert result.downloaded_bytes == len(PAYLOAD)
+    assert result.elapsed < 0.3
+
+
+def test_download_all_returns_the_failed_products(product_server, tmp_path):
+    products = [make_product(product_server, name='missing'), make_product(product_server)]
+
+    results = DownloadScheduler(requests.Session(), tmp_path).download_all(products)
+
+    assert [result.product for result in results] == products
+    assert results[0].failed and isinstance(results[0].error, requests.HTTPError)
+    assert not results[1].failed
+    assert results[1].path.read_bytes() == PAYLOAD
@@ -0,0 +1,48 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+rasterio = pytest.importorskip('rasterio')
+pytest.importorskip('shapely')
+
+from affine import Affine  # noqa: E402
+from rasterio.crs import CRS  # noqa: E402
+
+from export import INT16_NODATA, IndexEncoding, export_mosaic, int16_scale  # noqa: E402
+from models import Band, BandNumber, Bands, FieldData  # noqa: E402
+
+CRS_UTM = CRS.from_epsg(32720)
+
+
+def make_field(left: float, top: float, nir: float, size: int = 4) -> FieldData:
+    """A field of size x size pixels with a uniform ndvi of (nir - 1000) / (nir + 1000)."""
+    transform = Affine(10, 0, left, 0, -10, top)
+
+    def band(name: str, value: float) -> Band:
+        return Band(BandNumber(name), 10, np.full((1, size, size), value), None, transform, CRS_UTM)
+
+    return FieldData({}, {}, Bands(B04=band('B04', 1000), B08=band('B08', nir)))
+
+
+@pytest.mark.parametrize('encoding', list(IndexEncoding))
+def test_export_mosaic_merges_overlapping_fields(tmp_path, encoding):
+    # The second field overlaps the bottom right 2 x 2 pixels of the first one.
+    first = make_field(500000, 6000000, nir=3000)
+    second = make_field(500020, 5999980, nir=9000)
+
+    path = export_mosaic([first, second], tmp_path / 'ndvi.tif', 'ndvi', encoding)
+
+    with rasterio.open(path) as dataset:
+        assert (dataset.width, dataset.height) == (6, 6)
+        assert dataset.transform == Affine(10, 0, 500000, 0, -10, 6000000)
+        raster = dataset.read(1)
+        if encoding is IndexEncoding.INT16:
+            assert dataset.scales == (int16_scale('ndvi'),)
+            nodata = raster == INT16_NODATA
+            raster = np.where(nodata, np.nan, raster * int16_scale('ndvi'))
+
+    np.testing.assert_allclose(raster[:2, :4], 0.5, atol=1e-4)
+    np.testing.assert_allclose(raster[2:4, :2], 0.5, atol=1e-4)
+    # The overlapping pixels are taken from the last field.
+    np.testing.assert_allclose(raster[2:, 2:], 0.8, atol=1e-4)
+    assert np.isnan(raster[:2, 4:]).all()
+    assert np.isnan(raster[4:, :2]).all()
@@ -0,0 +1,45 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+rasterio = pytest.importorskip('rasterio')
+pytest.importorskip('shapely')
+
+from affine import Affine  # noqa: E402
+from rasterio.crs import CRS  # noqa: E402
+from rasterio.warp import transform_geom  # noqa: E402
+from shapely.geometry import box, mapping, shape  # noqa: E402
+
+from mosaic import get_field_grids  # noqa: E402
+
+CRS_UTM = CRS.from_epsg(32720)
+CRS_WGS84 = CRS.from_epsg(4326)
+
+
+def make_tile(path, crs: CRS, transform: Affine, size: int = 100):
+    with rasterio.open(
+            path, 'w', driver='GTiff', width=size, height=size, count=1, dtype='uint16', crs=crs, transform=transform
+    ) as dataset:
+        dataset.write(np.ones((1, size, size), dtype='uint16'))
+    return path
+
+
+def test_field_grids_reproject_geographic_fields_to_the_tile(tmp_path):
+    tile = make_tile(tmp_path / 'tile.tif', CRS_UTM, Affine(10, 0, 500005, 0, -10, 6000005))
+    field = mapping(box(500100, 5999700, 500300, 5999900))
+    geographic_field = transform_geom(CRS_UTM, CRS_WGS84, field)
+
+    grids, crs, geometries = get_field_grids([tile], [geographic_field], 10, CRS_WGS84)
+
+    assert crs == CRS_UTM
+    # The grid is on the tile pixels, and covers the field in meters.
+    assert grids[0].transform.a == 10
+    assert (grids[0].transform.c - 500005) % 10 == 0
+    assert 20 <= grids[0].width <= 22 and 20 <= grids[0].height <= 22
+    assert shape(geometries[0]).bounds == pytest.approx(shape(field).bounds, abs=1e-3)
+
+
+def test_field_grids_reject_geographic_tiles(tmp_path):
+    tile = make_tile(tmp_path / 'tile.tif', CRS_WGS84, Affine(0.0001, 0, -60, 0, -0.0001, -35))
+
+    with pytest.raises(ValueError):
+        get_field_grids([tile], [mapping(box(-59.999, -35.009, -59.998, -35.008))], 10, CRS_WGS84)
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import time
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+pytest.importorskip('requests')
+pytest.importorskip('shapely')
+
+import query  # noqa: E402
+from query import AreaQuery, AsyncQueryClient, RateLimiter  # noqa: E402
+
+WEST = 'POLYGON ((0 0, 1 0, 1 1, 0 1, 0 0))'
+EAST = 'POLYGON ((1 0, 2 0, 2 1, 1 1, 1 0))'
+
+
+def make_entry(product_id: str, footprint: str, date: str) -> dict:
+    return {
+        'id': product_id,
+        'title': f'S2A_MSIL2A_{product_id}',
+        'str': [{'name': 'footprint', 'content': footprint}],
+        'date': {'name': 'beginposition', 'content': f'{date}T10:00:00.000Z'},
+    }
+
+
+ENTRIES = [
+    make_entry('west', 'POLYGON ((0.2 0.2, 0.8 0.2, 0.8 0.8, 0.2 0.8, 0.2 0.2))', '2022-01-05'),
+    make_entry('east', 'POLYGON ((1.2 0.2, 1.8 0.2, 1.8 0.8, 1.2 0.8, 1.2 0.2))', '2022-01-05'),
+    make_entry('east-late', 'POLYGON ((1.2 0.2, 1.8 0.2, 1.8 0.8, 1.2 0.8, 1.2 0.2))', '2022-01-25'),
+]
+
+
+class HubHandler(BaseHTTPRequestHandler):
+    """Serves the server entries as OpenSearch pages, sending the server statuses first."""
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        params = parse_qs(urlparse(self.path).query)
+        server.requests.append({'q': parse_qs(body)['q'][0], 'start': int(params['start'][0])})
+        time.sleep(server.delay)
+
+        if server.statuses:
+            self.send_response(server.statuses.pop(0))
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        start, rows = int(params['start'][0]), int(params['rows'][0])
+        body = json.dumps({
+            'feed': {'opensearch:totalResults': str(len(server.entries)), 'entry': server.entries[start:start + rows]}
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def hub_server(http_server):
+    return http_server(HubHandler, entries=ENTRIES, statuses=[], delay=0.0, requests=[])
+
+
+def make_client(server, **options) -> AsyncQueryClient:
+    options = {'rate': 1000, 'burst': 100, 'backoff': 0.01, **options}
+    return AsyncQueryClient(server.url, 'user', 'password', **options)
+
+
+def run(coroutine_function):
+    """Run a coroutine function receiving nothing, returning its result."""
+    return asyncio.run(coroutine_function())
+
+
+def test_query_areas_coalesces_and_fans_out(hub_server):
+    queries = [
+        AreaQuery('west', WEST, datetime(2022, 1, 1), datetime(2022, 1, 10)),
+        AreaQuery('east', EAST, datetime(2022, 1, 5), datetime(2022, 1, 31)),
+    ]
+
+    async def query_areas():
+        async with make_client(hub_server) as client:
+            return await client.query_areas(queries)
+
+    areas_products = run(query_areas)
+
+    assert len(hub_server.requests) == 1
+    assert 'beginPosition:[2022-01-01T00:00:00.000Z TO 2022-01-31T00:00:00.000Z]' in hub_server.requests[0]['q']
+    assert list(areas_products['west']) == ['west']
+    assert list(areas_products['east']) == ['east', 'east-late']
+
+
+def test_query_requests_the_remaining_pages(hub_server):
+    async def query_area():
+        async with make_client(hub_server, page_size=2) as client:
+            return await client.query(WEST, datetime(2022, 1, 1), datetime(2022, 1, 31))
+
+    products = run(query_area)
+
+    assert list(products) == ['west', 'east', 'east-late']
+    assert sorted(request['start'] for request in hub_server.requests) == [0, 2]
+
+
+def test_identical_queries_in_flight_are_sent_once(hub_server):
+    hub_server.delay = 0.2
+
+    async def query_twice():
+        async with make_client(hub_server) as client:
+            return await asyncio.gather(
+                client.query(WEST, datetime(2022, 1, 1), datetime(2022, 1, 10)),
+                client.query(WEST, datetime(2022, 1, 1), datetime(2022, 1, 10)),
+            )
+
+    first, second = run(query_twice)
+
+    assert len(hub_server.requests) == 1
+    assert first == second
+
+
+def test_throttled_query_honors_retry_after(hub_server, monkeypatch):
+    delays = []
+
+    async def sleep(seconds):
+        delays.append(seconds)
+
+    hub_server.statuses = [429]
+
+    async def query_area():
+        async with make_client(hub_server) as client:
+            monkeypatch.setattr(query.asyncio, 'sleep', sleep)
+            return await client.query(WEST, datetime(2022, 1, 1), datetime(2022, 1, 10))
+
+    products = run(query_area)
+
+    assert list(products) == ['west', 'east', 'east-late']
+    assert delays == [1.0]
+    assert len(hub_server.requests) == 2
+
+
+def test_failed_query_raises_after_the_last_attempt(hub_server):
+    hub_server.statuses = [503, 503]
+
+    async def query_area():
+        async with make_client(hub_server, max_attempts=2) as client:
+            return await client.query(WEST, datetime(2022, 1, 1), datetime(2022, 1, 10))
+
+    with pytest.raises(query.requests.HTTPError):
+        run(query_area)
+    assert len(hub_server.requests) == 2
+
+
+def test_rate_limiter_allows_a_burst_then_the_rate():
+    limiter = RateLimiter(rate=20, burst=2)
+
+    async def acquire_times():
+        times = []
+        for _ in range(5):
+            await limiter.acquire()
+            times.append(time.monotonic())
+        return times
+
+    times = run(acquire_times)
+
+    assert times[1] - times[0] < 0.04
+    # The burst is spent, so the next requests wait 1 / rate each.
+    assert all(later - earlier >= 0.045 for earlier, later in zip(times[1:], times[2:]))